@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Benchmark columnar batch reading of BAM files
+
+Compares extracting the fixed-width core fields through the per-record
+iterator of ``BAMFile`` against ``BAMFile.iter_batches()``.
+
+Usage: bench_bam_batches.py [PATH.bam] [REPEATS]
+"""
+
+import os.path
+import sys
+import time
+
+import pyhtslib.bam as bam
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                            'files', 'two_hundred.bam')
+FIELDS = list(bam.BAM_BATCH_FIXED_FIELDS.keys())
+
+
+def per_record(path):
+    """Extract the core fields record by record"""
+    num = 0
+    with bam.BAMFile(path) as f:
+        for record in f:
+            [getattr(record, name) for name in FIELDS]
+            num += 1
+    return num
+
+
+def batches(path):
+    """Extract the core fields batch by batch"""
+    num = 0
+    with bam.BAMFile(path) as f:
+        for batch in f.iter_batches(fields=FIELDS):
+            num += len(batch)
+    return num
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else DEFAULT_PATH
+    repeats = int(argv[2]) if len(argv) > 2 else 20
+    results = {}
+    for name, func in [('per-record', per_record), ('batches', batches)]:
+        num = 0
+        start = time.perf_counter()
+        for _ in range(repeats):
+            num += func(path)
+        results[name] = time.perf_counter() - start
+        print('{:>10}: {:.3f}s, {:,.0f} records/s'.format(
+            name, results[name], num / results[name]))
+    print('speedup: {:.1f}x'.format(results['per-record'] /
+                                    results['batches']))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
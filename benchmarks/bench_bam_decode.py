@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Benchmark SEQ/QUAL decoding of BAM records
+
+Compares the per-base decoding (``_bam_seqi`` for each base, ``chr()`` for
+each quality value) against the bulk decoding through ``ctypes.string_at``
+and ``bytes.translate`` that is used by ``BAMRecordImpl``.
+
+Usage: bench_bam_decode.py [PATH.bam] [REPEATS]
+"""
+
+import ctypes
+import os.path
+import sys
+import time
+
+import pyhtslib.bam as bam
+from pyhtslib.bam_internal import *  # NOQA
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                            'files', 'two_hundred.bam')
+
+
+def decode_per_base(ptr):
+    """Previous implementation, decoding one base/quality at a time"""
+    l_qseq = ptr[0].core.l_qseq
+    seq_ptr = ctypes.cast(_bam_get_seq(ptr), ctypes.POINTER(ctypes.c_uint8))
+    seq = ''.join([_BAM_SEQ_STR[_bam_seqi(seq_ptr, i)]
+                   for i in range(l_qseq)])
+    qual_ptr = _bam_get_qual(ptr)
+    qual = ''.join([chr(ord('!') + qual_ptr[i]) for i in range(l_qseq)])
+    return seq, qual
+
+
+def decode_bulk(ptr):
+    """Current implementation, decoding the whole buffer at once"""
+    seq = bam.decode_seq(_bam_get_seq_bytes(ptr), ptr[0].core.l_qseq)
+    qual = bam.decode_qual(_bam_get_qual_bytes(ptr))
+    return seq, qual
+
+
+def run(path, func, repeats):
+    """Run ``func`` on each record of ``path``, ``repeats`` times"""
+    num_bases = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        with bam.BAMFile(path) as f:
+            for record in f:
+                seq, _ = func(record.struct_ptr)
+                num_bases += len(seq)
+    return time.perf_counter() - start, num_bases
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else DEFAULT_PATH
+    repeats = int(argv[2]) if len(argv) > 2 else 20
+    # baseline: I/O only
+    io_time, _ = run(path, lambda ptr: ('', ''), repeats)
+    results = {}
+    for name, func in [('per-base', decode_per_base), ('bulk', decode_bulk)]:
+        elapsed, num_bases = run(path, func, repeats)
+        results[name] = elapsed - io_time
+        print('{:>10}: {:.3f}s total, {:.3f}s decoding, {:,} bases'.format(
+            name, elapsed, results[name], num_bases))
+    print('speedup of decoding: {:.1f}x'.format(
+        results['per-base'] / max(results['bulk'], 1e-9)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
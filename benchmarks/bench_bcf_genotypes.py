@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Benchmark extraction of per-sample FORMAT values from VCF records
+
+Generates VCF files with an increasing number of samples and measures the
+time for building ``BCFRecord.genotypes``.  As each FORMAT field is
+extracted once per record, the time per sample should stay constant when
+the number of samples grows.
+
+Usage: bench_bcf_genotypes.py [NUM_RECORDS] [SAMPLE_COUNTS...]
+"""
+
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pyhtslib.bcf as bcf
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+HEADER = '''##fileformat=VCFv4.2
+##contig=<ID=1,length=249250621>
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Phred likelihoods">
+'''
+
+
+def write_vcf(path, num_records, num_samples, seed=42):
+    """Write VCF file with random genotypes to ``path``"""
+    rng = random.Random(seed)
+    with open(path, 'wt') as f:
+        f.write(HEADER)
+        f.write('\t'.join(
+            ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO',
+             'FORMAT'] + ['S{}'.format(i) for i in range(num_samples)]))
+        f.write('\n')
+        for i in range(num_records):
+            samples = []
+            for _ in range(num_samples):
+                gt = rng.choice(['0/0', '0/1', '1/1', './.'])
+                ref, alt = rng.randint(0, 40), rng.randint(0, 40)
+                samples.append('{}:{},{}:{}:{}:{},{},{}'.format(
+                    gt, ref, alt, ref + alt, rng.randint(0, 99),
+                    rng.randint(0, 255), rng.randint(0, 255),
+                    rng.randint(0, 255)))
+            f.write('\t'.join(['1', str(1000 + 10 * i), '.', 'A', 'G', '50',
+                               'PASS', '.', 'GT:AD:DP:GQ:PL'] + samples))
+            f.write('\n')
+
+
+def run(path):
+    """Build the genotypes of all records in ``path``"""
+    start = time.perf_counter()
+    with bcf.BCFFile(path) as f:
+        for record in f:
+            record.genotypes
+    return time.perf_counter() - start
+
+
+def main(argv):
+    num_records = int(argv[1]) if len(argv) > 1 else 50
+    sample_counts = [int(x) for x in argv[2:]] or [500, 1000, 2500, 5000]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>10} {:>14} {:>14}'.format(
+            'samples', 'time', 'ms/record', 'us/sample'))
+        for num_samples in sample_counts:
+            path = os.path.join(tmpdir, 'bench.vcf')
+            write_vcf(path, num_records, num_samples)
+            elapsed = run(path)
+            print('{:>8} {:>9.3f}s {:>14.2f} {:>14.2f}'.format(
+                num_samples, elapsed, 1e3 * elapsed / num_records,
+                1e6 * elapsed / num_records / num_samples))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
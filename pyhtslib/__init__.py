@@ -5,11 +5,38 @@
 class GenomeInterval:
     """Zero-based genome interval."""
 
+    @staticmethod
+    def from_str(region_str):
+        """Parse samtools-style region string ``seq[:begin[-end]]``
+
+        The positions in the string are one-based and inclusive and may
+        contain thousands separators.  ``end_pos`` is ``None`` if the end is
+        open.
+        """
+        seq, sep, range_ = region_str.rpartition(':')
+        if not sep:
+            return GenomeInterval(region_str, 0, None)
+        begin, _, end = range_.replace(',', '').partition('-')
+        return GenomeInterval(seq, int(begin) - 1,
+                              int(end) if end else None)
+
     def __init__(self, seq, begin_pos, end_pos):
         self.seq = seq
         self.begin_pos = begin_pos
         self.end_pos = end_pos
 
+    def __eq__(self, other):
+        return (self.seq == other.seq and
+                self.begin_pos == other.begin_pos and
+                self.end_pos == other.end_pos)
+
+    def __hash__(self):
+        return hash((self.seq, self.begin_pos, self.end_pos))
+
+    def __repr__(self):
+        return 'GenomeInterval({}, {}, {})'.format(
+            repr(self.seq), self.begin_pos, self.end_pos)
+
     def __str__(self):
         return '{}:{:,}-{:,}'.format(self.seq, self.begin_pos + 1,
                                      self.end_pos)
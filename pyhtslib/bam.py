@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 """Access to SAM and BAM files through htslib"""
 
+import array
 import collections
 import ctypes
 import logging
+import numbers
 import os
 import os.path
+import struct
+import sys
 
+from pyhtslib.hts import (
+    QUERY_MANY_MAX_GAP, BGZFBlockCache, build_many, parallel_map,
+    query_many, require_numpy, require_pyarrow, set_threads)
 from pyhtslib.hts_internal import *  # NOQA
 from pyhtslib.bam_internal import *  # NOQA
 from pyhtslib.tabix_internal import *  # NOQA
@@ -141,10 +148,33 @@ class BAMHeader:
         self.struct = None
 
     def to_sam_header(self):
-        """Return SAM header representation"""
-        def f(entry):
-            return entry.to_sam_header()
-        return '\n'.join(map(f, self.header_record))
+        """Return SAM header representation
+
+        ``@SQ`` lines are generated from ``self.target_infos`` if there are
+        none in ``self.header_records``.
+        """
+        lines = [rec.for_sam_header() for rec in self.header_records]
+        if not any(getattr(rec, 'key', None) == 'SQ'
+                   for rec in self.header_records):
+            pos = 1 if lines and lines[0].startswith('@HD') else 0
+            lines[pos:pos] = [
+                '@SQ\tSN:{}\tLN:{}'.format(info.name, info.length)
+                for info in self.target_infos]
+        return ''.join(line + '\n' for line in lines)
+
+    def _to_struct(self):
+        """Return pointer to new ``bam_hdr_t`` built from the header text
+
+        The caller is responsible for freeing it with ``bam_hdr_destroy()``.
+        """
+        text = self.to_sam_header().encode('utf-8')
+        ptr = _sam_hdr_parse(len(text), text)
+        if not ptr:
+            raise BAMFileException('Could not build BAM header')
+        # sam_hdr_parse() only fills the targets
+        ptr[0].l_text = len(text)
+        ptr[0].text = _strdup(text)
+        return ptr
 
 
 class CIGARElement:
@@ -164,113 +194,358 @@ class CIGARElement:
         return '{}{}'.format(self.count, self.operation)
 
 
+def decode_seq(packed, length, as_numpy=False):
+    """Decode BAM 4-bit packed sequence ``packed`` with ``length`` bases
+
+    Two bases are decoded at once through 256-entry lookup tables and
+    ``bytes.translate``.  Returns a ``str`` or, if ``as_numpy`` is true, a
+    NumPy ``uint8`` array with the ASCII codes of the bases.
+    """
+    buf = _decode_seq_bytes(packed, length)
+    if as_numpy:
+        return require_numpy(BAMFileException).frombuffer(buf, dtype='u1')
+    return buf.decode('ascii')
+
+
+def _decode_seq_bytes(packed, length):
+    """Decode 4-bit packed sequence to ``bytearray`` of ASCII characters"""
+    buf = bytearray(len(packed) * 2)
+    buf[0::2] = packed.translate(_BAM_SEQ_HI_TABLE)
+    buf[1::2] = packed.translate(_BAM_SEQ_LO_TABLE)
+    del buf[length:]
+    return buf
+
+
+def decode_qual(raw, as_numpy=False):
+    """Decode BAM quality bytes ``raw`` to Phred+33 ``str``
+
+    Returns ``'*'`` if the qualities are missing.  If ``as_numpy`` is true, a
+    NumPy ``uint8`` array with the Phred values is returned instead.
+    """
+    if as_numpy:
+        return require_numpy(BAMFileException).frombuffer(raw, dtype='u1')
+    return _decode_qual_bytes(raw).decode('ascii')
+
+
+def _decode_qual_bytes(raw):
+    """Decode quality bytes to Phred+33 ``bytes``, ``b'*'`` if missing"""
+    if raw[:1] == b'\xff':
+        return b'*'
+    return raw.translate(_BAM_QUAL_TABLE)
+
+
+def _array_typecode(candidates, itemsize):
+    """Return first ``array`` type code from ``candidates`` with ``itemsize``
+    """
+    return next(c for c in candidates if array.array(c).itemsize == itemsize)
+
+
+# ``struct.Struct`` objects for the scalar aux field types
+_AUX_STRUCTS = {
+    'c': struct.Struct('<b'), 'C': struct.Struct('<B'),
+    's': struct.Struct('<h'), 'S': struct.Struct('<H'),
+    'i': struct.Struct('<i'), 'I': struct.Struct('<I'),
+    'f': struct.Struct('<f'), 'd': struct.Struct('<d'),
+}
+# size of the scalar aux field types, in bytes
+_AUX_SIZES = dict([('A', 1)] +
+                  [(key, fmt.size) for key, fmt in _AUX_STRUCTS.items()])
+# ``array`` type codes for the element types of ``B`` arrays
+_AUX_ARRAY_TYPECODES = {
+    'c': 'b', 'C': 'B', 's': 'h', 'S': 'H',
+    'i': _array_typecode('il', 4), 'I': _array_typecode('IL', 4), 'f': 'f',
+}
+# NumPy dtypes for the element types of ``B`` arrays
+_AUX_NUMPY_DTYPES = {
+    'c': '<i1', 'C': '<u1', 's': '<i2', 'S': '<u2', 'i': '<i4', 'I': '<u4',
+    'f': '<f4',
+}
+_AUX_UINT32 = _AUX_STRUCTS['I']
+
+
 class BAMAuxTagParser:
-    """Helper for parsing aux field tags from BAM records"""
-    # TODO(holtgrewe): This probably works better using ctypes.string_at and
-    # then performing all parsing in native Python.
+    """Helper for parsing aux field tags from BAM records
 
-    def __init__(self, struct_ptr, aux, aux_len):
-        self.struct_ptr = struct_ptr
-        self.aux = aux
-        self.aux_len = aux_len
-        self.keys = self.get_keys()
+    The aux block is copied once using ``ctypes.string_at()`` and then parsed
+    in a single pass in Python.  Arrays (type ``B``) are returned as
+    ``array.array`` or, if ``as_numpy`` is true, as read-only NumPy views on
+    the copied block.
+    """
 
-    def get_keys(self):
-        """Get keys"""
-        def aux_type2size(t):
-            DIR = {'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4,
-                   'f': 4, 'd': 8, 'Z': 'Z', 'H': 'H', 'B': 'B'}
-            return DIR.get(t, 0)
-
-        def skip_aux(s):
-            # skip the type
-            def deref(s):
-                return ctypes.c_char.from_address(s).value
-            size = aux_type2size(deref(s).decode('utf-8'))
-            # print('c={}, size={}'.format(deref(s), size), file=sys.stderr)
-            s += 1
-            if size in ['Z', 'H']:
-                while deref(s) != b'\x00':
-                    s += 1
-                return s + 1
-            elif size == 'B':
-                size = aux_type2size(deref(s).decode('utf-8'))
-                s += 1
-                n = ctypes.c_uint32(0)
-                ctypes.memmove(ctypes.byref(n), s, 4)
-                return s + size * n.value
-            elif size == 0:
-                raise BAMFileException('Problem parsing auxiliary fields!')
-            else:
-                return s + size
+    @staticmethod
+    def from_struct(ptr, as_numpy=False):
+        """Return ``BAMAuxTagParser`` for the aux block of ``bam1_t`` ``ptr``
+        """
+        buf = ctypes.string_at(_bam_get_aux(ptr), _bam_get_l_aux(ptr))
+        return BAMAuxTagParser(buf, as_numpy)
+
+    def __init__(self, buf, as_numpy=False):
+        #: ``bytes`` with the raw aux block
+        self.buf = buf
+        #: whether or not to return arrays as NumPy arrays
+        self.as_numpy = as_numpy
 
+    def get_keys(self):
+        """Return list of keys, in the order of the aux block"""
         result = []
-        s = ctypes.addressof(self.aux.contents)
-        while s < ctypes.addressof(self.aux.contents) + self.aux_len:
-            c1 = ctypes.c_char.from_address(s).value.decode('utf-8')
-            c2 = ctypes.c_char.from_address(s + 1).value.decode('utf-8')
-            result.append('{}{}'.format(c1, c2))
-            # print('result={}'.format(result), file=sys.stderr)
-            s = skip_aux(s + 2)
+        buf = self.buf
+        pos = 0
+        while pos < len(buf):
+            result.append(buf[pos:pos + 2].decode('ascii'))
+            pos = self._skip_value(chr(buf[pos + 2]), pos + 3)
+        return result
+
+    def get_types(self):
+        """Return ``OrderedDict`` with the aux type code of each tag
+
+        The codes are single characters (e.g. ``'A'``, ``'Z'``, ``'H'``,
+        ``'C'``), except for arrays where the element type follows the
+        ``'B'``, e.g. ``'BC'`` for arrays of ``uint8_t``.
+        """
+        result = collections.OrderedDict()
+        buf = self.buf
+        pos = 0
+        while pos < len(buf):
+            key = buf[pos:pos + 2].decode('ascii')
+            type_ = chr(buf[pos + 2])
+            result[key] = type_ + chr(buf[pos + 3]) if type_ == 'B' else type_
+            pos = self._skip_value(type_, pos + 3)
         return result
 
     def __call__(self):
+        """Return ``OrderedDict`` with all tags of the aux block"""
         result = collections.OrderedDict()
-        for key in self.keys:
-            # print('key={}'.format(key), file=sys.stderr)
-            ptr = _bam_aux_get(self.struct_ptr, key.encode('utf-8'))
-            # print('ptr={}'.format(ptr), file=sys.stderr)
-            t = chr(ptr[0])
-            # print('t={}'.format(t), file=sys.stderr)
-            if t in ['c', 'C', 's', 'S', 'i', 'I']:
-                result[key] = _bam_aux2i(ptr)
-            elif t in ['d', 'f']:
-                result[key] = _bam_aux2f(ptr)
-            elif t in ['A']:
-                result[key] = _bam_aux2A(ptr)
-            elif t in ['Z', 'H']:
-                result[key] = ctypes.string_at(
-                    ctypes.addressof(_bam_aux2Z(ptr).contents)).decode('utf-')
-            else:
-                # TODO(holtgrewe): finish for arrays
-                print('WARNING: unknown type {}'.format(t), file=sys.stderr)
-                result[key] = None
+        buf = self.buf
+        pos = 0
+        while pos < len(buf):
+            key = buf[pos:pos + 2].decode('ascii')
+            result[key], pos = self._parse_value(chr(buf[pos + 2]), pos + 3)
         return result
 
+    def _skip_value(self, type_, pos):
+        """Return position after the value of type ``type_`` at ``pos``"""
+        size = _AUX_SIZES.get(type_)
+        if size:
+            return pos + size
+        elif type_ in ('Z', 'H'):
+            return self.buf.index(b'\x00', pos) + 1
+        elif type_ == 'B':
+            count = _AUX_UINT32.unpack_from(self.buf, pos + 1)[0]
+            return pos + 5 + count * self._array_item_size(pos)
+        else:
+            raise BAMFileException('Problem parsing auxiliary fields!')
+
+    def _parse_value(self, type_, pos):
+        """Return value of type ``type_`` at ``pos`` and position after it"""
+        buf = self.buf
+        fmt = _AUX_STRUCTS.get(type_)
+        if fmt:
+            return fmt.unpack_from(buf, pos)[0], pos + fmt.size
+        elif type_ == 'A':
+            return chr(buf[pos]), pos + 1
+        elif type_ in ('Z', 'H'):
+            end = buf.index(b'\x00', pos)
+            return buf[pos:end].decode('utf-8'), end + 1
+        elif type_ == 'B':
+            return self._parse_array(pos)
+        else:
+            raise BAMFileException('Problem parsing auxiliary fields!')
+
+    def _array_item_size(self, pos):
+        """Return item size of the ``B`` array with header at ``pos``"""
+        sub_type = chr(self.buf[pos])
+        if sub_type not in _AUX_ARRAY_TYPECODES:
+            raise BAMFileException('Invalid auxiliary array type!')
+        return _AUX_SIZES[sub_type]
+
+    def _parse_array(self, pos):
+        """Return ``B`` array at ``pos`` and position after it"""
+        buf = self.buf
+        sub_type = chr(buf[pos])
+        count = _AUX_UINT32.unpack_from(buf, pos + 1)[0]
+        begin = pos + 5
+        end = begin + count * self._array_item_size(pos)
+        if self.as_numpy:
+            result = require_numpy(BAMFileException).frombuffer(
+                buf, dtype=_AUX_NUMPY_DTYPES[sub_type], count=count,
+                offset=begin)
+        else:
+            result = array.array(_AUX_ARRAY_TYPECODES[sub_type])
+            result.frombytes(buf[begin:end])
+            if sys.byteorder != 'little':
+                result.byteswap()
+        return result, end
+
+
+def _aux_value(ptr):
+    """Return value of aux field from result ``ptr`` of ``bam_aux_get()``
+    """
+    type_ = chr(ptr[0])
+    if type_ in ('c', 'C', 's', 'S', 'i'):
+        return _bam_aux2i(ptr)
+    elif type_ == 'I':
+        return _bam_aux2i(ptr) & 0xffffffff
+    elif type_ in ('f', 'd'):
+        return _bam_aux2f(ptr)
+    elif type_ == 'A':
+        return _bam_aux2A(ptr).decode('ascii')
+    elif type_ in ('Z', 'H'):
+        return ctypes.string_at(_bam_aux2Z(ptr)).decode('utf-8')
+    elif type_ == 'B':
+        # copy the array header first to learn the size of the whole array
+        address = ctypes.addressof(ptr.contents) + 1
+        header = BAMAuxTagParser(ctypes.string_at(address, 5))
+        buf = ctypes.string_at(address, header._skip_value('B', 0))
+        return BAMAuxTagParser(buf)._parse_array(0)[0]
+    else:
+        raise BAMFileException('Problem parsing auxiliary fields!')
+
+
+class TagSelector:
+    """Extract a fixed selection of aux tags from ``BAMRecord``s
+
+    Construct once, e.g. ``select = TagSelector(['CB', 'UB'])``, and then
+    call for each record, ``cb, ub = select(record)``.  The aux block is
+    scanned once per record, only the selected tags are decoded and the scan
+    stops as soon as all of them have been found.
+    """
 
-class BAMRecordImpl:
+    def __init__(self, names, default=None):
+        #: names of the tags to extract
+        self.names = list(names)
+        #: value to use for tags not present in a record
+        self.default = default
+        # mapping from encoded tag name to index in self.names
+        self._indices = dict((name.encode('ascii'), i)
+                             for i, name in enumerate(self.names))
+
+    def __call__(self, record):
+        """Return ``tuple`` with the values of the tags from ``record``"""
+        if not record.struct_ptr:
+            tags = record.tags
+            return tuple(tags.get(name, self.default) for name in self.names)
+        return self._select_from_struct(record.struct_ptr)
+
+    def _select_from_struct(self, ptr):
+        """Return ``tuple`` with the values of the tags from ``bam1_t`` ptr
+        """
+        result = [self.default] * len(self.names)
+        parser = BAMAuxTagParser.from_struct(ptr)
+        buf = parser.buf
+        pos = 0
+        missing = len(self._indices)
+        while missing and pos < len(buf):
+            idx = self._indices.get(buf[pos:pos + 2])
+            if idx is None:
+                pos = parser._skip_value(chr(buf[pos + 2]), pos + 3)
+            else:
+                result[idx], pos = parser._parse_value(
+                    chr(buf[pos + 2]), pos + 3)
+                missing -= 1
+        return tuple(result)
+
+
+class _BAMFlagsMixin:
+    """Properties interpreting the ``flag`` member of BAM records"""
+
+    @property
+    def is_paired(self):
+        return (self.flag & _BAM_FPAIRED) != 0
+
+    @property
+    def is_proper_pair(self):
+        return (self.flag & _BAM_FPROPER_PAIR) != 0
+
+    @property
+    def is_unmapped(self):
+        return (self.flag & _BAM_FUNMAP) != 0
+
+    @property
+    def is_mate_unmapped(self):
+        return (self.flag & _BAM_FMUNMAP) != 0
+
+    @property
+    def is_reversed(self):
+        return (self.flag & _BAM_FREVERSE) != 0
+
+    @property
+    def is_mate_reversed(self):
+        return (self.flag & _BAM_FMREVERSE) != 0
+
+    @property
+    def is_first(self):
+        return (self.flag & _BAM_FREAD1) != 0
+
+    @property
+    def is_last(self):
+        return (self.flag & _BAM_FREAD2) != 0
+
+    @property
+    def is_secondary(self):
+        return (self.flag & _BAM_FSECONDARY) != 0
+
+    @property
+    def is_qc_fail(self):
+        return (self.flag & _BAM_FQCFAIL) != 0
+
+    @property
+    def is_duplicate(self):
+        return (self.flag & _BAM_FDUP) != 0
+
+    @property
+    def is_supplementary(self):
+        return (self.flag & _BAM_FSUPPLEMENTARY) != 0
+
+
+class BAMRecordImpl(_BAMFlagsMixin):
     """Information extracted from C internals of ``BAMRecord``"""
 
+    #: names of the fields, in the order of the constructor arguments
+    FIELDS = ('qname', 'flag', 'r_id', 'ref', 'begin_pos', 'end_pos', 'mapq',
+              'cigar', 'r_id_next', 'ref_next', 'pos_next', 'tlen', 'seq',
+              'qual', 'tags', 'tag_types')
+
     @staticmethod
     def from_struct(ptr, header):
         """Return ``BAMRecordImpl`` from internal C structure"""
-        qname = _bam_get_qname(ptr).value.decode('utf-8')
-        flag = ptr[0].core.flag
-        tid = ptr[0].core.tid
-        ref = header.target_infos[ptr[0].core.tid].name
-        pos = ptr[0].core.pos
-        end_pos = _bam_endpos(ptr)
-        mapq = ptr[0].core.qual
-        cigar = BAMRecordImpl._cigar(ptr)
-        mtid = ptr[0].core.mtid
-        mref = header.target_infos[ptr[0].core.mtid].name
-        mpos = ptr[0].core.mpos
-        isize = ptr[0].core.isize
-        _l_qseq = ptr[0].core.l_qseq
-        _seq_ptr = ctypes.cast(_bam_get_seq(ptr),
-                               ctypes.POINTER(ctypes.c_uint8))
-        seq = ''.join([_BAM_SEQ_STR[_bam_seqi(_seq_ptr, i)]
-                       for i in range(_l_qseq)])
-        _qual_ptr = _bam_get_qual(ptr)
-        qual = ''.join([chr(ord('!') + _qual_ptr[i]) for i in range(_l_qseq)])
-        # TODO(holtgrewe): make parsing of tags lazy
-        tags = BAMAuxTagParser(ptr, _bam_get_aux(ptr), _bam_get_l_aux(ptr))()
-
-        return BAMRecordImpl(qname, flag, tid, ref, pos, end_pos, mapq, cigar,
-                             mtid, mref, mpos, isize, seq, qual, tags)
+        return BAMRecordImpl(*[BAMRecordImpl.decoder(name)(ptr, header)
+                               for name in BAMRecordImpl.FIELDS])
 
     @staticmethod
-    def _cigar(ptr):
+    def decoder(name):
+        """Return function decoding field ``name`` from ``(ptr, header)``"""
+        return getattr(BAMRecordImpl, '_decode_' + name)
+
+    @staticmethod
+    def _decode_qname(ptr, header):
+        return _bam_get_qname(ptr).value.decode('utf-8')
+
+    @staticmethod
+    def _decode_flag(ptr, header):
+        return ptr[0].core.flag
+
+    @staticmethod
+    def _decode_r_id(ptr, header):
+        return ptr[0].core.tid
+
+    @staticmethod
+    def _decode_ref(ptr, header):
+        return BAMRecordImpl._ref_name(header, ptr[0].core.tid)
+
+    @staticmethod
+    def _decode_begin_pos(ptr, header):
+        return ptr[0].core.pos
+
+    @staticmethod
+    def _decode_end_pos(ptr, header):
+        return _bam_endpos(ptr)
+
+    @staticmethod
+    def _decode_mapq(ptr, header):
+        return ptr[0].core.qual
+
+    @staticmethod
+    def _decode_cigar(ptr, header):
         def to_ce(cigar):
             return CIGARElement(_bam_cigar_oplen(cigar),
                                 _bam_cigar_opchr(cigar))
@@ -278,9 +553,48 @@ class BAMRecordImpl:
         cigar_arr = _bam_get_cigar(ptr)
         return [to_ce(cigar_arr[i]) for i in range(ptr[0].core.n_cigar)]
 
+    @staticmethod
+    def _decode_r_id_next(ptr, header):
+        return ptr[0].core.mtid
+
+    @staticmethod
+    def _decode_ref_next(ptr, header):
+        return BAMRecordImpl._ref_name(header, ptr[0].core.mtid)
+
+    @staticmethod
+    def _decode_pos_next(ptr, header):
+        return ptr[0].core.mpos
+
+    @staticmethod
+    def _decode_tlen(ptr, header):
+        return ptr[0].core.isize
+
+    @staticmethod
+    def _decode_seq(ptr, header):
+        return decode_seq(_bam_get_seq_bytes(ptr), ptr[0].core.l_qseq)
+
+    @staticmethod
+    def _decode_qual(ptr, header):
+        return decode_qual(_bam_get_qual_bytes(ptr))
+
+    @staticmethod
+    def _decode_tags(ptr, header):
+        return BAMAuxTagParser.from_struct(ptr)()
+
+    @staticmethod
+    def _decode_tag_types(ptr, header):
+        return BAMAuxTagParser.from_struct(ptr).get_types()
+
+    @staticmethod
+    def _ref_name(header, r_id):
+        """Return name of reference ``r_id``, ``None`` if unset (``-1``)"""
+        if r_id < 0:
+            return None
+        return header.target_infos[r_id].name
+
     def __init__(self, qname, flag, r_id, ref, begin_pos, end_pos, mapq,
                  cigar, r_id_next, ref_next, pos_next, tlen, seq, qual,
-                 tags):
+                 tags, tag_types=None):
         #: read name (QNAME)
         self.qname = qname
         #: numeric flag (FLAG)
@@ -312,60 +626,63 @@ class BAMRecordImpl:
         self.qual = qual
         #: tags, as ``OrderedDict``
         self.tags = tags
+        #: aux type codes of the tags, as returned by
+        #: ``BAMAuxTagParser.get_types()``, ``None`` to derive them from the
+        #: values when writing
+        self.tag_types = tag_types
 
-    @property
-    def is_paired(self):
-        return (self.flag & _BAM_FPAIRED) != 0
-
-    @property
-    def is_proper_pair(self):
-        return (self.flag & _BAM_FPROPER_PAIR) != 0
-
-    @property
-    def is_unmapped(self):
-        return (self.flag & _BAM_UNMAP) != 0
-
-    @property
-    def is_mate_unmapped(self):
-        return (self.flag & _BAM_MUNMAP) != 0
-
-    @property
-    def is_reversed(self):
-        return (self.flag & _BAM_FREVERSE) != 0
 
-    @property
-    def is_mate_reversed(self):
-        return (self.flag & _BAM_FMREVERSE) != 0
-
-    @property
-    def is_first(self):
-        return (self.flag & _BAM_FREAD1) != 0
-
-    @property
-    def is_last(self):
-        return (self.flag & _BAM_FREAD2) != 0
-
-    @property
-    def is_secondary(self):
-        return (self.flag & _BAM_FSECONDARY) != 0
-
-    @property
-    def is_qc_fail(self):
-        return (self.flag & _BAM_FQC_FAIL) != 0
-
-    @property
-    def is_duplicate(self):
-        return (self.flag & _BAM_FDUPLICATE) != 0
-
-    @property
-    def is_supplementary(self):
-        return (self.flag & _BAM_FSUPPLEMENTARY) != 0
+class _LazyBAMRecordField:
+    """Descriptor for a lazily decoded field of ``BAMRecord``
 
+    The value is decoded from the wrapped ``bam1_t`` on first access and
+    cached until the record is reset for the next iteration.
+    """
 
-class BAMRecord:
-    """Record from a BAM file"""
+    def __init__(self, name):
+        self.name = name
+        self.decode = BAMRecordImpl.decoder(name)
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        if record.impl:
+            return getattr(record.impl, self.name)
+        cache = record._cache
+        if self.name not in cache:
+            if not record.struct_ptr:
+                raise AttributeError('self.impl is None and cannot rebuild '
+                                     'from None self.struct')
+            cache[self.name] = self.decode(record.struct_ptr, record.header)
+        return cache[self.name]
+
+
+class BAMRecord(_BAMFlagsMixin):
+    """Record from a BAM file
+
+    The fields are decoded lazily from the wrapped C struct, one at a time
+    on first access, so only the fields actually used are paid for.
+    """
 
-    def __init__(self, struct_ptr=None, header=None, impl=None):
+    qname = _LazyBAMRecordField('qname')
+    flag = _LazyBAMRecordField('flag')
+    r_id = _LazyBAMRecordField('r_id')
+    ref = _LazyBAMRecordField('ref')
+    begin_pos = _LazyBAMRecordField('begin_pos')
+    end_pos = _LazyBAMRecordField('end_pos')
+    mapq = _LazyBAMRecordField('mapq')
+    cigar = _LazyBAMRecordField('cigar')
+    r_id_next = _LazyBAMRecordField('r_id_next')
+    ref_next = _LazyBAMRecordField('ref_next')
+    pos_next = _LazyBAMRecordField('pos_next')
+    tlen = _LazyBAMRecordField('tlen')
+    seq = _LazyBAMRecordField('seq')
+    qual = _LazyBAMRecordField('qual')
+    tags = _LazyBAMRecordField('tags')
+    tag_types = _LazyBAMRecordField('tag_types')
+
+    def __init__(self, struct_ptr=None, header=None, impl=None,
+                 owns_struct=False):
         #: pointer to wrapped C struct
         self.struct_ptr = struct_ptr
         #: wrapped C struct
@@ -374,8 +691,12 @@ class BAMRecord:
             self.struct = self.struct_ptr[0]
         #: ``BAMHeader`` for references
         self.header = header
-        #: ``BAMRecordImpl`` instance used for the representation
+        #: ``BAMRecordImpl`` instance used for the representation, if any
         self.impl = impl
+        # whether or not the C struct has to be freed by this record
+        self._owns_struct = owns_struct
+        # fields decoded from the C struct so far
+        self._cache = {}
 
     def detach(self):
         """Return copy that is detached from the underlying C object
@@ -386,25 +707,51 @@ class BAMRecord:
         ``BAMRecord`` around for longer than the current iteration then you
         have to obtain a copy that is independent of the current buffer
         through the use of ``detach()``.
+
+        The copy is made using ``bam_dup1()`` on the raw record, no fields
+        are decoded.
         """
-        impl = self.impl
-        if not impl:
-            impl = BAMRecordImpl.from_struct(self.struct_ptr, self.header)
-        self.impl = None
-        return BAMRecord(impl=impl)
+        if not self.struct_ptr:
+            return BAMRecord(impl=self.impl)
+        return BAMRecord(_bam_dup1(self.struct_ptr), self.header,
+                         owns_struct=True)
+
+    def get_tag(self, name, default=None):
+        """Return value of aux tag ``name``, ``default`` if not present
+
+        Only the requested tag is looked up (using ``bam_aux_get()``) and
+        decoded, the remaining aux block is not parsed.
+        """
+        if not self.struct_ptr:
+            return self.tags.get(name, default)
+        ptr = _bam_aux_get(self.struct_ptr, name.encode('ascii'))
+        if not ptr:
+            return default
+        return _aux_value(ptr)
+
+    def has_tag(self, name):
+        """Return whether or not the record has the aux tag ``name``"""
+        if not self.struct_ptr:
+            return name in self.tags
+        return bool(_bam_aux_get(self.struct_ptr, name.encode('ascii')))
 
     def _reset(self):
         """Reset Python side, as if freshly constructed"""
         self.impl = None
+        self._cache = {}
 
-    def __getattr__(self, name):
-        """Delegation to self.impl if set, auto-set from struct"""
-        if not self.impl and not self.struct:
-            raise AttributeError('self.impl is None and cannot rebuild from '
-                                 'None self.struct')
-        elif not self.impl and self.struct:
-            self.impl = BAMRecordImpl.from_struct(self.struct_ptr, self.header)
-        return getattr(self.impl, name)
+    def free(self):
+        """Free C struct if owned by this record (after ``detach()``)
+
+        This function is idempotent.
+        """
+        if self._owns_struct and self.struct_ptr:
+            _bam_destroy1(self.struct_ptr)
+            self.struct_ptr = None
+            self.struct = None
+
+    def __del__(self):
+        self.free()
 
 
 class BAMFileIter:
@@ -459,9 +806,11 @@ class BAMIndexIter:
     resource leaks.
     """
 
-    def __init__(self, bam_index, itr):
+    def __init__(self, bam_index, itr, multi=False):
         #: the ``BAMIndex`` to iterate through
         self.bam_index = bam_index
+        #: whether or not ``itr`` is a multi-region iterator
+        self.multi = multi
         #: the ``BAMFile`` used
         self.bam_file = self.bam_index.bam_file
         #: buffer for reading in the file itself
@@ -483,7 +832,10 @@ class BAMIndexIter:
         return self
 
     def __next__(self):
-        if self.bam_index.is_bam_or_cram:
+        if self.multi:
+            r = _hts_itr_multi_next(self.bam_file.struct_ptr, self.itr_ptr,
+                                    ctypes.byref(self.struct))
+        elif self.bam_index.is_bam_or_cram:
             r = _sam_itr_next(self.bam_file.struct_ptr,
                               self.itr_ptr,
                               ctypes.byref(self.struct))
@@ -529,6 +881,339 @@ class BAMIndexIter:
             self.itr = None
 
 
+# ``array`` type code for 32 bit signed integers
+_INT32 = _array_typecode('il', 4)
+
+# ``array`` type codes of the fixed-width columns of ``BAMRecordBatch``es,
+# the values are extracted with the field decoders of ``BAMRecordImpl``
+BAM_BATCH_FIXED_FIELDS = collections.OrderedDict([
+    ('r_id', _INT32),
+    ('begin_pos', _INT32),
+    ('end_pos', _INT32),
+    ('mapq', 'B'),
+    ('flag', 'H'),
+    ('tlen', _INT32),
+    ('r_id_next', _INT32),
+    ('pos_next', _INT32),
+])
+
+
+def _batch_qname(ptr):
+    return _bam_get_qname(ptr).value
+
+
+def _batch_seq(ptr):
+    return _decode_seq_bytes(_bam_get_seq_bytes(ptr), ptr[0].core.l_qseq)
+
+
+def _batch_qual(ptr):
+    return _decode_qual_bytes(_bam_get_qual_bytes(ptr))
+
+
+def _batch_cigar(ptr):
+    n_cigar = ptr[0].core.n_cigar
+    if not n_cigar:
+        return b'*'
+    return ''.join('{}{}'.format(_bam_cigar_oplen(c), _bam_cigar_opchr(c))
+                   for c in _bam_get_cigar(ptr)[:n_cigar]).encode('ascii')
+
+
+# functions returning the ``bytes`` value of variable-length columns of
+# ``BAMRecordBatch``es
+BAM_BATCH_VAR_FIELDS = collections.OrderedDict([
+    ('qname', _batch_qname),
+    ('seq', _batch_seq),
+    ('qual', _batch_qual),
+    ('cigar', _batch_cigar),
+])
+
+# SAM types of aux tag columns of ``BAMRecordBatch``es, with functions
+# returning the Arrow type given the ``pyarrow`` module; ``i`` is used for
+# all integer types and ``B`` arrays are given with their element type
+BAM_BATCH_TAG_TYPES = collections.OrderedDict([
+    ('A', lambda pa: pa.string()),
+    ('Z', lambda pa: pa.string()),
+    ('H', lambda pa: pa.string()),
+    ('i', lambda pa: pa.int64()),
+    ('f', lambda pa: pa.float32()),
+    ('Bc', lambda pa: pa.list_(pa.int8())),
+    ('BC', lambda pa: pa.list_(pa.uint8())),
+    ('Bs', lambda pa: pa.list_(pa.int16())),
+    ('BS', lambda pa: pa.list_(pa.uint16())),
+    ('Bi', lambda pa: pa.list_(pa.int32())),
+    ('BI', lambda pa: pa.list_(pa.uint32())),
+    ('Bf', lambda pa: pa.list_(pa.float32())),
+])
+
+
+class BAMBatchVarColumn:
+    """Variable-length column of a ``BAMRecordBatch``
+
+    The values are stored back-to-back in ``data``, value ``i`` is
+    ``data[offsets[i]:offsets[i + 1]]``.  This is the layout of Arrow string
+    arrays, so the column can be converted without copying.
+    """
+
+    def __init__(self):
+        #: ``array.array`` with ``len(self) + 1`` 32 bit offsets into data
+        self.offsets = array.array(_INT32, [0])
+        #: ``bytearray`` with the concatenated values
+        self.data = bytearray()
+
+    def extend(self, values):
+        """Append the ``bytes`` from the iterable ``values``"""
+        offsets = self.offsets
+        data = self.data
+        for value in values:
+            data += value
+            offsets.append(len(data))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class BAMBatchTagColumn(list):
+    """Aux tag column of a ``BAMRecordBatch``
+
+    A ``list`` with the value of the tag for each record, ``None`` where the
+    record does not have the tag.
+    """
+
+    def __init__(self, type_, values=()):
+        list.__init__(self, values)
+        #: SAM type of the tag, key of ``BAM_BATCH_TAG_TYPES``
+        self.type_ = type_
+
+
+class BAMRecordBatch:
+    """Batch of BAM records stored column by column
+
+    Fixed-width fields (see ``BAM_BATCH_FIXED_FIELDS``) are stored as
+    ``array.array``, variable-length fields (see ``BAM_BATCH_VAR_FIELDS``)
+    as ``BAMBatchVarColumn`` and aux tags as ``BAMBatchTagColumn``.
+    """
+
+    def __init__(self, columns):
+        #: ``OrderedDict`` mapping field name to column
+        self.columns = collections.OrderedDict(columns)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def to_numpy(self):
+        """Return ``OrderedDict`` mapping field name to NumPy arrays
+
+        Variable-length columns are returned as ``(offsets, data)`` pairs
+        of arrays.  No data is copied, except for tag columns which become
+        arrays of Python objects.
+        """
+        np = require_numpy(BAMFileException)
+        result = collections.OrderedDict()
+        for name, column in self.columns.items():
+            if isinstance(column, BAMBatchTagColumn):
+                result[name] = np.array(column, dtype=object)
+            elif isinstance(column, BAMBatchVarColumn):
+                result[name] = (np.frombuffer(column.offsets, dtype=np.int32),
+                                np.frombuffer(column.data, dtype=np.uint8))
+            else:
+                result[name] = np.frombuffer(
+                    column, dtype=np.dtype(column.typecode))
+        return result
+
+    def to_arrow(self):
+        """Return ``pyarrow.RecordBatch`` with the columns
+
+        Only the tag columns are copied.
+        """
+        pa = require_pyarrow(BAMFileException)
+        types = {'B': pa.uint8(), 'H': pa.uint16(), _INT32: pa.int32()}
+        arrays = []
+        for column in self.columns.values():
+            if isinstance(column, BAMBatchTagColumn):
+                values = column
+                if column.type_.startswith('B'):
+                    values = [None if x is None else x.tolist()
+                              for x in column]
+                arrays.append(pa.array(
+                    values, type=BAM_BATCH_TAG_TYPES[column.type_](pa)))
+            elif isinstance(column, BAMBatchVarColumn):
+                buffers = [None, pa.py_buffer(column.offsets),
+                           pa.py_buffer(column.data)]
+                arrays.append(pa.Array.from_buffers(
+                    pa.string(), len(column), buffers))
+            else:
+                buffers = [None, pa.py_buffer(column)]
+                arrays.append(pa.Array.from_buffers(
+                    types[column.typecode], len(column), buffers))
+        return pa.RecordBatch.from_arrays(arrays, list(self.columns.keys()))
+
+
+class _BAMBatchBuilder:
+    """Build ``BAMRecordBatch`` objects from ``bam1_t`` pointers
+
+    ``tags`` optionally maps aux tag names to their SAM type from
+    ``BAM_BATCH_TAG_TYPES``, the tags are added as columns after the fields.
+    """
+
+    def __init__(self, fields, tags=None):
+        for name in fields:
+            if (name not in BAM_BATCH_FIXED_FIELDS and
+                    name not in BAM_BATCH_VAR_FIELDS):
+                tpl = 'Invalid field for BAM record batch: {}'
+                raise BAMFileException(tpl.format(name))
+        tags = collections.OrderedDict(tags or [])
+        for name, type_ in tags.items():
+            if type_ not in BAM_BATCH_TAG_TYPES:
+                tpl = 'Invalid type {} for tag {}, must be one of {}'
+                raise BAMFileException(tpl.format(
+                    type_, name, ', '.join(BAM_BATCH_TAG_TYPES)))
+        #: names of the fields to extract
+        self.fields = list(fields)
+        #: ``OrderedDict`` mapping names of the tags to extract to their type
+        self.tags = tags
+        # selector for extracting the tags
+        self._select = TagSelector(list(tags))
+
+    def build(self, ptrs):
+        """Return ``BAMRecordBatch`` for the records in ``ptrs``
+
+        The columns are filled one after the other, each in one pass over
+        ``ptrs``.
+        """
+        columns = collections.OrderedDict()
+        for name in self.fields:
+            if name in BAM_BATCH_FIXED_FIELDS:
+                decode = BAMRecordImpl.decoder(name)
+                column = array.array(BAM_BATCH_FIXED_FIELDS[name])
+                column.extend(decode(ptr, None) for ptr in ptrs)
+            else:
+                column = BAMBatchVarColumn()
+                column.extend(map(BAM_BATCH_VAR_FIELDS[name], ptrs))
+            columns[name] = column
+        if self.tags:
+            values = [self._select._select_from_struct(ptr) for ptr in ptrs]
+            for i, (name, type_) in enumerate(self.tags.items()):
+                columns[name] = BAMBatchTagColumn(
+                    type_, (row[i] for row in values))
+        return BAMRecordBatch(columns)
+
+
+class BAMBatchIter:
+    """Iterate over a ``BAMFile`` in ``BAMRecordBatch``es
+
+    Do not use directly but through ``BAMFile.iter_batches()``.  Iteration
+    must be completed or ``close()`` must be called to prevent resource
+    leaks.
+    """
+
+    def __init__(self, bam_file, batch_size, fields, tags=None):
+        #: the ``BAMFile`` to iterate through
+        self.bam_file = bam_file
+        #: number of records per batch
+        self.batch_size = batch_size
+        # builder for the batches
+        self._builder = _BAMBatchBuilder(fields, tags)
+        #: pool of ``bam1_t`` buffers, reused for each batch
+        self.pool = [_bam_init1() for _ in range(batch_size)]
+        # whether or not the end of file has been reached
+        self._at_end = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._at_end or not self.pool:
+            self.close()
+            raise StopIteration
+        num = 0
+        while num < self.batch_size:
+            r = self._read_into(self.pool[num])
+            if r < 0:
+                self._at_end = True
+                if r < -1:
+                    self.close()
+                    tpl = 'truncated file {}'
+                    raise BAMFileException(tpl.format(self.bam_file.path))
+                break
+            num += 1
+        if not num:
+            self.close()
+            raise StopIteration
+        return self._builder.build(self.pool[:num])
+
+    def _read_into(self, ptr):
+        """Read next record into ``bam1_t`` ``ptr``, return ``sam_read1()``
+        result"""
+        return _sam_read1(self.bam_file.struct_ptr,
+                          self.bam_file.header.struct_ptr, ptr)
+
+    def close(self):
+        for ptr in self.pool:
+            _bam_destroy1(ptr)
+        self.pool = []
+
+
+class BAMIndexBatchIter(BAMBatchIter):
+    """Iterate over query results from a ``BAMIndex`` in ``BAMRecordBatch``es
+
+    Do not use directly but through ``BAMIndex.query_batches()``.
+    Iteration must be completed or ``close()`` must be called to prevent
+    resource leaks.
+    """
+
+    def __init__(self, bam_index, itr, batch_size, fields, tags=None):
+        #: the ``BAMIndex`` to iterate through
+        self.bam_index = bam_index
+        #: pointer to iterator struct to for iteration
+        self.itr_ptr = itr
+        # buffer to use in case of SAM.gz
+        self._buffer = None
+        if not self.bam_index.is_bam_or_cram:
+            self._buffer = _kstring_t(0, 0, None)
+        try:
+            BAMBatchIter.__init__(self, bam_index.bam_file, batch_size,
+                                  fields, tags)
+        except BAMFileException:
+            self.pool = []
+            self.close()
+            raise
+
+    def _read_into(self, ptr):
+        if self.bam_index.is_bam_or_cram:
+            r = _sam_itr_next(self.bam_file.struct_ptr, self.itr_ptr, ptr)
+        else:
+            r = _tbx_itr_next(self.bam_file.struct_ptr,
+                              self.bam_index.struct_ptr, self.itr_ptr,
+                              ctypes.byref(self._buffer))
+            if r >= 0:
+                _sam_parse1(ctypes.byref(self._buffer),
+                            self.bam_file.header.struct_ptr, ptr)
+        return r
+
+    def close(self):
+        BAMBatchIter.close(self)
+        if self._buffer:
+            self._buffer.free_p()
+            self._buffer = None
+        if self.itr_ptr and self.bam_index.is_bam_or_cram:
+            _sam_itr_destroy(self.itr_ptr)
+            self.itr_ptr = None
+        elif self.itr_ptr and not self.bam_index.is_bam_or_cram:
+            _tbx_itr_destroy(self.itr_ptr)
+            self.itr_ptr = None
+
+
 class BAMFile:
     """Wrapper for SAM/BAM/CRAM access
 
@@ -536,9 +1221,11 @@ class BAMFile:
     ``BAMIndex``.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, threads=1):
         #: path to BAM file
         self.path = path
+        #: number of (de-)compression threads or ``HTSThreadPool``
+        self.threads = threads
         #: wrapped C struct
         self.struct = None
         #: pointer to C struct
@@ -556,7 +1243,11 @@ class BAMFile:
             return  # already open
         # open file and store handles
         self.struct_ptr = _hts_open(self.path.encode('utf-8'), 'r')
+        if not self.struct_ptr:
+            tpl = 'Could not open BAM file {}'
+            raise BAMFileException(tpl.format(self.path))
         self.struct = self.struct_ptr[0]
+        set_threads(self.struct_ptr, self.threads)
         # read header
         self.header = BAMHeader._read_from_file(self.struct_ptr)
 
@@ -578,6 +1269,19 @@ class BAMFile:
         self.iterators.append(BAMFileIter(self))
         return self.iterators[-1]
 
+    def iter_batches(self, batch_size=65536, fields=None, tags=None):
+        """Iterate over the file in ``BAMRecordBatch``es
+
+        ``fields`` is a list of names from ``BAM_BATCH_FIXED_FIELDS`` and
+        ``BAM_BATCH_VAR_FIELDS``, defaulting to all fixed-width fields.
+        ``tags`` optionally maps aux tag names to their type from
+        ``BAM_BATCH_TAG_TYPES`` for adding tag columns, e.g.
+        ``{'NM': 'i', 'CB': 'Z'}``.
+        """
+        fields = fields or list(BAM_BATCH_FIXED_FIELDS.keys())
+        self.iterators.append(BAMBatchIter(self, batch_size, fields, tags))
+        return self.iterators[-1]
+
     def __enter__(self):
         self.open()
         return self
@@ -590,12 +1294,54 @@ class BAMIndex:
     """Random-access access to BAM file"""
 
     @staticmethod
-    def build(path, bai_path=None):
-        assert False, 'Implement me!'
+    def build(path, bai_path=None, min_shift=None, threads=1):
+        """Build index for the BAM, CRAM or bgzip-compressed SAM file
+
+        The index is written to ``bai_path``, by default next to ``path``.
+        ``min_shift`` is ``0`` for a BAI index (TBI for SAM) or the size of
+        the smallest bins, as power of two, of a CSI index.  By default, a
+        CSI index with ``min_shift=14`` is built if ``bai_path`` ends with
+        ``.csi``.  CRAM files always get a CRAI index.  ``threads`` is only
+        used with htslib >= 1.4.  Returns the path to the index.
+        """
+        if min_shift is None:
+            min_shift = 14 if bai_path and bai_path.endswith('.csi') else 0
+        bai_path = bai_path or path + BAMIndex._get_index_ext(path, min_shift)
+        if path.endswith('.sam.gz'):
+            conf = _tbx_conf_t.in_dll(htslib, 'tbx_conf_sam')
+            res = _tbx_index_build2(path.encode('utf-8'),
+                                    bai_path.encode('utf-8'), min_shift,
+                                    ctypes.byref(conf))
+        elif _sam_index_build3:
+            res = _sam_index_build3(path.encode('utf-8'),
+                                    bai_path.encode('utf-8'), min_shift,
+                                    threads)
+        else:
+            res = _sam_index_build2(path.encode('utf-8'),
+                                    bai_path.encode('utf-8'), min_shift)
+        if res != 0:
+            tpl = 'Could not build index {} for {}'
+            raise BAMIndexException(tpl.format(bai_path, path))
+        return bai_path
 
     @staticmethod
-    def _get_index_ext(path):
-        if path.endswith('.sam.gz'):
+    def build_many(paths, min_shift=None, threads=1, processes=None):
+        """Build indices for many files in a process pool
+
+        Calls ``build()`` for each of the ``paths`` with the default index
+        path.  With ``processes=1``, everything runs in the current process.
+        Returns the list of index paths.
+        """
+        return build_many(BAMIndex.build, paths, processes,
+                          min_shift=min_shift, threads=threads)
+
+    @staticmethod
+    def _get_index_ext(path, min_shift=None):
+        if path.endswith('.cram'):
+            return '.crai'
+        elif min_shift:
+            return '.csi'
+        elif path.endswith('.sam.gz'):
             return '.tbi'
         elif path.endswith('.bam'):
             return '.bai'
@@ -604,7 +1350,8 @@ class BAMIndex:
             raise BAMIndexException(tpl.format(path))
 
     def __init__(self, path, bai_path=None, require_index=True,
-                 auto_load=True, auto_build=False):
+                 auto_load=True, auto_build=False, threads=1,
+                 cache_size=None):
         #: path to BAM file
         self.path = path
         #: path to BAI (BAM index) file
@@ -619,8 +1366,12 @@ class BAMIndex:
         self.is_bam_or_cram = not self.path.endswith('.sam.gz')
 
         #: the ``BAMFile`` to use for reading
-        self.bam_file = BAMFile(self.path)
+        self.bam_file = BAMFile(self.path, threads)
         self.bam_file.open()
+        #: ``BGZFBlockCache`` if ``cache_size`` is given, else ``None``
+        self.cache = None
+        if cache_size:
+            self.cache = BGZFBlockCache(self.bam_file.struct_ptr, cache_size)
 
         # collection of iterators, we will call close() on all of them
         # in our own close to ensure that all memory is freed
@@ -671,6 +1422,10 @@ class BAMIndex:
 
     # TODO(holtgrewe): fix exception display if not region_string
     def query(self, region_str=None, seq=None, begin=None, end=None):
+        return BAMIndexIter(self, self._query_itr(region_str, seq, begin, end))
+
+    def _query_itr(self, region_str=None, seq=None, begin=None, end=None):
+        """Return pointer to htslib iterator for the query"""
         if (region_str is None and
                 (seq is None or begin is None or end is None)):
             raise BAMIndexException(
@@ -691,7 +1446,84 @@ class BAMIndex:
         if not ptr:
             tpl = 'Could not jump to {}'
             raise BAMIndexException(tpl.format(region_str))
-        return BAMIndexIter(self, ptr)
+        return ptr
+
+    def query_batches(self, region_str, batch_size=65536, fields=None,
+                      tags=None):
+        """Query ``region_str``, iterate over results in ``BAMRecordBatch``es
+
+        ``batch_size``, ``fields`` and ``tags`` are as for
+        ``BAMFile.iter_batches()``.
+        """
+        fields = fields or list(BAM_BATCH_FIXED_FIELDS.keys())
+        self.iterators.append(BAMIndexBatchIter(
+            self, self._query_itr(region_str), batch_size, fields, tags))
+        return self.iterators[-1]
+
+    def query_many(self, regions, max_gap=QUERY_MANY_MAX_GAP):
+        """Query many regions at once, yields ``(record, matched)`` pairs
+
+        ``regions`` are ``GenomeInterval`` objects or region strings.  They
+        are sorted and overlapping or adjacent ones are merged.  For BAM
+        and CRAM files, htslib >= 1.7 reads them with one multi-region
+        iterator, so each block of the file is read once.  Otherwise,
+        regions less than ``max_gap`` base pairs apart are read with one
+        query.  Each record is yielded once, together with the list of
+        given regions it overlaps.  The yielded records are only valid
+        until the next iteration step, use ``detach()`` for keeping them.
+        """
+        return query_many(self, regions, max_gap)
+
+    def _query_multi(self, intervals):
+        """Return multi-region ``BAMIndexIter`` for the sorted, disjoint
+        ``GenomeInterval``s or ``None`` if not supported
+        """
+        if (not self.is_bam_or_cram or not _sam_itr_regarray or
+                not _hts_itr_multi_next):
+            return None
+        regs = (ctypes.c_char_p * len(intervals))(
+            *[str(interval).encode('utf-8') for interval in intervals])
+        ptr = _sam_itr_regarray(self.struct_ptr,
+                                self.bam_file.header.struct_ptr,
+                                regs, len(intervals))
+        if not ptr:
+            raise BAMIndexException('Could not jump to regions')
+        self.iterators.append(BAMIndexIter(self, ptr, multi=True))
+        return self.iterators[-1]
+
+    @staticmethod
+    def _record_seq(record):
+        return record.ref
+
+    def parallel_map(self, fn, regions=None, chunk_bp=10000000,
+                     processes=None, reduce=None):
+        """Call ``fn(shard, records)`` for genome shards in a process pool
+
+        The genome (or the given ``regions``) is split into shards of
+        ``chunk_bp`` that are queried by per-process BAMIndex handles.
+        Records are attributed to the shard containing their begin
+        position, so each record is passed to ``fn`` exactly once.  Returns
+        the list of results in genome order, folded with ``reduce`` if
+        given.
+        """
+        return parallel_map(self, fn, regions, chunk_bp, processes, reduce)
+
+    def _targets(self):
+        """Return list of ``(name, length)`` pairs for sharding"""
+        return [(info.name, info.length)
+                for info in self.bam_file.header.target_infos]
+
+    def _index_path(self):
+        return self.bai_path
+
+    def _worker_kwargs(self):
+        """Return arguments for opening this index in worker processes"""
+        return {'threads': self.bam_file.threads,
+                'cache_size': self.cache.cache_size if self.cache else None}
+
+    @staticmethod
+    def _record_span(record):
+        return record.begin_pos, record.end_pos
 
     def load(self):
         self.close(close_file=False)
@@ -740,3 +1572,264 @@ class BAMIndex:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close(close_file=True)
+
+
+# SAM types of the element types of ``array.array`` values of ``B`` tags
+_AUX_ARRAY_SUBTYPES = dict(
+    (typecode, sub_type)
+    for sub_type, typecode in _AUX_ARRAY_TYPECODES.items())
+
+
+def _aux_int_type(values):
+    """Return aux type code ``i`` or ``I`` covering the integers ``values``
+
+    Raises ``BAMFileException`` if there is no such type.
+    """
+    low, high = min(values, default=0), max(values, default=0)
+    if low < -2 ** 31 or high > 2 ** 32 - 1 or (low < 0 and high >= 2 ** 31):
+        tpl = 'Integer tag values {}..{} do not fit int32 or uint32'
+        raise BAMFileException(tpl.format(low, high))
+    return 'I' if high >= 2 ** 31 else 'i'
+
+
+def _aux_type(value):
+    """Return aux type code for tag ``value`` from its Python type"""
+    if isinstance(value, numbers.Integral):  # also ``bool``
+        return _aux_int_type([int(value)])
+    elif isinstance(value, float):
+        return 'f'
+    elif isinstance(value, str):
+        return 'Z'
+    elif isinstance(value, array.array):
+        return 'B' + _AUX_ARRAY_SUBTYPES[value.typecode]
+    elif all(isinstance(x, numbers.Integral) for x in value):
+        # other sequences, e.g. NumPy arrays
+        return 'B' + _aux_int_type([int(x) for x in value])
+    else:
+        return 'Bf'
+
+
+def _sam_tag(name, value, type_=None):
+    """Return SAM representation of tag ``name`` with ``value``
+
+    ``type_`` is the aux type code as returned by
+    ``BAMAuxTagParser.get_types()``, by default derived from ``value``.  The
+    integer types are written as ``i`` and ``d`` as ``f``, as SAM has no
+    other numeric types, htslib picks the BAM type from the range of the
+    value.  Raises ``BAMFileException`` for integers that fit neither
+    ``int32`` nor ``uint32``.
+    """
+    type_ = type_ or _aux_type(value)
+    if type_[0] == 'B':
+        return '{}:B:{}{}'.format(
+            name, type_[1], ''.join(',' + str(x) for x in value))
+    elif type_ in _AUX_STRUCTS:
+        if type_ in ('f', 'd'):
+            return '{}:f:{}'.format(name, float(value))
+        _aux_int_type([int(value)])  # check the range
+        return '{}:i:{}'.format(name, int(value))
+    else:  # 'A', 'Z', 'H'
+        return '{}:{}:{}'.format(name, type_, value)
+
+
+def _sam_line(record):
+    """Return SAM line, without line ending, for detached ``BAMRecord``"""
+    def pos_str(pos):
+        return str(pos + 1)
+
+    cigar = ''.join(map(str, record.cigar)) or '*'
+    fields = [record.qname, str(record.flag), record.ref or '*',
+              pos_str(record.begin_pos), str(record.mapq), cigar,
+              record.ref_next or '*', pos_str(record.pos_next),
+              str(record.tlen), record.seq or '*', record.qual or '*']
+    types = record.tag_types or {}
+    fields += [_sam_tag(name, value, types.get(name))
+               for name, value in record.tags.items()]
+    return '\t'.join(fields)
+
+
+class BAMWriter:
+    """Write SAM/BAM/CRAM files
+
+    The format is chosen from the extension of ``path`` (``.sam``,
+    ``.sam.gz``, ``.bam`` or ``.cram``) unless ``mode`` is given.
+    ``level`` is the compression level from ``0`` to ``9``, ``threads`` the
+    number of compression threads or a ``HTSThreadPool``.  ``header`` is a
+    ``BAMHeader``, e.g. the one of a ``BAMFile`` that is read.
+
+    Records read from files are written as they are, without decoding them
+    in Python.  Use as a context manager or call ``open()`` and ``close()``.
+    """
+
+    #: file extensions and the ``hts_open()`` modes for writing them
+    MODES = collections.OrderedDict([
+        ('.sam.gz', 'wz'),
+        ('.sam', 'w'),
+        ('.bam', 'wb'),
+        ('.cram', 'wc'),
+    ])
+
+    @staticmethod
+    def _get_mode(path):
+        for ext, mode in BAMWriter.MODES.items():
+            if path.endswith(ext):
+                return mode
+        tpl = 'Not a valid alignment file extension: {}'
+        raise BAMFileException(tpl.format(path))
+
+    def __init__(self, path, header, threads=1, level=None, mode=None):
+        #: path to the file to write
+        self.path = path
+        #: ``BAMHeader`` to write
+        self.header = header
+        #: number of compression threads or ``HTSThreadPool``
+        self.threads = threads
+        #: compression level, ``None`` for the default
+        self.level = level
+        #: mode for ``hts_open()``
+        self.mode = mode or BAMWriter._get_mode(path)
+        if level is not None:
+            self.mode += str(level)
+        #: wrapped C struct
+        self.struct = None
+        #: pointer to C struct
+        self.struct_ptr = None
+        # pointer to the ``bam_hdr_t`` used for writing and whether it has
+        # been created by us from a header without one
+        self._hdr_ptr = None
+        self._own_hdr = False
+        # buffer for encoding records without a ``bam1_t``
+        self._buffer = None
+
+    def open(self):
+        """Open file and write header"""
+        if self.struct_ptr:
+            return  # already open
+        self.struct_ptr = _hts_open(self.path.encode('utf-8'),
+                                    self.mode.encode('ascii'))
+        if not self.struct_ptr:
+            tpl = 'Could not open file {} for writing'
+            raise BAMFileException(tpl.format(self.path))
+        self.struct = self.struct_ptr[0]
+        try:
+            set_threads(self.struct_ptr, self.threads)
+            self._hdr_ptr = self.header.struct_ptr
+            if not self._hdr_ptr:
+                self._hdr_ptr = self.header._to_struct()
+                self._own_hdr = True
+            if _sam_hdr_write(self.struct_ptr, self._hdr_ptr) < 0:
+                tpl = 'Could not write header to {}'
+                raise BAMFileException(tpl.format(self.path))
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, record):
+        """Write ``BAMRecord`` ``record``
+
+        Records that are not detached are passed to htslib as they are,
+        detached ones are encoded from their fields.
+        """
+        ptr = record.struct_ptr
+        if not ptr:
+            ptr = self._encode(record)
+        if _sam_write1(self.struct_ptr, self._hdr_ptr, ptr) < 0:
+            tpl = 'Could not write record {} to {}'
+            raise BAMFileException(tpl.format(record.qname, self.path))
+
+    def write_many(self, records):
+        """Write all ``BAMRecord``s from the iterable ``records``
+
+        Returns the number of records written.
+        """
+        num = 0
+        for record in records:
+            self.write(record)
+            num += 1
+        return num
+
+    def _encode(self, record):
+        """Return pointer to ``bam1_t`` with detached ``record``"""
+        if not self._buffer:
+            self._buffer = _bam_init1()
+        line = ctypes.create_string_buffer(_sam_line(record).encode('utf-8'))
+        kstr = _kstring_t(len(line.value), len(line), ctypes.addressof(line))
+        if _sam_parse1(ctypes.byref(kstr), self._hdr_ptr, self._buffer) < 0:
+            tpl = 'Could not encode record {}'
+            raise BAMFileException(tpl.format(record.qname))
+        return self._buffer
+
+    def close(self):
+        """Close file, flushing all data
+
+        This function is idempotent.
+        """
+        if self.struct_ptr:
+            res = _hts_close(self.struct_ptr)
+            self.struct_ptr = None
+            self.struct = None
+            if res != 0:
+                tpl = 'Problem closing file {}'
+                raise BAMFileException(tpl.format(self.path))
+        if self._buffer:
+            _bam_destroy1(self._buffer)
+            self._buffer = None
+        if self._own_hdr:
+            _bam_hdr_destroy(self._hdr_ptr)
+            self._own_hdr = False
+        self._hdr_ptr = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def to_arrow(path, fields=None, region=None, batch_size=65536, tags=None):
+    """Yield ``pyarrow.RecordBatch``es with the records of a SAM/BAM file
+
+    ``fields`` is a list of names from ``BAM_BATCH_FIXED_FIELDS`` and
+    ``BAM_BATCH_VAR_FIELDS``, defaulting to all of them.  ``tags`` maps aux
+    tag names to their type from ``BAM_BATCH_TAG_TYPES`` for adding typed
+    tag columns.  If ``region`` is given, only the records overlapping it
+    are read through the index.
+    """
+    require_pyarrow(BAMFileException)
+    fields = fields or (list(BAM_BATCH_FIXED_FIELDS.keys()) +
+                        list(BAM_BATCH_VAR_FIELDS.keys()))
+    if region is None:
+        with BAMFile(path) as bam_file:
+            for batch in bam_file.iter_batches(batch_size, fields, tags):
+                yield batch.to_arrow()
+    else:
+        with BAMIndex(path) as bam_index:
+            for batch in bam_index.query_batches(
+                    region, batch_size, fields, tags):
+                yield batch.to_arrow()
+
+
+def write_parquet(path, parquet_path, fields=None, region=None,
+                  batch_size=65536, tags=None, **kwargs):
+    """Write the records of a SAM/BAM file to a Parquet file
+
+    The arguments are as for ``to_arrow()``, further keyword arguments are
+    passed to ``pyarrow.parquet.ParquetWriter``, e.g. ``compression``.
+    Returns the number of records written.
+    """
+    pa = require_pyarrow(BAMFileException)
+    import pyarrow.parquet
+    fields = fields or (list(BAM_BATCH_FIXED_FIELDS.keys()) +
+                        list(BAM_BATCH_VAR_FIELDS.keys()))
+    # the schema is taken from an empty batch, for writing empty files
+    schema = _BAMBatchBuilder(fields, tags).build([]).to_arrow().schema
+    num = 0
+    writer = pyarrow.parquet.ParquetWriter(parquet_path, schema, **kwargs)
+    try:
+        for batch in to_arrow(path, fields, region, batch_size, tags):
+            writer.write_table(pa.Table.from_batches([batch]))
+            num += len(batch)
+    finally:
+        writer.close()
+    return num
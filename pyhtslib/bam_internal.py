@@ -30,6 +30,9 @@ __all__ = [
     '_BAM_CIGAR_TYPE',
 
     '_BAM_SEQ_STR',
+    '_BAM_SEQ_HI_TABLE',
+    '_BAM_SEQ_LO_TABLE',
+    '_BAM_QUAL_TABLE',
 
     '_BAM_FPAIRED',
     '_BAM_FPROPER_PAIR',
@@ -60,6 +63,8 @@ __all__ = [
     '_bam_get_aux',
     '_bam_get_l_aux',
     '_bam_seqi',
+    '_bam_get_seq_bytes',
+    '_bam_get_qual_bytes',
     '_bam_itr_destroy',
     '_bam_itr_queryi',
     '_bam_itr_querys',
@@ -98,6 +103,8 @@ __all__ = [
     '_sam_index_load2',
     '_sam_index_build',
     '_sam_index_build2',
+    '_sam_index_build3',
+    '_sam_itr_regarray',
     '_sam_itr_queryi',
     '_sam_itr_querys',
     '_sam_hdr_parse',
@@ -140,6 +147,16 @@ _BAM_CIGAR_TYPE = 0x3C1A7
 
 _BAM_SEQ_STR = '=ACMGRSVTWYHKDBN'
 
+# 256-entry lookup tables for decoding a packed byte (a pair of 4-bit encoded
+# bases) at once, meant for ``bytes.translate``: byte ``b`` decodes to the
+# characters ``_BAM_SEQ_HI_TABLE[b]`` followed by ``_BAM_SEQ_LO_TABLE[b]``
+_BAM_SEQ_HI_TABLE = bytes(ord(_BAM_SEQ_STR[i >> 4]) for i in range(256))
+_BAM_SEQ_LO_TABLE = bytes(ord(_BAM_SEQ_STR[i & 0xf]) for i in range(256))
+
+# lookup table translating Phred qualities to Phred+33 ASCII characters,
+# values that cannot be printed are capped at ``'~'``
+_BAM_QUAL_TABLE = bytes(min(q, 93) + 33 for q in range(256))
+
 
 def _bam_cigar_op(c):
     return c & _BAM_CIGAR_MASK
@@ -238,6 +255,23 @@ def _bam_seqi(s, i):
     return (s[i >> 1] >> (((~i) & 1) << 2)) & 0xf
 
 
+def _bam_get_seq_bytes(b):
+    """Return the packed 4-bit sequence of ``b`` as ``bytes``"""
+    core = b[0].core
+    offset = core.l_qname + (core.n_cigar << 2)
+    address = ctypes.addressof(b[0].data.contents) + offset
+    return ctypes.string_at(address, (core.l_qseq + 1) >> 1)
+
+
+def _bam_get_qual_bytes(b):
+    """Return the Phred qualities of ``b`` as ``bytes``"""
+    core = b[0].core
+    offset = (core.l_qname + (core.n_cigar << 2) +
+              ((core.l_qseq + 1) >> 1))
+    address = ctypes.addressof(b[0].data.contents) + offset
+    return ctypes.string_at(address, core.l_qseq)
+
+
 def _bam_itr_destroy(it):
     return _hts_itr_destroy(it)
 
@@ -386,6 +420,14 @@ _sam_index_build.restype = ctypes.c_int
 _sam_index_build2 = htslib.sam_index_build2
 _sam_index_build2.restype = ctypes.c_int
 
+# with the number of threads, only available in htslib >= 1.4
+_sam_index_build3 = _optional_function('sam_index_build3', ctypes.c_int)
+
+# multi-region iterator from region strings, only available in
+# htslib >= 1.7
+_sam_itr_regarray = _optional_function('sam_itr_regarray',
+                                       ctypes.POINTER(_hts_itr_t))
+
 _sam_itr_queryi = htslib.sam_itr_queryi
 _sam_itr_queryi.restype = ctypes.POINTER(_hts_itr_t)
 
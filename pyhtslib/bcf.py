@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 """Access to BCF and BCF files"""
 
+import array
 import collections
+import collections.abc
 import ctypes
+import logging
+import math
 import os
 import sys  # NOQA  # TODO(holtgrew): remove?
 
+from pyhtslib.hts import (
+    QUERY_MANY_MAX_GAP, BGZFBlockCache, build_many, parallel_map,
+    query_many, require_numpy, require_pyarrow, set_threads)
 from pyhtslib.hts_internal import *  # NOQA
 from pyhtslib.bcf_internal import *  # NOQA
 from pyhtslib.tabix_internal import *  # NOQA
@@ -36,6 +43,37 @@ class BCFInfoFieldException(Exception):
         Exception.__init__(self, tpl.format(type_, key, msg))
 
 
+#: ``bcf_unpack()`` levels for the ``unpack`` argument of ``BCFFile``: the
+#: site (up to ALT), all shared fields (up to INFO) or everything
+BCF_UNPACK_LEVELS = collections.OrderedDict([
+    ('site', _BCF_UN_STR),
+    ('shared', _BCF_UN_SHR),
+    ('all', _BCF_UN_ALL),
+])
+
+#: allele index used in ``gt_array()`` for missing alleles (``.``)
+GT_MISSING = -1
+#: allele index used in ``gt_array()`` for padding samples of lower ploidy
+GT_VECTOR_END = -2
+
+
+def stack_gt_arrays(gt_arrays):
+    """Stack ``(alleles, phased)`` pairs from ``BCFRecord.gt_array()``
+
+    Returns a pair of a (variants x samples x ploidy) allele array and a
+    (variants x samples) phased mask.  Records of lower ploidy are padded
+    with ``GT_VECTOR_END``.
+    """
+    np = require_numpy(BCFFileException)
+    ploidy = max(alleles.shape[1] for alleles, _ in gt_arrays)
+    dtype = np.result_type(*[alleles for alleles, _ in gt_arrays])
+    result = np.full((len(gt_arrays), gt_arrays[0][0].shape[0], ploidy),
+                     GT_VECTOR_END, dtype=dtype)
+    for i, (alleles, _) in enumerate(gt_arrays):
+        result[i, :, :alleles.shape[1]] = alleles
+    return result, np.stack([phased for _, phased in gt_arrays])
+
+
 class BCFHeaderTargetInfo:
     """Information (name, length) for the reference/target sequence"""
 
@@ -217,11 +255,25 @@ class BCFHeader:
     """
 
     @staticmethod
-    def _read_from_file(file_ptr):
-        """Read header from BCF file handle"""
+    def _read_from_file(file_ptr, samples=None):
+        """Read header from BCF file handle
+
+        If ``samples`` is given, htslib is configured to only read the
+        FORMAT values for these samples.
+        """
         ptr = _bcf_hdr_read(file_ptr)
         if not ptr:
             raise BCFFileException('Could not load BCF header from file!')
+        if samples is not None:
+            # "-" selects no samples at all
+            samples_str = ','.join(samples) if samples else '-'
+            res = _bcf_hdr_set_samples(ptr, samples_str.encode('utf-8'), 0)
+            if res != 0:
+                _bcf_hdr_destroy(ptr)
+                if res > 0:
+                    tpl = 'Sample {} not found in the VCF/BCF file'
+                    raise BCFFileException(tpl.format(samples[res - 1]))
+                raise BCFFileException('Could not select samples')
         return BCFHeader(ptr)
 
     def __init__(self, struct_ptr=None):
@@ -255,6 +307,11 @@ class BCFHeader:
         self.id_to_format_record = {}
         #: dict mapping string ID keys to CONTIG BCFHeaderRecord objects
         self.id_to_contig_record = {}
+        # ``_BCFFieldMeta`` objects, by header line type and numeric key id
+        self._field_metas = {}
+        # accessors created through this header, their buffers are freed
+        # in ``free()``
+        self._accessors = []
 
         self._fill_from_struct()
 
@@ -279,6 +336,9 @@ class BCFHeader:
 
     def free(self):
         """Free all memory associated with this object"""
+        for accessor in self._accessors:
+            accessor.free()
+        self._accessors = []
         if self.struct_ptr:
             _bcf_hdr_destroy(self.struct_ptr)
             self.struct_ptr = None
@@ -294,6 +354,23 @@ class BCFHeader:
             lines.append(r)
         return '\n'.join([l.to_header_line() for l in lines] + [''])
 
+    def _to_struct(self):
+        """Return pointer to new ``bcf_hdr_t`` built from the header text
+
+        The caller is responsible for freeing it with ``bcf_hdr_destroy()``.
+        """
+        columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                   'INFO']
+        if self.sample_names:
+            columns += ['FORMAT'] + self.sample_names
+        text = self.to_vcf_header() + '\t'.join(columns) + '\n'
+        ptr = _bcf_hdr_init(b'w')
+        if not ptr or _bcf_hdr_parse(ptr, text.encode('utf-8')) != 0:
+            if ptr:
+                _bcf_hdr_destroy(ptr)
+            raise BCFFileException('Could not build BCF header')
+        return ptr
+
     def _fill_from_struct(self):
         """Fill object with the information from ``self.struct_ptr``, if any
         """
@@ -341,101 +418,206 @@ class BCFHeader:
             rec = self.struct.hrec[i][0]  # bcf_hrec_t
             self.add_header_record(DIR[rec.type]._from_struct(rec))
 
+    def _field_meta(self, hl_type, key_id):
+        """Return ``_BCFFieldMeta`` for INFO or FORMAT key with ``key_id``
+
+        ``hl_type`` is ``_BCF_HL_INFO`` or ``_BCF_HL_FMT``.  The result is
+        computed on first use and cached for all further records.
+        """
+        try:
+            return self._field_metas[(hl_type, key_id)]
+        except KeyError:
+            meta = _BCFFieldMeta(self, hl_type, key_id)
+            self._field_metas[(hl_type, key_id)] = meta
+            return meta
+
+    def _defined_key_meta(self, hl_type, key):
+        """Return ``_BCFFieldMeta`` for ``key``, raise if not in header"""
+        kind, records = {
+            _BCF_HL_INFO: ('INFO', self.id_to_info_record),
+            _BCF_HL_FMT: ('FORMAT', self.id_to_format_record),
+        }[hl_type]
+        if not self.struct_ptr or key not in records:
+            tpl = '{} field {} is not defined in the header'
+            raise BCFFileException(tpl.format(kind, key))
+        return self._field_meta(hl_type, self.ids.index(key))
+
+    def info_accessor(self, key):
+        """Return ``BCFInfoAccessor`` for the INFO field ``key``
+
+        Use this for extracting the same INFO field from many records.
+        """
+        accessor = BCFInfoAccessor(
+            self, self._defined_key_meta(_BCF_HL_INFO, key))
+        self._accessors.append(accessor)
+        return accessor
+
+    def format_accessor(self, key):
+        """Return ``BCFFormatAccessor`` for the FORMAT field ``key``
+
+        Use this for extracting the same FORMAT field from many records.
+        """
+        accessor = BCFFormatAccessor(
+            self, self._defined_key_meta(_BCF_HL_FMT, key))
+        self._accessors.append(accessor)
+        return accessor
+
+
+class _BCFFieldMeta:
+    """Header information on an INFO or FORMAT key, used for decoding"""
+
+    def __init__(self, header, hl_type, key_id):
+        #: header line type, ``_BCF_HL_INFO`` or ``_BCF_HL_FMT``
+        self.hl_type = hl_type
+        #: numeric id of the key
+        self.key_id = key_id
+        #: the key as ``str``
+        self.key = header.ids[key_id]
+        #: the key as ``bytes``, for passing to htslib
+        self.enc_key = self.key.encode('utf-8')
+        #: value type from the header, one of ``_BCF_HT_*``
+        self.type_ = _bcf_hdr_id2type(header.struct_ptr, hl_type, key_id)
+        #: kind of value count (cmp. Number), one of ``_BCF_VL_*``
+        self.length = _bcf_hdr_id2length(header.struct_ptr, hl_type, key_id)
+        #: number of values if ``self.length`` is ``_BCF_VL_FIXED``
+        self.number = _bcf_hdr_id2number(header.struct_ptr, hl_type, key_id)
+        # ignore any values if the header says that there are none; otherwise
+        # we can get problems with things like "SNP=true"
+        #: whether or not the key is a flag
+        self.is_flag = (self.type_ == _BCF_HT_FLAG or
+                        (self.length == _BCF_VL_FIXED and self.number == 0))
+        #: whether or not the key has exactly one value
+        self.is_scalar = (self.length == _BCF_VL_FIXED and self.number == 1)
+
 
 class _BCFTypedInfoFieldConverter:
-    # TODO(holtgrew): interpret as scalar if count is 1
+    """Decode the value of an INFO key from a ``bcf1_t`` struct
+
+    The values are extracted into the buffers of the ``_BCFBufferArena``
+    ``buffers``.
+    """
 
-    def __init__(self, header, info, struct, key):
+    def __init__(self, header, meta, struct, buffers):
         self.header = header
-        self.info = info
+        self.meta = meta
         self.struct = struct
-        self.key = key
+        self.buffers = buffers
 
     def __call__(self):
-        # ignore any values if the header says that there are none; otherwise
-        # we can get problems with things like "SNP=true"
-        num = _bcf_hdr_id2int(self.header.struct_ptr, _BCF_DT_ID,
-                              self.key.encode('utf-8'))
-        length = _bcf_hdr_id2length(self.header.struct_ptr, _BCF_HL_INFO, num)
-        number = _bcf_hdr_id2number(self.header.struct_ptr, _BCF_HL_INFO, num)
-        type_ = _bcf_hdr_id2type(self.header.struct_ptr, _BCF_HL_INFO, num)
-        if length == _BCF_VL_FIXED and number == 0:
+        meta = self.meta
+        if meta.is_flag:
             return self.convert_flag()
 
         # branch based on the type of the info field
         BRANCH = {
-            _BCF_BT_NULL: self.convert_flag,
-            _BCF_BT_INT8: self.convert_int,
-            _BCF_BT_INT16: self.convert_int,
-            _BCF_BT_INT32: self.convert_int,
-            _BCF_BT_FLOAT: self.convert_float,
-            _BCF_BT_CHAR: self.convert_char,
+            _BCF_HT_INT: self.convert_int,
+            _BCF_HT_REAL: self.convert_float,
+            _BCF_HT_STR: self.convert_char,
         }
-        result = BRANCH[self.info.type]()
+        result = BRANCH[meta.type_]()
 
         # extract single value in case of scalars and split strings at comma
         # in case of vectors
-        is_scalar = (length == _BCF_VL_FIXED and number == 1)
-        if type_ == _BCF_HT_STR:
-            return result if is_scalar else result.split(',')
-        elif is_scalar:
+        if meta.type_ == _BCF_HT_STR:
+            return result if meta.is_scalar else result.split(',')
+        elif meta.is_scalar:
             assert len(result) == 1, 'len(result) == {}'.format(len(result))
             return result[0]
         else:
             return result
 
-    def convert_flag(self):
-        ndst = ctypes.c_int(0)
-        dst = ctypes.c_char_p()
-        res = _bcf_get_info_flag(
+    def _get(self, getter, buf):
+        """Call ``getter`` with ``buf``, return number of values"""
+        return getter(
             self.header.struct_ptr, ctypes.byref(self.struct),
-            self.key.encode('utf-8'), ctypes.byref(dst), ctypes.byref(ndst))
-        _libc.free(dst)
+            self.meta.enc_key, ctypes.byref(buf.ptr), ctypes.byref(buf.size))
+
+    def convert_flag(self):
+        res = self._get(_bcf_get_info_flag, self.buffers.char)
         return (res == 1)
 
     def convert_int(self):
-        ndst = ctypes.c_int(0)
-        dst = ctypes.POINTER(ctypes.c_int32)()
-        res = _bcf_get_info_int32(
-            self.header.struct_ptr, ctypes.byref(self.struct),
-            self.key.encode('utf-8'), ctypes.byref(dst), ctypes.byref(ndst))
+        buf = self.buffers.int32
+        res = self._get(_bcf_get_info_int32, buf)
         if res < 0:
-            _libc.free(dst)
-            raise BCFInfoFieldException(res, self.key, 'int32')
-        result = [dst[i] for i in range(ndst.value)]
-        _libc.free(dst)
-        return result
+            raise BCFInfoFieldException(res, self.meta.key, 'int32')
+        return buf.ptr[:res]
 
     def convert_float(self):
-        ndst = ctypes.c_int(0)
-        dst = ctypes.POINTER(ctypes.c_float)()
-        res = _bcf_get_info_float(
-            self.header.struct_ptr, ctypes.byref(self.struct),
-            self.key.encode('utf-8'), ctypes.byref(dst), ctypes.byref(ndst))
+        buf = self.buffers.float
+        res = self._get(_bcf_get_info_float, buf)
         if res < 0:
-            _libc.free(dst)
-            raise BCFInfoFieldException(res, self.key, 'float')
-        result = [dst[i] for i in range(ndst.value)]
-        _libc.free(dst)
-        return result
+            raise BCFInfoFieldException(res, self.meta.key, 'float')
+        return buf.ptr[:res]
 
     def convert_char(self):
-        ndst = ctypes.c_int(0)
-        dst = ctypes.c_char_p()
-        res = _bcf_get_info_string(
-            self.header.struct_ptr, ctypes.byref(self.struct),
-            self.key.encode('utf-8'), ctypes.byref(dst), ctypes.byref(ndst))
+        buf = self.buffers.char
+        res = self._get(_bcf_get_info_string, buf)
         if res < 0:
-            _libc.free(dst)
-            raise BCFInfoFieldException(res, self.key, 'string')
-        result = dst.value.decode('utf-8')
-        _libc.free(dst)
-        return result
+            raise BCFInfoFieldException(res, self.meta.key, 'string')
+        return buf.snapshot(res).rstrip(b'\0').decode('utf-8')
+
+
+class BCFInfo(collections.abc.Mapping):
+    """Read-only mapping of the INFO column of a ``BCFRecord``
+
+    The keys are taken from the record on construction but each value is
+    only decoded on first access.  Like the ``BCFRecord`` it belongs to, the
+    mapping is only valid for the current iteration.
+    """
+
+    def __init__(self, struct, header, buffers):
+        #: wrapped ``bcf1_t`` C struct, unpacked at least to INFO
+        self.struct = struct
+        #: ``BCFHeader`` with the INFO definitions
+        self.header = header
+        #: ``_BCFBufferArena`` to extract the values with
+        self.buffers = buffers
+        # ``_BCFFieldMeta`` for each key in the record, in record order
+        self._metas = collections.OrderedDict()
+        for i in range(struct.n_info):
+            meta = header._field_meta(_BCF_HL_INFO, struct.d.info[i].key)
+            self._metas[meta.key] = meta
+        # values decoded so far
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = _BCFTypedInfoFieldConverter(
+                self.header, self._metas[key], self.struct, self.buffers)()
+            self._values[key] = value
+            return value
+
+    def __iter__(self):
+        return iter(self._metas)
+
+    def __len__(self):
+        return len(self._metas)
+
+    def __contains__(self, key):
+        return key in self._metas
+
+    def __repr__(self):
+        return 'BCFInfo({})'.format(list(self._metas))
 
 
 class GenotypeCall:
     """Information about a genotype call"""
 
+    @staticmethod
+    def from_values(values):
+        """Return ``GenotypeCall`` from the encoded GT values of a sample
+
+        ``None`` values (``bcf_int32_missing``) are missing alleles, the
+        call is phased if any of the alleles after the first is phased.
+        """
+        return GenotypeCall(
+            [None if x is None or _bcf_gt_is_missing(x)
+             else _bcf_gt_allele(x) for x in values],
+            any(x is not None and _bcf_gt_is_phased(x) for x in values[1:]))
+
     def __init__(self, allele_ids, is_phased, gt_info=None):
         self.allele_ids = allele_ids
         self.is_phased = is_phased
@@ -505,73 +687,134 @@ class GenotypeCall:
             repr(self.allele_ids), repr(self.is_phased))
 
 
+class _BCFValueBuffer:
+    """Output buffer for ``bcf_get_*_values()`` that is reused across calls
+
+    htslib grows the buffer with ``realloc()`` whenever it is too small.
+    """
+
+    def __init__(self, ctype):
+        #: ``ctypes`` type of the elements
+        self.ctype = ctype
+        #: pointer to the buffer, allocated by htslib
+        self.ptr = ctypes.POINTER(ctype)()
+        #: capacity of the buffer in elements
+        self.size = ctypes.c_int(0)
+
+    def snapshot(self, n):
+        """Return copy of the first ``n`` elements as ``bytes``"""
+        return ctypes.string_at(self.ptr, n * ctypes.sizeof(self.ctype))
+
+    def free(self):
+        """Free the buffer, it can be used again afterwards"""
+        if self.ptr:
+            _libc.free(self.ptr)
+        self.ptr = ctypes.POINTER(self.ctype)()
+        self.size.value = 0
+
+
+class _BCFBufferArena:
+    """Output buffers for ``bcf_get_*_values()``, one for each value type
+
+    Each iterator owns one arena that is used for all INFO and FORMAT
+    values of all its records, so htslib only has to ``realloc()`` when a
+    value is larger than all before.  Freed when the iterator is closed.
+    """
+
+    def __init__(self):
+        self.int32 = _BCFValueBuffer(ctypes.c_int32)
+        self.float = _BCFValueBuffer(ctypes.c_float)
+        self.char = _BCFValueBuffer(ctypes.c_char)
+
+    def free(self):
+        for buf in (self.int32, self.float, self.char):
+            buf.free()
+
+
 class GenotypeInfo:
     """Information given for each sample"""
 
-    def _build_from_struct(struct, header, sample_id):
-        """Construct ``GenotypeInfo`` for the i-th sample from ``record_impl``
+    @staticmethod
+    def _build_all_from_struct(struct, header, buffers):
+        """Construct ``GenotypeInfo`` objects for all samples of ``struct``
+
+        Each FORMAT field is extracted once for all samples into a
+        sample-by-value matrix that is then sliced per sample, using the
+        ``_BCFBufferArena`` ``buffers``.
         """
-        fields = collections.OrderedDict()
-        for hdr_id, struct_id in [(struct.d.fmt[sample_id].id, i)
-                                  for i in range(struct.n_fmt)]:
-            format_key = header.ids[hdr_id]
-            enc_format_key = format_key.encode('utf-8')
-            if format_key == 'GT':
-                arr = ctypes.POINTER(ctypes.c_int32)()
-                narr = ctypes.c_int(0)
-                r = _bcf_get_genotypes(
-                    header.struct_ptr, ctypes.byref(struct),
-                    ctypes.byref(arr), ctypes.byref(narr))
-                if r < 0:
-                    continue  # skip, has no genotype
-                # TODO(holtgrewe): is the following too hacky?
-                is_phased = _bcf_gt_is_phased(arr[0])
-                allele_ids = [None if _bcf_gt_is_missing(arr[i])
-                              else _bcf_gt_allele(arr[i])
-                              for i in range(narr.value)]
-                fields[format_key] = [GenotypeCall(allele_ids, is_phased)]
-            elif struct.d.fmt[struct_id].type in [
-                    _BCF_BT_INT8, _BCF_BT_INT16, _BCF_BT_INT32]:
-                arr = ctypes.POINTER(ctypes.c_int32)()
-                narr = ctypes.c_int(0)
-                r = _bcf_get_format_int32(
-                    header.struct_ptr, ctypes.byref(struct), enc_format_key,
-                    ctypes.byref(arr), ctypes.byref(narr))
-                if r < 0:
-                    tpl = 'Problem when reading genotype field {}'
-                    raise BCFFileException(tpl.format(format_key))
-                fields[format_key] = [arr[i] for i in range(narr.value)]
-            elif struct.d.fmt[struct_id].type == _BCF_BT_FLOAT:
-                arr = ctypes.POINTER(ctypes.c_float)()
-                narr = ctypes.c_int(0)
-                r = _bcf_get_format_float(
-                    header.struct_ptr, ctypes.byref(struct), enc_format_key,
-                    ctypes.byref(arr), ctypes.byref(narr))
-                if r < 0:
-                    tpl = 'Problem when reading genotype field {}'
-                    raise BCFFileException(tpl.format(format_key))
-                fields[format_key] = [arr[i] for i in range(narr.value)]
-            elif struct.d.fmt[struct_id].type == _BCF_BT_CHAR:
-                arr = ctypes.POINTER(ctypes.c_uint8)()
-                narr = ctypes.c_int(0)
-                r = _bcf_get_format_char(
-                    header.struct_ptr, ctypes.byref(struct), enc_format_key,
-                    ctypes.byref(arr), ctypes.byref(narr))
-                if r < 0:
-                    tpl = 'Problem when reading genotype field {}'
-                    raise BCFFileException(tpl.format(format_key))
-                fields[format_key] = [chr(narr[i]) for i in range(narr.value)]
-            else:
-                tpl = 'Invalid FORMAT type {} for entry {}'
-                raise BCFFileException(tpl.format(
-                    struct.d.fmt[struct_id].type, format_key))
+        n_sample = struct.n_sample
+        if not n_sample:
+            return []
+        fields = [collections.OrderedDict() for _ in range(n_sample)]
+        for i in range(struct.n_fmt):
+            meta = header._field_meta(_BCF_HL_FMT, struct.d.fmt[i].id)
+            rows = GenotypeInfo._extract_format(struct, header, meta, buffers)
+            if rows is None:
+                continue  # skip, has no genotype
+            for sample_fields, value in zip(fields, rows):
+                sample_fields[meta.key] = value
+        return [GenotypeInfo(sample_fields) for sample_fields in fields]
 
-            # extract scalar values from list
-            num = header.id_to_format_record[format_key].entries.get('number')
-            if num and str(num) == '1':
-                fields[format_key] = fields[format_key][0]
+    @staticmethod
+    def _extract_format(struct, header, meta, buffers):
+        """Return list with the value of FORMAT key for each sample
 
-        return GenotypeInfo(fields)
+        ``meta`` is the key's ``_BCFFieldMeta``.  Returns ``None`` if there
+        is no genotype in the record.
+        """
+        format_key = meta.key
+        if format_key == 'GT' or meta.type_ == _BCF_HT_INT:
+            buf, getter = buffers.int32, _bcf_get_format_int32
+        elif meta.type_ == _BCF_HT_REAL:
+            buf, getter = buffers.float, _bcf_get_format_float
+        elif meta.type_ == _BCF_HT_STR:
+            buf, getter = buffers.char, _bcf_get_format_char
+        else:
+            tpl = 'Invalid FORMAT type {} for entry {}'
+            raise BCFFileException(tpl.format(meta.type_, format_key))
+        n = getter(header.struct_ptr, ctypes.byref(struct), meta.enc_key,
+                   ctypes.byref(buf.ptr), ctypes.byref(buf.size))
+        if n < 0 and format_key == 'GT':
+            return None
+        elif n < 0:
+            tpl = 'Problem when reading genotype field {}'
+            raise BCFFileException(tpl.format(format_key))
+
+        n_sample = struct.n_sample
+        width = n // n_sample
+        raw = buf.snapshot(n)
+        is_scalar = meta.is_scalar
+        if buf is buffers.char:
+            rows = [raw[i * width:(i + 1) * width].rstrip(b'\0').decode(
+                'utf-8') for i in range(n_sample)]
+            return rows if is_scalar else [row.split(',') for row in rows]
+
+        # the bit patterns are compared for detecting missing values and
+        # vector ends, also for floats
+        bits = array.array('i', raw)
+        if buf is buffers.float:
+            values = array.array('f', raw)
+            missing, vector_end = _BCF_FLOAT_MISSING, _BCF_FLOAT_VECTOR_END
+        else:
+            values = bits
+            missing, vector_end = _BCF_INT32_MISSING, _BCF_INT32_VECTOR_END
+        rows = [values[i * width:(i + 1) * width].tolist()
+                for i in range(n_sample)]
+        if vector_end in bits or missing in bits:
+            for i, row in enumerate(rows):
+                row_bits = bits[i * width:(i + 1) * width]
+                if vector_end in row_bits:
+                    end = row_bits.index(vector_end)
+                    row, row_bits = row[:end], row_bits[:end]
+                rows[i] = [None if b == missing else x
+                           for x, b in zip(row, row_bits)]
+
+        if format_key == 'GT':
+            return [GenotypeCall.from_values(row) for row in rows]
+        elif is_scalar:
+            return [row[0] if row else None for row in rows]
+        else:
+            return rows
 
     def __init__(self, fields, record_impl=None):
         # link back to the ``BCFRecordInfo``, for ``BCFRecord`` and
@@ -579,7 +822,7 @@ class GenotypeInfo:
         self.record_impl = record_impl
         #: ``OrderedDict`` with field entries
         self.fields = fields
-        if self.gt:
+        if 'GT' in self.fields:
             self.gt.gt_info = self
 
     @property
@@ -652,46 +895,249 @@ class GenotypeInfo:
         return tpl.format(self.fields, self.record_impl)
 
 
+def _bcf_unpack_upto(struct, level):
+    """Unpack ``bcf1_t`` struct up to ``level`` unless already done"""
+    if (struct.unpacked & level) != level:
+        _bcf_unpack(ctypes.byref(struct), level)
+
+
+class BCFInfoAccessor:
+    """Extract the value of one INFO field from ``BCFRecord``s
+
+    Obtain through ``BCFHeader.info_accessor()`` and call with a record.
+    The key id, type and Number are resolved on construction and the output
+    buffer is reused between calls.  Scalar numbers are read directly from
+    the record without copying.  Returns ``None`` for missing values and if
+    the field is not present (``False`` for flags).
+    """
+
+    #: missing value by the integer type of scalars in ``bcf_info_t.v1``
+    V1_INT_MISSING = {
+        _BCF_BT_INT8: _BCF_INT8_MISSING,
+        _BCF_BT_INT16: _BCF_INT16_MISSING,
+        _BCF_BT_INT32: _BCF_INT32_MISSING,
+    }
+
+    def __init__(self, header, meta):
+        #: the ``BCFHeader`` the accessor was created for
+        self.header = header
+        #: ``_BCFFieldMeta`` of the field
+        self.meta = meta
+        #: the INFO key
+        self.key = meta.key
+        # value returned if the field is not present in a record
+        self._absent = False if meta.is_flag else None
+        # output buffer, getter function and type name for non-scalar values
+        self._buffer, self._getter, self._type_name = {
+            _BCF_HT_FLAG: (None, None, 'flag'),
+            _BCF_HT_INT: (_BCFValueBuffer(ctypes.c_int32),
+                          _bcf_get_info_int32, 'int32'),
+            _BCF_HT_REAL: (_BCFValueBuffer(ctypes.c_float),
+                           _bcf_get_info_float, 'float'),
+            _BCF_HT_STR: (_BCFValueBuffer(ctypes.c_char),
+                          _bcf_get_info_string, 'string'),
+        }[meta.type_]
+
+    def __call__(self, record):
+        meta = self.meta
+        if record.impl:  # detached record
+            return record.impl.info.get(self.key, self._absent)
+        struct = record.struct
+        _bcf_unpack_upto(struct, _BCF_UN_INFO)
+        info_ptr = _bcf_get_info_id(ctypes.byref(struct), meta.key_id)
+        if not info_ptr or not info_ptr[0].vptr:
+            return self._absent
+        if meta.is_flag:
+            return True
+        info = info_ptr[0]
+        if info.len == 1 and meta.is_scalar and info.type != _BCF_BT_CHAR:
+            return self._convert_v1(info)
+        return self._convert_buffer(struct)
+
+    def _convert_v1(self, info):
+        """Return scalar number stored in ``bcf_info_t`` ``info``"""
+        if info.type == _BCF_BT_FLOAT:
+            return None if info.v1.i == _BCF_FLOAT_MISSING else info.v1.f
+        elif info.v1.i == self.V1_INT_MISSING[info.type]:
+            return None
+        else:
+            return info.v1.i
+
+    def _convert_buffer(self, struct):
+        """Return value extracted with ``bcf_get_info_values()``"""
+        buf = self._buffer
+        n = self._getter(self.header.struct_ptr, ctypes.byref(struct),
+                         self.meta.enc_key, ctypes.byref(buf.ptr),
+                         ctypes.byref(buf.size))
+        if n < 0:
+            raise BCFInfoFieldException(n, self.key, self._type_name)
+        if buf.ctype is ctypes.c_char:
+            value = buf.snapshot(n).rstrip(b'\0').decode('utf-8')
+            return value if self.meta.is_scalar else value.split(',')
+        values = buf.ptr[:n]
+        if buf.ctype is ctypes.c_float:
+            bits = ctypes.cast(buf.ptr, ctypes.POINTER(ctypes.c_int32))[:n]
+            missing = _BCF_FLOAT_MISSING
+        else:
+            bits, missing = values, _BCF_INT32_MISSING
+        if missing in bits:
+            values = [None if b == missing else x
+                      for x, b in zip(values, bits)]
+        return values[0] if self.meta.is_scalar else values
+
+    def free(self):
+        """Free the output buffer
+
+        This function is idempotent.
+        """
+        if self._buffer:
+            self._buffer.free()
+
+
+class BCFFormatAccessor:
+    """Extract the values of one FORMAT field from ``BCFRecord``s
+
+    Obtain through ``BCFHeader.format_accessor()`` and call with a record.
+    The key id, type and Number are resolved on construction and the output
+    buffers are reused between calls.  Returns a list with the value for
+    each sample, as in ``GenotypeInfo.fields``, or ``None`` if the field is
+    not present.
+    """
+
+    def __init__(self, header, meta):
+        #: the ``BCFHeader`` the accessor was created for
+        self.header = header
+        #: ``_BCFFieldMeta`` of the field
+        self.meta = meta
+        #: the FORMAT key
+        self.key = meta.key
+        # output buffers
+        self._buffers = _BCFBufferArena()
+
+    def __call__(self, record):
+        if record.impl:  # detached record
+            if not any(self.key in gt.fields for gt in record.impl.genotypes):
+                return None
+            return [gt.fields.get(self.key) for gt in record.impl.genotypes]
+        struct = record.struct
+        _bcf_unpack_upto(struct, _BCF_UN_FMT)
+        fmt_ptr = _bcf_get_fmt_id(ctypes.byref(struct), self.meta.key_id)
+        if not fmt_ptr or not fmt_ptr[0].p:
+            return None
+        return GenotypeInfo._extract_format(
+            struct, self.header, self.meta, self._buffers)
+
+    def free(self):
+        """Free the output buffers
+
+        This function is idempotent.
+        """
+        self._buffers.free()
+
+
 class BCFRecordImpl:
     """Information extracted from C internals of ``BCFRecord``"""
 
+    #: names of the fields, in the order of the constructor arguments
+    FIELDS = ('r_id', 'chrom', 'begin_pos', 'end_pos', 'ids', 'ref', 'alts',
+              'qual', 'filters', 'info', 'format', 'genotypes')
+
+    #: ``bcf_unpack()`` level required for decoding each field
+    UNPACK_LEVELS = {
+        'r_id': 0,
+        'chrom': 0,
+        'begin_pos': 0,
+        'end_pos': 0,
+        'ids': _BCF_UN_STR,
+        'ref': _BCF_UN_STR,
+        'alts': _BCF_UN_STR,
+        'qual': 0,
+        'filters': _BCF_UN_FLT,
+        'info': _BCF_UN_INFO,
+        'format': _BCF_UN_FMT,
+        'genotypes': _BCF_UN_ALL,
+    }
+
     @staticmethod
-    def from_struct(struct, header):
-        """Return ``BCFRecordImpl`` from internal C structure"""
-        r_id = struct.rid
-        chrom = header.target_infos[r_id].name
-        begin_pos = struct.pos
-        end_pos = struct.pos + struct.rlen
-        ids = struct.d.id.decode('utf-8').split(';')
-        if ids == ['.']:
-            ids = []  # translate '.' to []
-        ref = struct.d.allele[0].decode('utf-8')
-        alts = [struct.d.allele[i].decode('utf-8')
-                for i in range(1, struct.n_allele)]
-        qual = struct.qual
-        filters = [header.ids[i] for i in range(struct.d.n_flt)]
-        info = BCFRecordImpl._build_info_field(struct, header)
-        format_ = [header.ids[struct.d.fmt[i].id]
-                   for i in range(struct.n_fmt)]
-        genotypes = [GenotypeInfo._build_from_struct(struct, header, i)
-                     for i in range(struct.n_sample)]
-
-        res = BCFRecordImpl(r_id, chrom, begin_pos, end_pos, ids, ref,
-                            alts, qual, filters, info, format_, genotypes)
-        for gt in genotypes:
+    def from_struct(struct, header, buffers=None):
+        """Return ``BCFRecordImpl`` from internal C structure
+
+        ``buffers`` is an optional ``_BCFBufferArena`` for extracting the
+        INFO and FORMAT values, a temporary one is used if not given.
+        """
+        _bcf_unpack_upto(struct, _BCF_UN_ALL)
+        own_buffers = buffers is None
+        if own_buffers:
+            buffers = _BCFBufferArena()
+        try:
+            res = BCFRecordImpl(*[
+                BCFRecordImpl.decoder(name)(struct, header, buffers)
+                for name in BCFRecordImpl.FIELDS])
+        finally:
+            if own_buffers:
+                buffers.free()
+        for gt in res.genotypes:
             gt.record_impl = res
         return res
 
-    def _build_info_field(struct, header):
-        """Return INFO column entries."""
-        result = []
-        for i in range(struct.n_info):
-            info = struct.d.info[i]
-            key_str = header.ids[info.key]
-            converter = _BCFTypedInfoFieldConverter(
-                header, info, struct, key_str)
-            result.append((key_str, converter()))
-        return result
+    @staticmethod
+    def decoder(name):
+        """Return function decoding field ``name``
+
+        The function is called as ``(struct, header, buffers)`` and expects
+        ``struct`` to be unpacked to the level from ``UNPACK_LEVELS``.
+        """
+        return getattr(BCFRecordImpl, '_decode_' + name)
+
+    @staticmethod
+    def _decode_r_id(struct, header, buffers):
+        return struct.rid
+
+    @staticmethod
+    def _decode_chrom(struct, header, buffers):
+        return header.target_infos[struct.rid].name
+
+    @staticmethod
+    def _decode_begin_pos(struct, header, buffers):
+        return struct.pos
+
+    @staticmethod
+    def _decode_end_pos(struct, header, buffers):
+        return struct.pos + struct.rlen
+
+    @staticmethod
+    def _decode_ids(struct, header, buffers):
+        ids = struct.d.id.decode('utf-8').split(';')
+        return [] if ids == ['.'] else ids  # translate '.' to []
+
+    @staticmethod
+    def _decode_ref(struct, header, buffers):
+        return struct.d.allele[0].decode('utf-8')
+
+    @staticmethod
+    def _decode_alts(struct, header, buffers):
+        return [struct.d.allele[i].decode('utf-8')
+                for i in range(1, struct.n_allele)]
+
+    @staticmethod
+    def _decode_qual(struct, header, buffers):
+        return struct.qual
+
+    @staticmethod
+    def _decode_filters(struct, header, buffers):
+        return [header.ids[struct.d.flt[i]] for i in range(struct.d.n_flt)]
+
+    @staticmethod
+    def _decode_info(struct, header, buffers):
+        return BCFInfo(struct, header, buffers)
+
+    @staticmethod
+    def _decode_format(struct, header, buffers):
+        return [header.ids[struct.d.fmt[i].id] for i in range(struct.n_fmt)]
+
+    @staticmethod
+    def _decode_genotypes(struct, header, buffers):
+        return GenotypeInfo._build_all_from_struct(struct, header, buffers)
 
     def __init__(self, r_id, chrom, begin_pos, end_pos, ids, ref, alts,
                  qual, filters, info, format_, genotypes):
@@ -724,10 +1170,70 @@ class BCFRecordImpl:
         self.genotypes = genotypes
 
 
+class _LazyBCFRecordField:
+    """Descriptor for a lazily decoded field of ``BCFRecord``
+
+    The wrapped ``bcf1_t`` is unpacked as far as needed and the value is
+    decoded on first access, then cached until the record is reset for the
+    next iteration.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.decode = BCFRecordImpl.decoder(name)
+        self.unpack_level = BCFRecordImpl.UNPACK_LEVELS[name]
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        if record.impl:
+            return getattr(record.impl, self.name)
+        cache = record._cache
+        if self.name not in cache:
+            if not record.struct:
+                raise AttributeError('self.impl is None and cannot rebuild '
+                                     'from None self.struct')
+            _bcf_unpack_upto(record.struct, self.unpack_level)
+            cache[self.name] = self._decode(record)
+        return cache[self.name]
+
+    def _decode(self, record):
+        return self.decode(record.struct, record.header, record._buffers)
+
+
+class _LazyBCFGenotypesField(_LazyBCFRecordField):
+    """Lazy ``BCFRecord.genotypes``, links ``GenotypeInfo``s to the record"""
+
+    def _decode(self, record):
+        genotypes = _LazyBCFRecordField._decode(self, record)
+        for gt in genotypes:
+            gt.record_impl = record
+        return genotypes
+
+
 class BCFRecord:
-    """Record from a BCF file"""
+    """Record from a BCF file
+
+    The fields are decoded lazily from the wrapped C struct on first access.
+    The struct is unpacked further by htslib as needed, so reading only the
+    site fields does not decode the per-sample data.
+    """
 
-    def __init__(self, struct_ptr=None, header=None, impl=None):
+    r_id = _LazyBCFRecordField('r_id')
+    chrom = _LazyBCFRecordField('chrom')
+    begin_pos = _LazyBCFRecordField('begin_pos')
+    end_pos = _LazyBCFRecordField('end_pos')
+    ids = _LazyBCFRecordField('ids')
+    ref = _LazyBCFRecordField('ref')
+    alts = _LazyBCFRecordField('alts')
+    qual = _LazyBCFRecordField('qual')
+    filters = _LazyBCFRecordField('filters')
+    info = _LazyBCFRecordField('info')
+    format = _LazyBCFRecordField('format')
+    genotypes = _LazyBCFGenotypesField('genotypes')
+
+    def __init__(self, struct_ptr=None, header=None, impl=None,
+                 buffers=None):
         #: pointer to wrapped C struct
         self.struct_ptr = struct_ptr
         #: wrapped C struct
@@ -738,6 +1244,18 @@ class BCFRecord:
         self.header = header
         #: ``BCFRecordImpl`` instance used for the representation
         self.impl = impl
+        # cache for the lazily decoded fields
+        self._cache = {}
+        # ``_BCFBufferArena`` for extracting INFO and FORMAT values, usually
+        # the one of the iterator the record belongs to
+        self._buffers = _BCFBufferArena() if buffers is None else buffers
+
+    @property
+    def alleles(self):
+        """List of all alleles"""
+        if self.impl:
+            return self.impl.alleles
+        return [self.ref] + self.alts
 
     def detach(self):
         """Return copy that is detached from the underlying C object
@@ -751,23 +1269,61 @@ class BCFRecord:
         """
         impl = self.impl
         if not impl:
-            impl = BCFRecordImpl.from_struct(self.struct_ptr, self.header)
+            impl = BCFRecordImpl.from_struct(self.struct, self.header,
+                                             self._buffers)
         self.impl = None
         return BCFRecord(impl=impl)
 
     def _reset(self):
         """Reset Python side, as if freshly constructed"""
         self.impl = None
+        self._cache = {}
+
+    def free(self):
+        """Free the buffers used for extracting values
+
+        This function is idempotent.
+        """
+        self._buffers.free()
+
+    def gt_array(self):
+        """Return the genotypes of all samples as NumPy arrays
+
+        Returns a pair of a (samples x ploidy) array with the allele
+        indices and a boolean array with the phasing of each sample.  The
+        values are taken from the ``bcf_get_genotypes()`` buffer without
+        building ``GenotypeCall`` objects.  Missing alleles are given as
+        ``GT_MISSING``, padding for samples of lower ploidy as
+        ``GT_VECTOR_END``.  The allele array has type ``int8`` or, for
+        records with more than 127 alleles, ``int16``.
+        """
+        result = self._gt_array()
+        if result is None:
+            raise BCFFileException('Record has no GT field')
+        return result
 
-    def __getattr__(self, name):
-        """Delegation to self.impl if set, auto-set from struct"""
-        if not self.impl and not self.struct:
-            raise AttributeError('self.impl is None and cannot rebuild from '
-                                 'None self.struct')
-        elif not self.impl and self.struct:
-            self.impl = BCFRecordImpl.from_struct(
-                self.struct_ptr[0], self.header)
-        return getattr(self.impl, name)
+    def _gt_array(self):
+        """Return result of ``gt_array()``, ``None`` if there is no GT"""
+        np = require_numpy(BCFFileException)
+        if not self.struct:
+            raise BCFFileException('gt_array() requires a non-detached record')
+        n_sample = self.struct.n_sample
+        buf = self._buffers.int32
+        n = _bcf_get_genotypes(self.header.struct_ptr,
+                               ctypes.byref(self.struct),
+                               ctypes.byref(buf.ptr), ctypes.byref(buf.size))
+        if n < 0 or not n_sample:
+            return None
+        raw = np.frombuffer(buf.snapshot(n), dtype=np.int32).reshape(
+            n_sample, n // n_sample)
+        vector_end = (raw == _BCF_INT32_VECTOR_END)
+        dtype = np.int8 if self.struct.n_allele <= 127 else np.int16
+        alleles = ((raw >> 1) - 1).astype(dtype)
+        alleles[raw == _BCF_INT32_MISSING] = GT_MISSING
+        alleles[vector_end] = GT_VECTOR_END
+        # htslib stores the phasing with the second and later alleles
+        phased = ((raw[:, 1:] & 1) == 1) & ~vector_end[:, 1:]
+        return alleles, phased.any(axis=1)
 
 
 class BCFFileIter:
@@ -784,18 +1340,24 @@ class BCFFileIter:
         self.struct_ptr = _bcf_init1()
         #: pointer to buffer for reading in the file record by record
         self.struct = self.struct_ptr[0]
+        #: buffers for INFO and FORMAT values of all records
+        self.buffers = _BCFBufferArena()
         #: ``BCFRecord`` meant for consumption by the user
-        self.record = BCFRecord(self.struct_ptr, self.bcf_file.header)
+        self.record = BCFRecord(self.struct_ptr, self.bcf_file.header,
+                                buffers=self.buffers)
         # whether or not iterating over BCF file
         self.is_bcf = (self.bcf_file.file_format == 'BCF')
+        # level to unpack records to, after reading
+        self._unpack_level = BCF_UNPACK_LEVELS[self.bcf_file.unpack]
 
     def __next__(self):
         read = _bcf_read1 if self.is_bcf else _vcf_read1
         r = read(self.bcf_file.struct_ptr, self.bcf_file.header.struct_ptr,
                  self.struct_ptr)
         if r >= 0:
-            r = _bcf_unpack(self.struct_ptr, _BCF_UN_ALL)
-            # TODO(holtgrewe): check r from unpack?
+            if _bcf_unpack(self.struct_ptr, self._unpack_level) != 0:
+                tpl = 'Could not unpack record from {}'
+                raise BCFFileException(tpl.format(self.bcf_file.path))
             # successfully read record from file
             self.record._reset()
             return self.record
@@ -810,6 +1372,7 @@ class BCFFileIter:
                 raise StopIteration
 
     def close(self):
+        self.buffers.free()
         if self.struct_ptr:
             _bcf_destroy1(self.struct_ptr)
             self.struct_ptr = None
@@ -819,13 +1382,23 @@ class BCFFileIter:
 class BCFFile:
     """Representation of a VCF/BCF file"""
 
-    def __init__(self, path, mode='r', worker_threads=1):
+    def __init__(self, path, mode='r', threads=1, samples=None,
+                 unpack='all'):
         #: path to BCF file
         self.path = path
         #: mode to open file with
         self.mode = mode
-        #: number of worker threads
-        self.worker_threads = worker_threads
+        #: number of (de-)compression threads or ``HTSThreadPool``
+        self.threads = threads
+        #: names of the samples to read FORMAT values for, ``None`` for all
+        self.samples = None if samples is None else list(samples)
+        if unpack not in BCF_UNPACK_LEVELS:
+            tpl = 'Invalid unpack level {}, must be one of {}'
+            raise BCFFileException(tpl.format(
+                repr(unpack), ', '.join(BCF_UNPACK_LEVELS)))
+        #: how far records are unpacked after reading, one of ``'site'``,
+        #: ``'shared'`` and ``'all'``, fields beyond are unpacked on access
+        self.unpack = unpack
         #: wrapped C struct
         self.struct = None
         #: pointer to C struct
@@ -851,13 +1424,22 @@ class BCFFile:
             return  # already open
         # open file and store handles
         self.struct_ptr = _hts_open(self.path.encode('utf-8'), self.mode)
+        if not self.struct_ptr:
+            tpl = 'Could not open VCF/BCF file {}'
+            raise BCFFileException(tpl.format(self.path))
         self.struct = self.struct_ptr[0]
         # check file format
         if self.file_format not in ['VCF', 'BCF']:
             self.close()
             raise BCFFileException('Not a VCF/BCF file: {}'.format(self.path))
+        set_threads(self.struct_ptr, self.threads)
         # read header
-        self.header = BCFHeader._read_from_file(self.struct_ptr)
+        try:
+            self.header = BCFHeader._read_from_file(self.struct_ptr,
+                                                    self.samples)
+        except BCFFileException:
+            self.close()
+            raise
 
     def close(self):
         """Close file again and free header and other data structures
@@ -879,6 +1461,28 @@ class BCFFile:
         self.iterators.append(BCFFileIter(self))
         return self.iterators[-1]
 
+    def iter_gt_blocks(self, n_variants=1024):
+        """Yield genotypes of blocks of ``n_variants`` records
+
+        Each block is a pair of a (variants x samples x ploidy) allele array
+        and a (variants x samples) phased mask, see ``BCFRecord.gt_array()``
+        and ``stack_gt_arrays()``.  The last block may be shorter.  Records
+        without GT, e.g. site-only records, are given as missing haploid
+        calls (``GT_MISSING``) that are not phased.
+        """
+        np = require_numpy(BCFFileException)
+        n_sample = len(self.header.sample_names)
+        missing = (np.full((n_sample, 1), GT_MISSING, dtype=np.int8),
+                   np.zeros(n_sample, dtype=bool))
+        block = []
+        for record in self:
+            block.append(record._gt_array() or missing)
+            if len(block) == n_variants:
+                yield stack_gt_arrays(block)
+                block = []
+        if block:
+            yield stack_gt_arrays(block)
+
     def __enter__(self):
         self.open()
         return self
@@ -910,8 +1514,13 @@ class BCFIndexIter:
         self.itr_ptr = itr
         #: iterator struct to use for iteration
         self.itr = self.itr_ptr[0]
+        #: buffers for INFO and FORMAT values of all records
+        self.buffers = _BCFBufferArena()
         #: ``BCFRecord`` meant for consumption by the user
-        self.record = BCFRecord(self.struct_ptr, self.bcf_file.header)
+        self.record = BCFRecord(self.struct_ptr, self.bcf_file.header,
+                                buffers=self.buffers)
+        # level to unpack records to, after reading
+        self._unpack_level = BCF_UNPACK_LEVELS[self.bcf_file.unpack]
         # buffer to use in case of SAM.gz
         self._buffer = None
         if not self.bcf_index.is_bcf:
@@ -936,6 +1545,13 @@ class BCFIndexIter:
                 _vcf_parse1(ctypes.byref(self._buffer),
                             self.bcf_file.header.struct_ptr,
                             ctypes.byref(self.struct))
+            elif self.bcf_file.header.struct.keep_samples:
+                # bcf_itr_next() does not subset the samples, bcf_read() does
+                _bcf_subset_format(self.bcf_file.header.struct_ptr,
+                                   self.struct_ptr)
+            if _bcf_unpack(self.struct_ptr, self._unpack_level) != 0:
+                tpl = 'Could not unpack record from {}'
+                raise BCFFileException(tpl.format(self.bcf_file.path))
             # successfully read record from file
             self.record._reset()
             return self.record
@@ -950,6 +1566,7 @@ class BCFIndexIter:
                 raise StopIteration
 
     def close(self):
+        self.buffers.free()
         if self.struct_ptr:
             _bcf_destroy1(self.struct_ptr)
             self.struct_ptr = None
@@ -971,13 +1588,61 @@ class BCFIndex:
     """Random-access access to BCF/VCF files"""
 
     @staticmethod
-    def build(path, csi_path=None):
-        assert False, 'Implement me!'
+    def build(path, csi_path=None, min_shift=None, threads=1):
+        """Build index for the BCF or bgzip-compressed VCF file
+
+        The index is written to ``csi_path``, by default next to ``path``.
+        ``min_shift`` is ``0`` for a TBI index or the size of the smallest
+        bins, as power of two, of a CSI index.  BCF files always get a CSI
+        index, by default with ``min_shift=14``, VCF files a TBI index
+        unless ``csi_path`` ends with ``.csi``.  ``threads`` is only used
+        with htslib >= 1.9.  Returns the path to the index.
+        """
+        is_vcf = path.endswith('.vcf.gz')
+        if min_shift is None:
+            use_csi = not is_vcf or (csi_path and csi_path.endswith('.csi'))
+            min_shift = 14 if use_csi else 0
+        if not is_vcf and not min_shift:
+            raise BCFIndexException('BCF files require a CSI index, '
+                                    'min_shift must be positive')
+        default_path = path + BCFIndex._get_index_ext(path, min_shift)
+        csi_path = csi_path or default_path
+        if _bcf_index_build3:
+            res = _bcf_index_build3(path.encode('utf-8'),
+                                    csi_path.encode('utf-8'), min_shift,
+                                    threads)
+        elif is_vcf:
+            conf = _tbx_conf_t.in_dll(htslib, 'tbx_conf_vcf')
+            res = _tbx_index_build2(path.encode('utf-8'),
+                                    csi_path.encode('utf-8'), min_shift,
+                                    ctypes.byref(conf))
+        elif _bcf_index_build2:
+            res = _bcf_index_build2(path.encode('utf-8'),
+                                    csi_path.encode('utf-8'), min_shift)
+        else:
+            res = _bcf_index_build(path.encode('utf-8'), min_shift)
+            if res == 0 and csi_path != default_path:
+                os.replace(default_path, csi_path)
+        if res != 0:
+            tpl = 'Could not build index {} for {}'
+            raise BCFIndexException(tpl.format(csi_path, path))
+        return csi_path
+
+    @staticmethod
+    def build_many(paths, min_shift=None, threads=1, processes=None):
+        """Build indices for many files in a process pool
+
+        Calls ``build()`` for each of the ``paths`` with the default index
+        path.  With ``processes=1``, everything runs in the current process.
+        Returns the list of index paths.
+        """
+        return build_many(BCFIndex.build, paths, processes,
+                          min_shift=min_shift, threads=threads)
 
     @staticmethod
-    def _get_index_ext(path):
+    def _get_index_ext(path, min_shift=None):
         if path.endswith('.vcf.gz'):
-            return '.tbi'
+            return '.csi' if min_shift else '.tbi'
         elif path.endswith('.bcf'):
             return '.csi'
         else:
@@ -985,7 +1650,8 @@ class BCFIndex:
             raise BCFIndexException(tpl.format(path))
 
     def __init__(self, path, csi_path=None, require_index=True,
-                 auto_load=True, auto_build=False):
+                 auto_load=True, auto_build=False, threads=1,
+                 cache_size=None, samples=None, unpack='all'):
         #: path to BCF file
         self.path = path
         #: path to BAI (BCF index) file
@@ -1000,8 +1666,13 @@ class BCFIndex:
         self.is_bcf = not self.path.endswith('.vcf.gz')
 
         #: the ``BCFFile`` to use for reading
-        self.bcf_file = BCFFile(self.path)
+        self.bcf_file = BCFFile(self.path, threads=threads, samples=samples,
+                                unpack=unpack)
         self.bcf_file.open()
+        #: ``BGZFBlockCache`` if ``cache_size`` is given, else ``None``
+        self.cache = None
+        if cache_size:
+            self.cache = BGZFBlockCache(self.bcf_file.struct_ptr, cache_size)
 
         # collection of iterators, we will call close() on all of them
         # in our own close to ensure that all memory is freed
@@ -1074,6 +1745,46 @@ class BCFIndex:
             raise BCFIndexException(tpl.format(region_str))
         return BCFIndexIter(self, ptr)
 
+    def query_many(self, regions, max_gap=QUERY_MANY_MAX_GAP):
+        """Query many regions at once, yields ``(record, matched)`` pairs
+
+        Works as ``BAMIndex.query_many()``, regions less than ``max_gap``
+        base pairs apart are read with one query.
+        """
+        return query_many(self, regions, max_gap)
+
+    def _query_multi(self, intervals):
+        return None  # no multi-region iterator for VCF/BCF
+
+    def parallel_map(self, fn, regions=None, chunk_bp=10000000,
+                     processes=None, reduce=None):
+        """Call ``fn(shard, records)`` for genome shards in a process pool
+
+        Works as ``BAMIndex.parallel_map()``, variants are attributed to the
+        shard containing their begin position.  Contigs without a length in
+        the header are processed as a single shard.
+        """
+        return parallel_map(self, fn, regions, chunk_bp, processes, reduce)
+
+    def _targets(self):
+        """Return list of ``(name, length)`` pairs for sharding"""
+        return [(info.name, info.length)
+                for info in self.bcf_file.header.target_infos]
+
+    def _index_path(self):
+        return self.csi_path
+
+    def _worker_kwargs(self):
+        """Return arguments for opening this index in worker processes"""
+        return {'threads': self.bcf_file.threads,
+                'cache_size': self.cache.cache_size if self.cache else None,
+                'samples': self.bcf_file.samples,
+                'unpack': self.bcf_file.unpack}
+
+    @staticmethod
+    def _record_span(record):
+        return record.begin_pos, record.end_pos
+
     def load(self):
         self.close(close_file=False)
         if not self.is_bcf and self.csi_path:
@@ -1120,3 +1831,424 @@ class BCFIndex:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close(close_file=True)
+
+
+def _float32(value):
+    """Return ``value`` rounded to ``float32``, as stored in BCF"""
+    return array.array('f', [value])[0]
+
+
+def _float_str(value):
+    """Return shortest representation of ``value`` as ``float32``
+
+    BCF stores floats with 32 bits, so the result reads back as the same
+    ``float32``, with at most 9 significant digits.
+    """
+    rounded = _float32(value)
+    for precision in range(6, 9):
+        text = '{:.{}g}'.format(value, precision)
+        if _float32(float(text)) == rounded:
+            return text
+    return '{:.9g}'.format(value)
+
+
+def _vcf_value(value):
+    """Return VCF representation of INFO or FORMAT value"""
+    if value is None:
+        return '.'
+    elif isinstance(value, GenotypeCall):
+        return _genotype_call_str(value)
+    elif isinstance(value, float):
+        return '.' if math.isnan(value) else _float_str(value)
+    elif isinstance(value, (list, tuple)):
+        return ','.join(map(_vcf_value, value)) or '.'
+    else:
+        return str(value)
+
+
+def _vcf_line(record):
+    """Return VCF line, without line ending, for detached ``BCFRecord``"""
+    info = []
+    for key, value in record.info.items():
+        if value is True:
+            info.append(key)
+        elif value is not False:
+            info.append('{}={}'.format(key, _vcf_value(value)))
+    fields = [record.chrom, str(record.begin_pos + 1),
+              ';'.join(record.ids) or '.', record.ref,
+              ','.join(record.alts) or '.', _vcf_value(record.qual),
+              ';'.join(record.filters) or '.', ';'.join(info) or '.']
+    if record.format:
+        fields.append(':'.join(record.format))
+        for gt_info in record.genotypes:
+            fields.append(':'.join(_vcf_value(gt_info.fields.get(key))
+                                   for key in record.format))
+    return '\t'.join(fields)
+
+
+class BCFWriter:
+    """Write VCF/BCF files
+
+    ``mode`` is the ``hts_open()`` mode, ``'wb'`` for BCF, ``'wz'`` for
+    bgzip-compressed VCF and ``'w'`` for plain VCF, by default chosen from
+    the extension of ``path``.  ``level`` is the compression level from
+    ``0`` to ``9``, ``threads`` the number of compression threads or a
+    ``HTSThreadPool``.  ``header`` is a ``BCFHeader``, e.g. the one of a
+    ``BCFFile`` that is read, and must not be freed before the writer is
+    closed.
+
+    Records read with the same header are written as they are, without
+    decoding them in Python.  Records read with a different header are
+    translated to ``header`` with ``bcf_translate()``.  Use as a context
+    manager or call ``open()`` and ``close()``.
+    """
+
+    #: file extensions and the ``hts_open()`` modes for writing them
+    MODES = collections.OrderedDict([
+        ('.vcf.gz', 'wz'),
+        ('.vcf', 'w'),
+        ('.bcf', 'wb'),
+    ])
+
+    @staticmethod
+    def _get_mode(path):
+        for ext, mode in BCFWriter.MODES.items():
+            if path.endswith(ext):
+                return mode
+        tpl = 'Not a valid VCF/BCF file extension: {}'
+        raise BCFFileException(tpl.format(path))
+
+    def __init__(self, path, header, mode=None, threads=1, level=None):
+        #: path to the file to write
+        self.path = path
+        #: ``BCFHeader`` to write
+        self.header = header
+        #: number of compression threads or ``HTSThreadPool``
+        self.threads = threads
+        #: compression level, ``None`` for the default
+        self.level = level
+        #: mode for ``hts_open()``
+        self.mode = mode or BCFWriter._get_mode(path)
+        if level is not None:
+            self.mode += str(level)
+        #: wrapped C struct
+        self.struct = None
+        #: pointer to C struct
+        self.struct_ptr = None
+        # pointer to the ``bcf_hdr_t`` used for writing and whether it has
+        # been created by us from a header without one
+        self._hdr_ptr = None
+        self._own_hdr = False
+        # buffer for encoding records without a ``bcf1_t``
+        self._buffer = None
+
+    def open(self):
+        """Open file and write header"""
+        if self.struct_ptr:
+            return  # already open
+        self.struct_ptr = _hts_open(self.path.encode('utf-8'),
+                                    self.mode.encode('ascii'))
+        if not self.struct_ptr:
+            tpl = 'Could not open file {} for writing'
+            raise BCFFileException(tpl.format(self.path))
+        self.struct = self.struct_ptr[0]
+        try:
+            set_threads(self.struct_ptr, self.threads)
+            self._hdr_ptr = self.header.struct_ptr
+            if not self._hdr_ptr:
+                self._hdr_ptr = self.header._to_struct()
+                self._own_hdr = True
+            if _bcf_hdr_write(self.struct_ptr, self._hdr_ptr) < 0:
+                tpl = 'Could not write header to {}'
+                raise BCFFileException(tpl.format(self.path))
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, record):
+        """Write ``BCFRecord`` ``record``"""
+        if not record.struct_ptr:
+            res = _bcf_write1(self.struct_ptr, self._hdr_ptr,
+                              self._encode(record))
+        elif self._same_header(record.header):
+            res = _bcf_write1(self.struct_ptr, self._hdr_ptr,
+                              record.struct_ptr)
+        else:
+            # translate a copy, the record stays valid for its header
+            ptr = _bcf_dup(record.struct_ptr)
+            try:
+                if _bcf_translate(self._hdr_ptr, record.header.struct_ptr,
+                                  ptr) != 0:
+                    raise BCFFileException(
+                        'Could not translate record to output header')
+                res = _bcf_write1(self.struct_ptr, self._hdr_ptr, ptr)
+            finally:
+                _bcf_destroy1(ptr)
+        if res < 0:
+            tpl = 'Could not write record to {}'
+            raise BCFFileException(tpl.format(self.path))
+
+    def write_many(self, records):
+        """Write all ``BCFRecord``s from the iterable ``records``
+
+        Returns the number of records written.
+        """
+        num = 0
+        for record in records:
+            self.write(record)
+            num += 1
+        return num
+
+    def _same_header(self, header):
+        """Return whether records with ``header`` need no translation"""
+        if header is self.header:
+            return True
+        return bool(header.struct_ptr) and (
+            ctypes.addressof(header.struct_ptr[0]) ==
+            ctypes.addressof(self._hdr_ptr[0]))
+
+    def _encode(self, record):
+        """Return pointer to ``bcf1_t`` with detached ``record``"""
+        if not self._buffer:
+            self._buffer = _bcf_init1()
+        line = ctypes.create_string_buffer(_vcf_line(record).encode('utf-8'))
+        kstr = _kstring_t(len(line.value), len(line), ctypes.addressof(line))
+        if _vcf_parse1(ctypes.byref(kstr), self._hdr_ptr, self._buffer) != 0:
+            tpl = 'Could not encode record at {}:{}'
+            raise BCFFileException(tpl.format(record.chrom,
+                                              record.begin_pos + 1))
+        return self._buffer
+
+    def close(self):
+        """Close file, flushing all data
+
+        This function is idempotent.
+        """
+        if self.struct_ptr:
+            res = _hts_close(self.struct_ptr)
+            self.struct_ptr = None
+            self.struct = None
+            if res != 0:
+                tpl = 'Problem closing file {}'
+                raise BCFFileException(tpl.format(self.path))
+        if self._buffer:
+            _bcf_destroy1(self._buffer)
+            self._buffer = None
+        if self._own_hdr:
+            _bcf_hdr_destroy(self._hdr_ptr)
+            self._own_hdr = False
+        self._hdr_ptr = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _arrow_qual(record):
+    qual = record.qual
+    return None if math.isnan(qual) else qual
+
+
+#: site columns for ``to_arrow()``, with functions returning the value for a
+#: ``BCFRecord`` and the Arrow type given the ``pyarrow`` module, ``POS`` is
+#: 1-based as in VCF
+BCF_ARROW_SITE_FIELDS = collections.OrderedDict([
+    ('CHROM', (lambda record: record.chrom, lambda pa: pa.string())),
+    ('POS', (lambda record: record.begin_pos + 1, lambda pa: pa.int32())),
+    ('ID', (lambda record: record.ids, lambda pa: pa.list_(pa.string()))),
+    ('REF', (lambda record: record.ref, lambda pa: pa.string())),
+    ('ALT', (lambda record: record.alts, lambda pa: pa.list_(pa.string()))),
+    ('QUAL', (_arrow_qual, lambda pa: pa.float32())),
+    ('FILTER', (lambda record: record.filters,
+                lambda pa: pa.list_(pa.string()))),
+])
+
+
+def _genotype_call_str(call):
+    """Return VCF representation of ``GenotypeCall``, e.g. ``"0|1"``"""
+    sep = '|' if call.is_phased else '/'
+    return sep.join('.' if x is None else str(x) for x in call.allele_ids)
+
+
+class _BCFArrowBatchBuilder:
+    """Collect values of ``BCFRecord``s column by column for Arrow batches
+    """
+
+    def __init__(self, header, fields):
+        pa = require_pyarrow(BCFFileException)
+        #: names of the columns
+        self.names = list(fields)
+        # function returning the value of each column for a record
+        self._getters = []
+        # Arrow type of each column
+        self._types = []
+        for name in self.names:
+            if name in BCF_ARROW_SITE_FIELDS:
+                getter, arrow_type = BCF_ARROW_SITE_FIELDS[name]
+                type_ = arrow_type(pa)
+            elif name.startswith('INFO/'):
+                getter = header.info_accessor(name[len('INFO/'):])
+                type_ = self._value_type(pa, getter.meta)
+            elif name.startswith('FORMAT/'):
+                accessor = header.format_accessor(name[len('FORMAT/'):])
+                if accessor.key == 'GT':
+                    getter = self._gt_getter(accessor)
+                    value_type = pa.string()
+                else:
+                    getter = accessor
+                    value_type = self._value_type(pa, accessor.meta)
+                type_ = pa.list_(value_type, len(header.sample_names))
+            else:
+                tpl = ('Invalid field for Arrow output: {}, must be a site '
+                       'column or INFO/<key> or FORMAT/<key>')
+                raise BCFFileException(tpl.format(name))
+            self._getters.append(getter)
+            self._types.append(type_)
+        #: ``pyarrow.Schema`` of the batches
+        self.schema = pa.schema(list(zip(self.names, self._types)))
+        # values of the current batch, by column
+        self._columns = [[] for _ in self.names]
+
+    @staticmethod
+    def _value_type(pa, meta):
+        """Return Arrow type of INFO/FORMAT values described by ``meta``"""
+        type_ = {
+            _BCF_HT_FLAG: pa.bool_(),
+            _BCF_HT_INT: pa.int32(),
+            _BCF_HT_REAL: pa.float32(),
+            _BCF_HT_STR: pa.string(),
+        }[meta.type_]
+        if meta.is_flag or meta.is_scalar:
+            return type_
+        return pa.list_(type_)
+
+    @staticmethod
+    def _gt_getter(accessor):
+        def getter(record):
+            calls = accessor(record)
+            if calls is None:
+                return None
+            return [_genotype_call_str(call) for call in calls]
+        return getter
+
+    def add(self, record):
+        """Append the values of ``BCFRecord`` ``record``"""
+        for column, getter in zip(self._columns, self._getters):
+            column.append(getter(record))
+
+    def build(self):
+        """Return ``pyarrow.RecordBatch`` with the values added so far and
+        start a new batch"""
+        pa = require_pyarrow(BCFFileException)
+        arrays = [pa.array(column, type=type_)
+                  for column, type_ in zip(self._columns, self._types)]
+        self._columns = [[] for _ in self.names]
+        return pa.RecordBatch.from_arrays(arrays, self.names)
+
+    def __len__(self):
+        return len(self._columns[0]) if self._columns else 0
+
+
+class BCFArrowBatchIter:
+    """Iterate over the records of a VCF/BCF file in ``pyarrow.RecordBatch``es
+
+    Do not use directly but through ``to_arrow()``.  Iteration must be
+    completed or ``close()`` must be called to prevent resource leaks.
+    """
+
+    def __init__(self, path, fields, samples, regions, batch_size):
+        fields = list(fields or BCF_ARROW_SITE_FIELDS.keys())
+        # per-sample data is only unpacked if needed
+        unpack = 'shared'
+        if any(name.startswith('FORMAT/') for name in fields):
+            unpack = 'all'
+        #: number of records per batch
+        self.batch_size = batch_size
+        #: the ``BCFFile`` or, if ``regions`` is given, ``BCFIndex`` read
+        if regions is None:
+            self.source = BCFFile(path, samples=samples, unpack=unpack)
+            self.source.open()
+            header = self.source.header
+            self._records = iter(self.source)
+        else:
+            self.source = BCFIndex(path, samples=samples, unpack=unpack)
+            header = self.source.bcf_file.header
+            self._records = (record for record, _ in
+                             self.source.query_many(regions))
+        try:
+            self._builder = _BCFArrowBatchBuilder(header, fields)
+        except BCFFileException:
+            self.close()
+            raise
+        #: ``pyarrow.Schema`` of the batches
+        self.schema = self._builder.schema
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.source:
+            raise StopIteration
+        for record in self._records:
+            self._builder.add(record)
+            if len(self._builder) == self.batch_size:
+                return self._builder.build()
+        if len(self._builder):
+            return self._builder.build()
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        """Close the file, this function is idempotent"""
+        if self.source:
+            self._records.close()
+            self.source.close()
+            self.source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def to_arrow(path, fields=None, samples=None, regions=None,
+             batch_size=65536):
+    """Return ``BCFArrowBatchIter`` over ``pyarrow.RecordBatch``es of the
+    records in the VCF/BCF file at ``path``
+
+    ``fields`` is a list of column names, the site columns from
+    ``BCF_ARROW_SITE_FIELDS`` (the default) and ``"INFO/<key>"`` and
+    ``"FORMAT/<key>"`` columns.  Their type follows the header definition,
+    FORMAT columns are fixed-size lists with the value of each sample, GT as
+    ``str`` such as ``"0|1"``.  ``samples`` selects samples as in
+    ``BCFFile``.  If ``regions`` is given, only records overlapping these
+    are read, through ``BCFIndex.query_many()``.
+    """
+    return BCFArrowBatchIter(path, fields, samples, regions, batch_size)
+
+
+def write_parquet(path, parquet_path, fields=None, samples=None,
+                  regions=None, batch_size=65536, **kwargs):
+    """Write the records of a VCF/BCF file to a Parquet file
+
+    The arguments are as for ``to_arrow()``, further keyword arguments are
+    passed to ``pyarrow.parquet.ParquetWriter``, e.g. ``compression``.
+    Returns the number of records written.
+    """
+    require_pyarrow(BCFFileException)
+    import pyarrow.parquet
+    num = 0
+    with to_arrow(path, fields, samples, regions, batch_size) as batches:
+        writer = pyarrow.parquet.ParquetWriter(
+            parquet_path, batches.schema, **kwargs)
+        try:
+            for batch in batches:
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+                num += len(batch)
+        finally:
+            writer.close()
+    return num
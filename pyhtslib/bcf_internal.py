@@ -95,6 +95,13 @@ __all__ = [
     '_BCF_UN_IND',
     '_BCF_UN_ALL',
 
+    '_BCF_INT8_MISSING',
+    '_BCF_INT16_MISSING',
+    '_BCF_INT32_MISSING',
+    '_BCF_INT32_VECTOR_END',
+    '_BCF_FLOAT_MISSING',
+    '_BCF_FLOAT_VECTOR_END',
+
     # structures
 
     '_bcf_hrec_t',
@@ -144,6 +151,18 @@ __all__ = [
     '_bcf_itr_querys',
     '_bcf_index_load',
     '_bcf_index_load2',
+    '_bcf_index_build',
+    '_bcf_index_build2',
+    '_bcf_index_build3',
+    '_bcf_hdr_set_samples',
+    '_bcf_subset_format',
+    '_bcf_hdr_init',
+    '_bcf_hdr_parse',
+    '_bcf_hdr_write',
+    '_bcf_write',
+    '_bcf_write1',
+    '_bcf_dup',
+    '_bcf_translate',
 
     '_vcf_read1',
     '_vcf_read',
@@ -256,6 +275,13 @@ _BCF_UN_FMT = 8  # unpack format and each sample
 _BCF_UN_IND = _BCF_UN_FMT  # a synonymo of _BCF_UN_FMT
 _BCF_UN_ALL = (_BCF_UN_SHR | _BCF_UN_FMT)  # everything
 
+_BCF_INT8_MISSING = -2 ** 7
+_BCF_INT16_MISSING = -2 ** 15
+_BCF_INT32_MISSING = -2 ** 31
+_BCF_INT32_VECTOR_END = -2 ** 31 + 1
+_BCF_FLOAT_MISSING = 0x7F800001  # bit patterns, compare as int32
+_BCF_FLOAT_VECTOR_END = 0x7F800002
+
 # ----------------------------------------------------------------------------
 # Structures
 # ----------------------------------------------------------------------------
@@ -531,6 +557,43 @@ def _bcf_index_load(fn):
 _bcf_index_load2 = htslib.bcf_index_load2
 _bcf_index_load2.restype = ctypes.POINTER(_hts_idx_t)
 
+_bcf_index_build = htslib.bcf_index_build
+_bcf_index_build.restype = ctypes.c_int
+
+# with the index path and the number of threads, only available in htslib
+# >= 1.4 and >= 1.9, respectively
+_bcf_index_build2 = _optional_function('bcf_index_build2', ctypes.c_int)
+_bcf_index_build3 = _optional_function('bcf_index_build3', ctypes.c_int)
+
+_bcf_hdr_set_samples = htslib.bcf_hdr_set_samples
+_bcf_hdr_set_samples.restype = ctypes.c_int
+
+_bcf_subset_format = htslib.bcf_subset_format
+_bcf_subset_format.restype = ctypes.c_int
+
+_bcf_hdr_init = htslib.bcf_hdr_init
+_bcf_hdr_init.restype = ctypes.POINTER(_bcf_hdr_t)
+
+_bcf_hdr_parse = htslib.bcf_hdr_parse
+_bcf_hdr_parse.restype = ctypes.c_int
+
+_bcf_hdr_write = htslib.bcf_hdr_write
+_bcf_hdr_write.restype = ctypes.c_int
+
+_bcf_write = htslib.bcf_write
+_bcf_write.restype = ctypes.c_int
+
+
+def _bcf_write1(fp, h, v):
+    """Replacement for C macro ``bcf_write1``."""
+    return _bcf_write(fp, h, v)
+
+_bcf_dup = htslib.bcf_dup
+_bcf_dup.restype = ctypes.POINTER(_bcf1_t)
+
+_bcf_translate = htslib.bcf_translate
+_bcf_translate.restype = ctypes.c_int
+
 _vcf_read = htslib.vcf_read
 _vcf_read.restype = ctypes.c_int
 
@@ -552,7 +615,7 @@ _bcf_get_info = htslib.bcf_get_info
 _bcf_get_info.restype = ctypes.POINTER(_bcf_info_t)
 
 _bcf_get_fmt_id = htslib.bcf_get_fmt_id
-_bcf_get_fmt_id.restype = ctypes.POINTER(_bcf_info_t)
+_bcf_get_fmt_id.restype = ctypes.POINTER(_bcf_fmt_t)
 
 _bcf_get_info_id = htslib.bcf_get_info_id
 _bcf_get_info_id.restype = ctypes.POINTER(_bcf_info_t)
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""Functionality shared by the SAM/BAM, VCF/BCF, and tabix wrappers"""
+
+import bisect
+import collections
+import ctypes
+import functools
+import multiprocessing
+import multiprocessing.util
+import warnings
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+from pyhtslib import GenomeInterval
+from pyhtslib.hts_internal import *  # NOQA
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+
+class HTSException(Exception):
+    """Raised when there is a problem with shared htslib functionality"""
+
+
+class HTSThreadPool:
+    """Pool of (de-)compression threads that can be shared by many files
+
+    Pass the pool as the ``threads`` argument of ``BAMFile``, ``BCFFile``,
+    ``TabixFile`` and the index classes.  The pool must be closed after all
+    files using it have been closed.  Requires htslib >= 1.4.
+    """
+
+    def __init__(self, num_threads):
+        if not _hts_tpool_init:
+            raise HTSException('Thread pools require htslib >= 1.4')
+        #: number of threads in the pool
+        self.num_threads = num_threads
+        #: wrapped C struct, pointer to the pool and queue size
+        self.struct = _htsThreadPool(_hts_tpool_init(num_threads), 0)
+        if not self.struct.pool:
+            raise HTSException('Could not create thread pool')
+
+    def attach(self, file_ptr):
+        """Use the pool for (de-)compression of the ``htsFile`` file_ptr"""
+        if not self.struct.pool:
+            raise HTSException('Thread pool has already been closed')
+        if _hts_set_thread_pool(file_ptr, ctypes.byref(self.struct)) != 0:
+            raise HTSException('Could not attach thread pool to file')
+
+    def close(self):
+        """Destroy the pool
+
+        This function is idempotent.
+        """
+        if self.struct.pool:
+            _hts_tpool_destroy(ctypes.c_void_p(self.struct.pool))
+            self.struct.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def set_threads(file_ptr, threads):
+    """Enable (de-)compression threads for the open ``htsFile`` ``file_ptr``
+
+    ``threads`` is either the number of threads to create for this file
+    alone or a ``HTSThreadPool``.  Decompression threads for reading
+    require htslib >= 1.4 (``hts_set_threads()``), older versions only
+    support compression threads for writing BGZF files.  Otherwise, a
+    ``RuntimeWarning`` is issued and the file is read with one thread.
+    """
+    if isinstance(threads, HTSThreadPool):
+        threads.attach(file_ptr)
+    elif not threads or threads <= 1:
+        return  # single-threaded, nothing to do
+    elif _hts_set_threads:
+        if _hts_set_threads(file_ptr, threads) != 0:
+            tpl = 'Could not enable {} threads for file {}'
+            raise HTSException(tpl.format(threads, file_ptr[0].fn))
+    elif (file_ptr[0].ftype.compression != _HTSCompression.BGZF or
+          _bgzf_mt(file_ptr[0].fp.bgzf, threads, 256) != 0):
+        # bgzf_mt() of htslib < 1.4 fails for files opened for reading
+        tpl = ('Ignoring threads={} for {}, (de-)compression threads '
+               'require htslib >= 1.4, found {}')
+        warnings.warn(tpl.format(
+            threads, file_ptr[0].fn.decode('utf-8'),
+            _hts_version().decode('ascii', 'replace')), RuntimeWarning)
+
+
+def require_numpy(exception=HTSException):
+    """Return the ``numpy`` module, raise ``exception`` if not installed"""
+    if numpy is None:
+        raise exception('NumPy is required for array output')
+    return numpy
+
+
+def require_pyarrow(exception=HTSException):
+    """Import and return the ``pyarrow`` module, raise ``exception`` if not
+    installed
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise exception('pyarrow is required for Arrow output')
+    return pyarrow
+
+
+#: suffixes accepted by ``parse_size()`` and their multipliers
+_SIZE_SUFFIXES = collections.OrderedDict([
+    ('KB', 1024), ('MB', 1024 ** 2), ('GB', 1024 ** 3),
+    ('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3), ('B', 1)])
+
+
+def parse_size(size):
+    """Parse size in bytes from ``int`` or string such as ``"256MB"``"""
+    if not isinstance(size, str):
+        return int(size)
+    value = size.strip().upper()
+    for suffix, factor in _SIZE_SUFFIXES.items():
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+class BGZFBlockCache:
+    """Cache of decompressed blocks for a BGZF-compressed ``htsFile``
+
+    The cache itself is htslib's, enabled with ``bgzf_set_cache_size()``,
+    it keeps decompressed blocks around so that nearby queries do not
+    decompress them again.  htslib does not report on its use.  Only
+    BGZF-compressed files (BAM, BCF, bgzip-compressed text) have one,
+    ``HTSException`` is raised for others, e.g. CRAM.
+    """
+
+    def __init__(self, file_ptr, cache_size):
+        if file_ptr[0].ftype.compression != _HTSCompression.BGZF:
+            tpl = 'Block cache requires a BGZF-compressed file, not {}'
+            raise HTSException(tpl.format(file_ptr[0].fn.decode('utf-8')))
+        #: size of the cache in bytes
+        self.cache_size = min(parse_size(cache_size), 2 ** 31 - 1)
+        _bgzf_set_cache_size(file_ptr[0].fp.bgzf, self.cache_size)
+
+
+#: end position used for sequences of unknown length, largest position
+#: that region strings accept
+UNKNOWN_LENGTH_END = 2 ** 31 - 1
+
+
+def shard_genome(targets, regions=None, chunk_bp=10000000):
+    """Split the genome into ``GenomeInterval`` shards of ``chunk_bp`` each
+
+    ``targets`` is a list of ``(name, length)`` pairs, a length of ``0``
+    means unknown.  ``regions`` optionally restricts the shards to the given
+    ``GenomeInterval`` objects or region strings, the default is the whole
+    genome.  The regions are sorted and overlapping ones merged with
+    ``merge_regions()`` first, so the shards do not overlap.  Open-ended
+    regions on sequences of unknown length are not split.
+    """
+    if regions is None:
+        regions = [GenomeInterval(name, 0, None) for name, _ in targets]
+    result = []
+    for region, _ in merge_regions(targets, regions):
+        end = region.end_pos
+        if end == UNKNOWN_LENGTH_END:  # unknown length, cannot split
+            result.append(region)
+            continue
+        for begin in range(region.begin_pos, end, chunk_bp):
+            result.append(GenomeInterval(region.seq, begin,
+                                         min(begin + chunk_bp, end)))
+    return result
+
+
+# index handles opened by the current (worker) process, by class, paths and
+# constructor arguments
+_WORKER_INDICES = {}
+
+
+def _close_worker_indices():
+    """Close the index handles cached in the process"""
+    while _WORKER_INDICES:
+        _, index = _WORKER_INDICES.popitem()
+        index.close()
+
+
+def _worker_index(klass, path, index_path, kwargs):
+    """Return index handle for the given file, cached in the process
+
+    The handles are closed when the process exits.
+    """
+    key = (klass, path, index_path, repr(sorted(kwargs.items())))
+    if key not in _WORKER_INDICES:
+        if not _WORKER_INDICES:
+            # run on exit of pool workers, unlike ``atexit`` handlers
+            multiprocessing.util.Finalize(
+                None, _close_worker_indices, exitpriority=10)
+        _WORKER_INDICES[key] = klass(path, index_path, **kwargs)
+    return _WORKER_INDICES[key]
+
+
+def _map_shard(index, fn, shard):
+    """Call ``fn`` on the records starting in ``shard``
+
+    Records overlapping the shard but starting left of it belong to the
+    previous shard and are skipped so each record is seen exactly once.
+    """
+    it = index.query(str(shard))
+    try:
+        return fn(shard, (record for record in it
+                          if index._record_span(record)[0] >=
+                          shard.begin_pos))
+    finally:
+        it.close()
+
+
+def _parallel_map_worker(args):
+    klass, path, index_path, kwargs, fn, shard = args
+    return _map_shard(_worker_index(klass, path, index_path, kwargs),
+                      fn, shard)
+
+
+def parallel_map(index, fn, regions=None, chunk_bp=10000000,
+                 processes=None, reduce=None):
+    """Implementation of ``parallel_map()`` of the index classes
+
+    ``fn(shard, records)`` is called for each shard in a process pool, the
+    result is the list of return values in genome order or, if ``reduce``
+    is given, these values folded with ``functools.reduce(reduce, ...)``.
+    With ``processes=1``, everything runs in the current process.  The
+    workers open the index with the same arguments as ``index``, as given
+    by its ``_worker_kwargs()``.
+    """
+    shards = shard_genome(index._targets(), regions, chunk_bp)
+    if processes == 1:
+        results = [_map_shard(index, fn, shard) for shard in shards]
+    else:
+        kwargs = index._worker_kwargs()
+        if isinstance(kwargs.get('threads'), HTSThreadPool):
+            # pools cannot be passed to other processes
+            kwargs['threads'] = kwargs['threads'].num_threads
+        tasks = [(type(index), index.path, index._index_path(), kwargs,
+                  fn, shard) for shard in shards]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_parallel_map_worker, tasks, chunksize=1)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()  # workers exit normally and close their indices
+        finally:
+            pool.join()
+    if reduce is None:
+        return results
+    else:
+        return functools.reduce(reduce, results)
+
+
+def build_many(build, paths, processes=None, **kwargs):
+    """Implementation of ``build_many()`` of the index classes
+
+    Calls ``build(path, **kwargs)`` for each of the ``paths`` in a process
+    pool and returns the list of return values, the index paths, in the
+    order of ``paths``.  With ``processes=1``, everything runs in the
+    current process.
+    """
+    fn = functools.partial(build, **kwargs)
+    if processes == 1:
+        return [fn(path) for path in paths]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(fn, paths, chunksize=1)
+
+
+def merge_regions(targets, regions):
+    """Sort and merge overlapping and adjacent regions
+
+    ``targets`` is a list of ``(name, length)`` pairs that defines the
+    sequence order.  Returns a list of ``(interval, members)`` pairs with
+    the merged ``GenomeInterval`` and a list of ``(begin_pos, end_pos,
+    region)`` triples for the given ``regions`` that were merged into it.
+    """
+    order = dict((name, i) for i, (name, _) in enumerate(targets))
+    lengths = dict(targets)
+    parsed = []
+    for region in regions:
+        interval = region
+        if not isinstance(region, GenomeInterval):
+            interval = GenomeInterval.from_str(region)
+        if interval.seq not in order:
+            tpl = 'Unknown sequence {} in region {}'
+            raise HTSException(tpl.format(interval.seq, region))
+        end = (interval.end_pos or lengths[interval.seq] or
+               UNKNOWN_LENGTH_END)
+        parsed.append((order[interval.seq], interval.begin_pos, end, region))
+    parsed.sort(key=lambda x: x[:3])
+    merged = []  # [seq index, begin, end, members]
+    for seq_idx, begin, end, region in parsed:
+        if merged and merged[-1][0] == seq_idx and begin <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+            merged[-1][3].append((begin, end, region))
+        else:
+            merged.append([seq_idx, begin, end, [(begin, end, region)]])
+    return [(GenomeInterval(targets[seq_idx][0], begin, end), members)
+            for seq_idx, begin, end, members in merged]
+
+
+#: largest gap in base pairs between regions that ``query_many()`` reads
+#: with one query, if no multi-region iterator is available
+QUERY_MANY_MAX_GAP = 16384
+
+
+def _matched_regions(spans, begin, end):
+    """Return the given regions overlapping ``[begin, end)``
+
+    ``spans`` are the merged ``(interval, members)`` pairs of one sequence
+    as returned by ``merge_regions()``, with the list of their end
+    positions as the first entry.
+    """
+    ends, merged = spans
+    matched = []
+    for interval, members in merged[bisect.bisect_right(ends, begin):]:
+        if interval.begin_pos >= end:
+            break
+        matched += [region for b, e, region in members
+                    if b < end and begin < e]
+    return matched
+
+
+def query_many(index, regions, max_gap=QUERY_MANY_MAX_GAP):
+    """Implementation of ``query_many()`` of the index classes
+
+    Yields ``(record, matched)`` pairs where ``matched`` is the list of the
+    given ``regions`` overlapping the record, each record once.  If the
+    index provides a multi-region iterator (``_query_multi()``), htslib
+    reads each block of the file once for all regions.  Otherwise, the
+    merged regions closer than ``max_gap`` base pairs are read with one
+    query, skipping the records in the gaps, so nearby regions do not
+    decompress the same blocks again.
+    """
+    merged = merge_regions(index._targets(), regions)
+    by_seq = collections.OrderedDict()
+    for interval, members in merged:
+        by_seq.setdefault(interval.seq, []).append((interval, members))
+    spans = dict((seq, ([interval.end_pos for interval, _ in items], items))
+                 for seq, items in by_seq.items())
+    it = index._query_multi([interval for interval, _ in merged])
+    if it is not None:
+        try:
+            for record in it:
+                begin, end = index._record_span(record)
+                matched = _matched_regions(spans[index._record_seq(record)],
+                                           begin, max(end, begin + 1))
+                if matched:
+                    yield record, matched
+        finally:
+            it.close()
+        return
+    for seq, items in by_seq.items():
+        # groups of merged regions that are read with one query
+        groups = []
+        for interval, _ in items:
+            if (groups and
+                    interval.begin_pos - groups[-1][1] < max_gap):
+                groups[-1][1] = interval.end_pos
+            else:
+                groups.append([interval.begin_pos, interval.end_pos])
+        prev_end = None
+        for begin_pos, end_pos in groups:
+            it = index.query(str(GenomeInterval(seq, begin_pos, end_pos)))
+            try:
+                for record in it:
+                    begin, end = index._record_span(record)
+                    if prev_end is not None and begin < prev_end:
+                        continue  # already yielded for previous query
+                    matched = _matched_regions(spans[seq], begin,
+                                               max(end, begin + 1))
+                    if matched:
+                        yield record, matched
+            finally:
+                it.close()
+            prev_end = end_pos
@@ -2,6 +2,7 @@
 """Shared htslib structs and functions"""
 
 import ctypes
+import re
 
 import pyhtslib.load_dll as pl
 
@@ -14,19 +15,30 @@ __all__ = [
     # handle to htslib
     'htslib',
     '_libc',
+    '_strdup',
     # constants (through ``#define``)
     '_HTS_IDX_NOCOOR',
     '_HTS_IDX_START',
     '_HTS_IDX_REST',
     '_HTS_IDX_NONE',
+    '_HTS_FMT_CSI',
+    '_HTS_FMT_BAI',
+    '_HTS_FMT_TBI',
+    '_BGZF_MAX_BLOCK_SIZE',
+    '_BGZF_LAYOUT_KNOWN',
+    '_HTSLIB_VERSION',
     # htslib types
     '_BGZF',
+    '_BGZF_1_2',
+    '_BGZF_1_4',
+    '_hts_pos_t',
     '_cram_fd',
     '_hFILE',
     '_htsFormat',
     '_htsFile',
     '_hts_idx_t',
     '_hts_itr_t',
+    '_htsThreadPool',
     # klib types
     '_kstring_t',
     '_KS_SEP_SPACE',
@@ -34,15 +46,34 @@ __all__ = [
     '_KS_SEP_LINE',
     '_KS_SEP_MAX',
     # htslib functions
+    '_optional_function',
     '_bgzf_is_bgzf',
+    '_bgzf_mt',
+    '_bgzf_set_cache_size',
+    '_bgzf_write',
+    '_bgzf_flush',
+    '_bgzf_tell',
+    '_bgzf_idx_push',
     '_hts_open',
     '_hts_close',
     '_hts_getline',
+    '_hts_version',
     '_hts_idx_destroy',
+    '_hts_idx_init',
+    '_hts_idx_push',
+    '_hts_idx_finish',
+    '_hts_idx_set_meta',
+    '_hts_idx_save',
+    '_hts_idx_amend_last',
     '_hts_itr_destroy',
     '_hts_itr_next',
+    '_hts_itr_multi_next',
     '_hts_itr_query',
     '_hts_itr_querys',
+    '_hts_set_threads',
+    '_hts_set_thread_pool',
+    '_hts_tpool_init',
+    '_hts_tpool_destroy',
     '_tbx_readrec',
     # wrapper Types
     '_HTSFormatCategory',
@@ -54,18 +85,131 @@ __all__ = [
 htslib = pl.load_htslib()
 _libc = pl.load_libc()
 
+# ``strdup()`` from libc, for strings that are freed by htslib
+_strdup = _libc.strdup
+_strdup.restype = ctypes.c_void_p
+
+
+def _optional_function(name, restype):
+    """Return htslib function ``name`` or ``None`` if not exported
+
+    Used for functions that are only available in later htslib versions.
+    """
+    func = getattr(htslib, name, None)
+    if func is not None:
+        func.restype = restype
+    return func
+
 _bgzf_is_bgzf = htslib.bgzf_is_bgzf
 _bgzf_is_bgzf.restype = ctypes.c_int
 
+_bgzf_mt = htslib.bgzf_mt
+_bgzf_mt.restype = ctypes.c_int
+
+_bgzf_set_cache_size = htslib.bgzf_set_cache_size
+_bgzf_set_cache_size.restype = None
+
+_bgzf_write = htslib.bgzf_write
+_bgzf_write.restype = ctypes.c_ssize_t
+
+_bgzf_flush = htslib.bgzf_flush
+_bgzf_flush.restype = ctypes.c_int
+
+
+def _bgzf_tell(fp):
+    """Replacement for C macro ``bgzf_tell()``, returns virtual offset
+
+    Only valid if ``_BGZF_LAYOUT_KNOWN``.
+    """
+    return (fp[0].block_address << 16) | (fp[0].block_offset & 0xFFFF)
+
 
 _HTS_IDX_NOCOOR = -2
 _HTS_IDX_START = -3
 _HTS_IDX_REST = -4
 _HTS_IDX_NONE = -5
 
+_HTS_FMT_CSI = 0
+_HTS_FMT_BAI = 1
+_HTS_FMT_TBI = 2
+
+_BGZF_MAX_BLOCK_SIZE = 0x10000
+
+
+_hts_version = htslib.hts_version
+_hts_version.restype = ctypes.c_char_p
+
+
+def _parse_htslib_version(version):
+    """Return ``(major, minor)`` from htslib version string, ``None`` if the
+    string cannot be parsed
+    """
+    match = re.match(r'(\d+)\.(\d+)', version.decode('ascii', 'replace'))
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+#: ``(major, minor)`` version of the loaded htslib, ``None`` if unknown
+_HTSLIB_VERSION = _parse_htslib_version(_hts_version())
+
+
+class _BGZF_1_2(ctypes.Structure):
+    """Type for representing a bgzip-compressed file, htslib < 1.4
+
+    Only the leading members are declared, the structure is only accessed
+    through pointers.
+    """
 
-class _BGZF(ctypes.Structure):
-    """Type for representing a bgzip-compressed file"""
+    _fields_ = [('errcode', ctypes.c_uint, 16),
+                ('is_write', ctypes.c_uint, 2),
+                ('is_be', ctypes.c_uint, 2),
+                ('compress_level', ctypes.c_int, 9),
+                ('is_compressed', ctypes.c_uint, 2),
+                ('is_gzip', ctypes.c_uint, 1),
+                ('cache_size', ctypes.c_int),
+                ('block_length', ctypes.c_int),
+                ('block_offset', ctypes.c_int),
+                ('block_address', ctypes.c_int64),
+                ('uncompressed_address', ctypes.c_int64)]
+
+
+class _BGZF_1_4(ctypes.Structure):
+    """Type for representing a bgzip-compressed file, htslib >= 1.4
+
+    Only the leading members are declared, the structure is only accessed
+    through pointers.
+    """
+
+    _fields_ = [('errcode', ctypes.c_uint, 16),
+                ('reserved', ctypes.c_uint, 1),
+                ('is_write', ctypes.c_uint, 1),
+                ('no_eof_block', ctypes.c_uint, 1),
+                ('is_be', ctypes.c_uint, 1),
+                ('compress_level', ctypes.c_int, 9),
+                ('last_block_eof', ctypes.c_uint, 1),
+                ('is_compressed', ctypes.c_uint, 1),
+                ('is_gzip', ctypes.c_uint, 1),
+                ('cache_size', ctypes.c_int),
+                ('block_length', ctypes.c_int),
+                ('block_clength', ctypes.c_int),
+                ('block_offset', ctypes.c_int),
+                ('block_address', ctypes.c_int64),
+                ('uncompressed_address', ctypes.c_int64)]
+
+
+#: whether or not the layout of ``BGZF`` is known for the loaded htslib,
+#: the members of ``_BGZF`` must not be read otherwise
+_BGZF_LAYOUT_KNOWN = _HTSLIB_VERSION is not None
+if _HTSLIB_VERSION is not None and _HTSLIB_VERSION < (1, 4):
+    _BGZF = _BGZF_1_2
+else:
+    _BGZF = _BGZF_1_4
+
+#: type of positions in the index functions, ``hts_pos_t`` since htslib 1.10
+_hts_pos_t = ctypes.c_int
+if _HTSLIB_VERSION is not None and _HTSLIB_VERSION >= (1, 10):
+    _hts_pos_t = ctypes.c_int64
 
 
 class _cram_fd(ctypes.Structure):
@@ -96,6 +240,10 @@ class _kstring_t(ctypes.Structure):
     def s(self):
         return ctypes.cast(self.p, ctypes.c_char_p).value
 
+    def to_bytes(self):
+        """Return the ``l`` bytes of the string, copied by length"""
+        return ctypes.string_at(self.p, self.l)
+
     def free_p(self):
         _libc.free(self.p)
 
@@ -236,6 +384,13 @@ class _hts_itr_t(ctypes.Structure):
     """Generic type for htslib iterator types"""
 
 
+class _htsThreadPool(ctypes.Structure):
+    """Wrapper for htslib type htsThreadPool (htslib >= 1.4)"""
+
+    _fields_ = [('pool', ctypes.c_void_p),
+                ('qsize', ctypes.c_int)]
+
+
 _hts_open = htslib.hts_open
 _hts_open.restype = ctypes.POINTER(_htsFile)
 
@@ -248,18 +403,49 @@ _hts_getline.restype = ctypes.c_int
 _hts_idx_destroy = htslib.hts_idx_destroy
 _hts_idx_destroy.restype = None
 
+# the offsets are ``uint64_t`` and have to be passed as ``c_uint64``
+_hts_idx_init = htslib.hts_idx_init
+_hts_idx_init.restype = ctypes.POINTER(_hts_idx_t)
+
+_hts_idx_push = htslib.hts_idx_push
+_hts_idx_push.restype = ctypes.c_int
+
+_hts_idx_finish = htslib.hts_idx_finish
+_hts_idx_finish.restype = None
+
+_hts_idx_set_meta = htslib.hts_idx_set_meta
+_hts_idx_set_meta.restype = None
+
+_hts_idx_save = htslib.hts_idx_save
+_hts_idx_save.restype = None
+
+# indexing of multi-threaded BGZF output, only available in htslib >= 1.10
+_bgzf_idx_push = _optional_function('bgzf_idx_push', ctypes.c_int)
+_hts_idx_amend_last = _optional_function('hts_idx_amend_last', None)
+
 _hts_itr_destroy = htslib.hts_itr_destroy
 _hts_itr_destroy.restype = None
 
 _hts_itr_next = htslib.hts_itr_next
 _hts_itr_next.restype = ctypes.c_int
 
+# for multi-region iterators, only available in htslib >= 1.7
+_hts_itr_multi_next = _optional_function('hts_itr_multi_next', ctypes.c_int)
+
 _hts_itr_query = htslib.hts_itr_query
 _hts_itr_query.restype = ctypes.POINTER(_hts_itr_t)
 
 _hts_itr_querys = htslib.hts_itr_querys
 _hts_itr_querys.restype = ctypes.POINTER(_hts_itr_t)
 
+_hts_set_threads = _optional_function('hts_set_threads', ctypes.c_int)
+
+# thread pools, only available in htslib >= 1.4
+_hts_set_thread_pool = _optional_function('hts_set_thread_pool',
+                                          ctypes.c_int)
+_hts_tpool_init = _optional_function('hts_tpool_init', ctypes.c_void_p)
+_hts_tpool_destroy = _optional_function('hts_tpool_destroy', None)
+
 
 _tbx_name2id = htslib.tbx_name2id
 _tbx_name2id.restype = ctypes.c_int
@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 """Wrapper for accessing tabix-indexed files"""
 
+import array
+import collections
 import ctypes
 import logging
 import os
 import os.path
+import re
+import struct
 
+from pyhtslib.hts import (
+    QUERY_MANY_MAX_GAP, BGZFBlockCache, HTSThreadPool, parallel_map,
+    query_many, require_numpy, set_threads)
 from pyhtslib.hts_internal import *  # NOQA
 from pyhtslib.tabix_internal import *  # NOQA
 
 __author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
 
 
+#: regular expression for the ``END`` key of the VCF ``INFO`` column
+_VCF_INFO_END = re.compile(r'(?:^|;)END=(\d+)')
+#: regular expression for SAM CIGAR operations
+_SAM_CIGAR_OP = re.compile(r'(\d+)([MIDNSHP=X])')
+
+
 class TabixIndexException(Exception):
     """Raised when there is a problem with a TabixIndex file"""
 
@@ -62,6 +75,7 @@ class TabixConfig:
         self.begin_col = begin_col
         self.end_col = end_col
         self.meta_char = meta_char
+        self.line_skip = line_skip
         self.min_shift = min_shift
 
     def to_c_struct(self):
@@ -72,6 +86,7 @@ class TabixConfig:
         res.bc = self.begin_col
         res.ec = self.end_col
         res.meta_char = self.meta_char
+        res.line_skip = self.line_skip
         return res
 
 
@@ -82,13 +97,189 @@ TBX_CONF_SAM = TabixConfig.from_c_struct('tbx_conf_sam')
 TBX_CONF_VCF = TabixConfig.from_c_struct('tbx_conf_vcf')
 
 
+def _line_span(preset, begin_col, end_col, fields):
+    """Return zero-based ``(begin_pos, end_pos)`` of line split into ``fields``
+
+    Follows the rules that ``tbx_parse1()`` uses for computing the end
+    position when indexing, the columns are 1-based.
+    """
+    begin_pos = int(fields[begin_col - 1])
+    if not preset & _TBX_UCSC:
+        begin_pos -= 1
+    preset = preset & 0xffff
+    if preset == _TBX_VCF:
+        end = _VCF_INFO_END.search(fields[7]) if len(fields) > 7 else None
+        if end:
+            return begin_pos, int(end.group(1))
+        return begin_pos, begin_pos + len(fields[3])
+    elif preset == _TBX_SAM:
+        ref_len = sum(int(n) for n, op in _SAM_CIGAR_OP.findall(fields[5])
+                      if op in 'MDN=X')
+        return begin_pos, begin_pos + max(ref_len, 1)
+    elif end_col:
+        return begin_pos, int(fields[end_col - 1])
+    else:
+        return begin_pos, begin_pos + 1
+
+
+def _column_to_array(values, type_):
+    """Convert ``bytes`` column ``values`` to ``type_`` in one pass"""
+    if type_ is int:
+        return array.array('q', map(int, values))
+    elif type_ is float:
+        return array.array('d', map(float, values))
+    elif type_ is str:
+        return [value.decode('utf-8') for value in values]
+    else:
+        return values
+
+
+def _column_to_numpy(values, type_):
+    """Convert ``bytes`` column ``values`` to NumPy array of ``type_``
+
+    The numbers are parsed by NumPy when casting from the ``bytes`` array.
+    """
+    np = require_numpy(TabixIndexException)
+    arr = np.array(values, dtype=bytes)
+    if type_ is int:
+        return arr.astype(np.int64)
+    elif type_ is float:
+        return arr.astype(np.float64)
+    elif type_ is str:
+        return np.char.decode(arr, 'utf-8')
+    else:
+        return arr
+
+
+#: types supported by ``TabixIndex.query_columns()``
+TABIX_COLUMN_TYPES = (str, int, float, bytes)
+
+
+class TabixColumnBatchIter:
+    """Iterate over query results in batches of typed columns
+
+    Do not use directly but through ``TabixIndex.query_columns()``.  Each
+    batch is an ``OrderedDict`` mapping the 0-based column numbers to their
+    values.  The lines of a batch are copied into one buffer that is split
+    into fields at once and each column is converted as a whole.
+    """
+
+    def __init__(self, index, struct_ptr, columns, batch_size, as_numpy):
+        #: the ``TabixIndex`` that is queried
+        self.index = index
+        #: pointer to the htslib iterator
+        self.struct_ptr = struct_ptr
+        #: ``OrderedDict`` mapping 0-based column numbers to types
+        self.columns = collections.OrderedDict(sorted(columns.items()))
+        #: maximal number of lines in a batch
+        self.batch_size = batch_size
+        #: whether or not to return NumPy arrays
+        self.as_numpy = as_numpy
+        self._convert = _column_to_numpy if as_numpy else _column_to_array
+        self._buffer = _kstring_t(0, 0, None)
+
+    def __iter__(self):
+        return self
+
+    def _read_batch(self):
+        """Return ``(data, num)`` with up to ``batch_size`` lines
+
+        The ``num`` lines are copied from the htslib buffer into the
+        ``bytes`` object ``data``, separated by line breaks.  As htslib
+        returns one line at a time, this is still one Python-level step per
+        line, only the splitting and conversion work on the whole batch.
+        """
+        data = bytearray()
+        num = 0
+        buf = self._buffer
+        while num < self.batch_size:
+            r = _tbx_itr_next(self.index.file.struct_ptr,
+                              self.index.struct_ptr, self.struct_ptr,
+                              ctypes.byref(buf))
+            if r < 0:
+                self.close()
+                if r < -1:
+                    tpl = 'Could not read from {}'
+                    raise TabixIndexException(tpl.format(self.index.path))
+                break  # end of query results
+            if num:
+                data += b'\n'
+            data += (ctypes.c_char * buf.l).from_address(buf.p)
+            num += 1
+        return bytes(data), num
+
+    def _split_columns(self, data, num):
+        """Return ``dict`` with the ``bytes`` fields of each column
+
+        If all lines have the same number of fields then the fields of a
+        column are a slice of all fields of the batch, otherwise the lines
+        are split one by one.
+        """
+        lines = data.split(b'\n')
+        num_fields = lines[0].count(b'\t') + 1
+        if all(line.count(b'\t') == num_fields - 1 for line in lines):
+            fields = data.replace(b'\n', b'\t').split(b'\t')
+            columns = {col: fields[col::num_fields]
+                       for col in self.columns if col < num_fields}
+        else:
+            rows = [line.split(b'\t') for line in lines]
+            columns = {col: [row[col] for row in rows]
+                       for col in self.columns
+                       if all(len(row) > col for row in rows)}
+        for col in self.columns:
+            if col not in columns:
+                tpl = 'Line without column {} in {}'
+                raise TabixIndexException(tpl.format(col, self.index.path))
+        return columns
+
+    def __next__(self):
+        if not self.struct_ptr:
+            raise StopIteration()
+        data, num = self._read_batch()
+        if not num:
+            raise StopIteration()
+        columns = self._split_columns(data, num)
+        result = collections.OrderedDict()
+        for col, type_ in self.columns.items():
+            try:
+                result[col] = self._convert(columns[col], type_)
+            except ValueError as e:
+                tpl = 'Could not convert column {} to {}: {}'
+                raise TabixIndexException(tpl.format(
+                    col, type_.__name__, e))
+        return result
+
+    def close(self):
+        """Free all associated resources
+
+        This function is idempotent.
+        """
+        if self.struct_ptr:
+            _hts_itr_destroy(self.struct_ptr)
+            self.struct_ptr = None
+        if self._buffer:
+            self._buffer.free_p()
+            self._buffer = None
+
+
+def _buffer_line(buf, raw):
+    """Return line from ``_kstring_t`` ``buf``, as ``bytes`` if ``raw``"""
+    line = buf.to_bytes()
+    return line if raw else line.decode('utf-8')
+
+
 class NormalTabixFileIter:
-    """Allows iteration over tabix files after querying"""
+    """Allows iteration over tabix files after querying
+
+    Yields the lines as ``str`` or, if ``raw`` is true, as ``bytes`` that
+    are not decoded.
+    """
 
-    def __init__(self, index, struct_ptr):
+    def __init__(self, index, struct_ptr, raw=False):
         self.index = index
         self.struct_ptr = struct_ptr
         self.struct = self.struct_ptr[0]
+        self.raw = raw
         self._buffer = _kstring_t(0, 0, None)
 
     def __iter__(self):
@@ -97,7 +288,7 @@ class NormalTabixFileIter:
     def __next__(self):
         if _tbx_itr_next(self.index.file.struct_ptr, self.index.struct_ptr,
                          self.struct_ptr, ctypes.byref(self._buffer)) >= 0:
-            return self._buffer.s.decode('utf-8')
+            return _buffer_line(self._buffer, self.raw)
         else:
             self.close()
             if self._buffer:
@@ -119,59 +310,64 @@ class NormalTabixFileIter:
 
 
 class AllTabixFileIter:
-    """Allows iteration over the whole tabix file"""
+    """Allows iteration over the whole tabix file
 
-    def __init__(self, index):
+    The file is read sequentially from the start with ``hts_getline()``,
+    without using the index, through a ``TabixFile`` of its own with the
+    threads of the index's file.  Meta lines and the first ``line_skip``
+    lines are skipped.  Yields the lines as ``str`` or, if ``raw`` is true,
+    as ``bytes``.
+    """
+
+    def __init__(self, index, raw=False):
         self.index = index
+        self.raw = raw
+        #: the ``TabixFile`` that is read
+        self.file = TabixFile(index.path, index.file.threads)
+        self.file.open()
+        #: number of the current line, including skipped ones
+        self.lineno = 0
+        conf = index.struct.conf
+        self._seq_col = conf.sc
+        self._meta_char = conf.meta_char
+        self._line_skip = conf.line_skip
         self._buffer = _kstring_t(0, 0, None)
-        self.current_chrom = iter(self._fetch_chroms())
-        seq = next(self.current_chrom)
-        self.struct_ptr = _tbx_itr_querys(self.index.struct_ptr, seq)
-        self.struct = self.struct_ptr[0]
+        self._line = None
 
     def __iter__(self):
         return self
 
-    def _fetch_chroms(self):
-        nseq = ctypes.c_int()
-        seq = _tbx_seqnames(self.index.struct_ptr, ctypes.byref(nseq))
-        result = [seq[i] for i in range(nseq.value)]
-        _libc.free(seq)
-        return result
+    @property
+    def chrom(self):
+        """Sequence name of the line returned last, ``None`` before"""
+        if self._line is None:
+            return None
+        fields = self._line.split(b'\t', self._seq_col)
+        return fields[self._seq_col - 1].decode('utf-8')
 
     def __next__(self):
-        if not self.current_chrom:
+        if not self._buffer:
             raise StopIteration()
-        if _tbx_itr_next(self.index.file.struct_ptr, self.index.struct_ptr,
-                         self.struct_ptr, ctypes.byref(self._buffer)) >= 0:
-            return self._buffer.s.decode('utf-8')
-        else:
-            while True:
-                try:
-                    seq = next(self.current_chrom)
-                    _tbx_itr_destroy(self.struct_ptr)
-                    self.struct_ptr = _tbx_itr_querys(
-                        self.index.struct_ptr, seq)
-                    self.struct = self.struct_ptr[0]
-                    if _tbx_itr_next(self.index.file.struct_ptr,
-                                     self.index.struct_ptr,
-                                     self.struct_ptr,
-                                     ctypes.byref(self._buffer)) >= 0:
-                        return self._buffer.s.decode('utf-8')
-                except StopIteration:
-                    self.close()
-                    raise StopIteration()
+        buf = self._buffer
+        while _hts_getline(self.file.struct_ptr, _KS_SEP_LINE,
+                           ctypes.byref(buf)) >= 0:
+            self.lineno += 1
+            if self.lineno <= self._line_skip:
+                continue
+            line = buf.to_bytes()
+            if not line or line[0] == self._meta_char:
+                continue  # empty or meta line
+            self._line = line
+            return line if self.raw else line.decode('utf-8')
+        self.close()
+        raise StopIteration()
 
     def close(self):
         """Free resources associated with the iterator
 
         This function is idempotent.
         """
-        self.current_chrom = None
-        if self.struct_ptr:
-            _tbx_itr_destroy(self.struct_ptr)
-            self.struct_ptr = None
-            self.struct = None
+        self.file.close()
         if self._buffer:
             self._buffer.free_p()
             self._buffer = None
@@ -180,9 +376,11 @@ class AllTabixFileIter:
 class TabixFile:
     """Tabix file"""
 
-    def __init__(self, path):
+    def __init__(self, path, threads=1):
         #: path to the indexed file
         self.path = path
+        #: number of decompression threads or ``HTSThreadPool``
+        self.threads = threads
         #: wrapped C struct
         self.struct = None
         #: pointer to C struct
@@ -198,6 +396,7 @@ class TabixFile:
             tpl = 'Opening tabix file {} failed'
             raise TabixFileException(tpl.format(self.path))
         self.struct = self.struct_ptr[0]
+        set_threads(self.struct_ptr, self.threads)
 
     def close(self):
         """Free all associated resources
@@ -229,7 +428,8 @@ class TabixIndex:
         Otherwise, it is built at ``${path}.tbi``.
 
         If ``min_shift`` and ``config`` are both not given (``None``) then
-        we attempt to recognize it from the file format.
+        we attempt to recognize it from the file format.  Raises
+        ``TabixIndexException`` if htslib could not build the index.
         """
         # auto-build configuration if necessary
         config = config or TabixConfig.from_extension(path)
@@ -238,15 +438,19 @@ class TabixIndex:
                                       'not recognize the file type')
         # build tabix index
         if tbi_path:
-            _tbx_index_build2(path.encode('utf-8'), tbi_path.encode('utf-8'),
-                              config.min_shift,
-                              ctypes.byref(config.to_c_struct()))
+            res = _tbx_index_build2(
+                path.encode('utf-8'), tbi_path.encode('utf-8'),
+                config.min_shift, ctypes.byref(config.to_c_struct()))
         else:
-            _tbx_index_build(path.encode('utf-8'), config.min_shift,
-                             ctypes.byref(config.to_c_struct()))
+            res = _tbx_index_build(path.encode('utf-8'), config.min_shift,
+                                   ctypes.byref(config.to_c_struct()))
+        if res != 0:
+            tpl = 'Could not build tabix index for {} ({})'
+            raise TabixIndexException(tpl.format(path, res))
 
     def __init__(self, path, tbi_path=None, require_index=False,
-                 auto_load=True, auto_build=True):
+                 auto_load=True, auto_build=True, threads=1,
+                 cache_size=None):
         #: path to indexed file
         self.path = path
         #: path to index file
@@ -260,8 +464,12 @@ class TabixIndex:
         self.auto_build = auto_build
 
         #: the ``TabixFile`` to use for reading
-        self.file = TabixFile(self.path)
+        self.file = TabixFile(self.path, threads)
         self.file.open()
+        #: ``BGZFBlockCache`` if ``cache_size`` is given, else ``None``
+        self.cache = None
+        if cache_size:
+            self.cache = BGZFBlockCache(self.file.struct_ptr, cache_size)
 
         #: wrapped C struct
         self.struct = None
@@ -324,8 +532,8 @@ class TabixIndex:
         buf.free_p()
         return ''.join(result)
 
-    # TODO(holtgrewe): fix exception display if not region_string
-    def query(self, region_str=None, seq=None, begin=None, end=None):
+    def _query_itr(self, region_str=None, seq=None, begin=None, end=None):
+        """Return pointer to htslib iterator for the given region"""
         if (region_str is None and
                 (seq is None or begin is None or end is None)):
             raise TabixIndexException(
@@ -338,16 +546,100 @@ class TabixIndex:
         if not ptr:
             tpl = 'Could not jump to {}'
             raise TabixIndexException(tpl.format(region_str))
-        self.iterators.append(NormalTabixFileIter(self, ptr))
+        return ptr
+
+    # TODO(holtgrewe): fix exception display if not region_string
+    def query(self, region_str=None, seq=None, begin=None, end=None,
+              raw=False):
+        """Iterate over the lines overlapping the given region
+
+        The lines are ``str`` or, if ``raw`` is true, ``bytes`` that are
+        not decoded.
+        """
+        ptr = self._query_itr(region_str, seq, begin, end)
+        self.iterators.append(NormalTabixFileIter(self, ptr, raw))
+        return self.iterators[-1]
+
+    def query_columns(self, region_str, columns, batch_size=65536,
+                      as_numpy=False):
+        """Query ``region_str`` and iterate over batches of typed columns
+
+        ``columns`` maps 0-based column numbers to one of the types from
+        ``TABIX_COLUMN_TYPES``, e.g. ``{0: str, 1: int, 2: int}`` for the
+        first three columns of a BED file.  Each batch is an
+        ``OrderedDict`` of ``array.array`` (numbers) and ``list`` (strings)
+        columns or, with ``as_numpy``, NumPy arrays.
+        """
+        for type_ in columns.values():
+            if type_ not in TABIX_COLUMN_TYPES:
+                tpl = 'Invalid column type {}, must be one of {}'
+                raise TabixIndexException(tpl.format(type_, ', '.join(
+                    t.__name__ for t in TABIX_COLUMN_TYPES)))
+        if as_numpy:
+            require_numpy(TabixIndexException)
+        ptr = self._query_itr(region_str)
+        self.iterators.append(TabixColumnBatchIter(
+            self, ptr, columns, batch_size, as_numpy))
         return self.iterators[-1]
 
-    def from_start(self):
-        self.iterators.append(AllTabixFileIter(self))
+    def from_start(self, raw=False):
+        """Iterate over all lines, as ``str`` or, if ``raw``, ``bytes``
+
+        The file is read sequentially, so also lines not covered by the
+        index are returned.  The sequence of the current line is available
+        as ``chrom`` of the returned ``AllTabixFileIter``.
+        """
+        self.iterators.append(AllTabixFileIter(self, raw))
         return self.iterators[-1]
 
     def __iter__(self):
         return iter(self.from_start())
 
+    def query_many(self, regions, max_gap=QUERY_MANY_MAX_GAP):
+        """Query many regions at once, yields ``(line, matched)`` pairs
+
+        Works as ``BAMIndex.query_many()``, regions less than ``max_gap``
+        base pairs apart are read with one query.  The overlap of lines and
+        regions is computed from the columns given by the tabix
+        configuration.
+        """
+        return query_many(self, regions, max_gap)
+
+    def _query_multi(self, intervals):
+        return None  # no multi-region iterator for tabix
+
+    def parallel_map(self, fn, regions=None, chunk_bp=10000000,
+                     processes=None, reduce=None):
+        """Call ``fn(shard, lines)`` for genome shards in a process pool
+
+        Works as ``BAMIndex.parallel_map()``.  The index does not know the
+        sequence lengths, so each sequence is one shard unless ``regions``
+        are given.  Lines are attributed by the begin column of the tabix
+        configuration.
+        """
+        return parallel_map(self, fn, regions, chunk_bp, processes, reduce)
+
+    def _targets(self):
+        """Return list of ``(name, length)`` pairs for sharding"""
+        nseq = ctypes.c_int()
+        seqs = _tbx_seqnames(self.struct_ptr, ctypes.byref(nseq))
+        result = [(seqs[i].decode('utf-8'), 0) for i in range(nseq.value)]
+        _libc.free(seqs)
+        return result
+
+    def _index_path(self):
+        return self.tbi_path
+
+    def _worker_kwargs(self):
+        """Return arguments for opening this index in worker processes"""
+        return {'threads': self.file.threads,
+                'cache_size': self.cache.cache_size if self.cache else None}
+
+    def _record_span(self, line):
+        """Return zero-based ``(begin_pos, end_pos)`` of the given line"""
+        conf = self.struct.conf
+        return _line_span(conf.preset, conf.bc, conf.ec, line.split('\t'))
+
     def load(self):
         self.close(close_file=False)
         if self.tbi_path:
@@ -380,3 +672,243 @@ class TabixIndex:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close(close_file=True)
+
+
+class TabixWriter:
+    """Write bgzip-compressed, tab-separated files with their tabix index
+
+    The lines must be sorted by sequence and begin position.  ``config`` is
+    the ``TabixConfig`` for indexing, by default chosen from the extension
+    of ``path``.  Unless ``index`` is false, the index is built while
+    writing, from the positions of the lines in the compressed output, and
+    written to ``index_path``, by default ``${path}.tbi`` or, if
+    ``config.min_shift`` is set, ``${path}.csi``.  Lines starting with the
+    configured meta character and the first ``line_skip`` lines are written
+    but not indexed.
+
+    ``threads`` is the number of compression threads or a
+    ``HTSThreadPool``.  Indexing the output of more than one thread
+    requires htslib >= 1.10 (``bgzf_idx_push()``), ``TabixIndexException``
+    is raised with older versions.
+    """
+
+    #: largest shift of the CSI binning, ``TBX_MAX_SHIFT`` in htslib
+    MAX_SHIFT = 31
+
+    def __init__(self, path, config=None, threads=1, level=None,
+                 index_path=None, index=True):
+        #: path to the file to write
+        self.path = path
+        #: ``TabixConfig`` for indexing
+        self.config = config or TabixConfig.from_extension(path)
+        #: number of compression threads or ``HTSThreadPool``
+        self.threads = threads
+        #: compression level, ``None`` for the default
+        self.level = level
+        #: whether or not to build the index
+        self.index = index
+        #: path to the index file to write
+        self.index_path = index_path or path + (
+            '.csi' if self.config.min_shift else '.tbi')
+        # whether or not compressing with more than one thread
+        self._threaded = (isinstance(threads, HTSThreadPool) or
+                          bool(threads and threads > 1))
+        if index:
+            version = _hts_version().decode('ascii', 'replace')
+            if not _BGZF_LAYOUT_KNOWN:
+                # the offsets would be read from the wrong struct members
+                raise TabixIndexException(
+                    'Cannot index while writing, unknown BGZF layout of '
+                    'htslib {}'.format(version))
+            if self._threaded and not _bgzf_idx_push:
+                raise TabixIndexException(
+                    'Indexing while writing with threads requires htslib '
+                    '>= 1.10, found {}; use threads=1 or index=False'.format(
+                        version))
+        #: wrapped C struct
+        self.struct = None
+        #: pointer to C struct
+        self.struct_ptr = None
+        # pointer to the ``BGZF`` struct of the file
+        self._bgzf = None
+        # index under construction, created with the first indexed line
+        self._idx = None
+        # numeric ids of the sequence names, in order of appearance
+        self._tids = collections.OrderedDict()
+        # number of lines written, sequence id and begin position of the
+        # last indexed line
+        self._lineno = 0
+        self._last = (-1, -1)
+
+    def open(self):
+        """Open file for writing"""
+        if self.struct_ptr:
+            return  # already open
+        mode = 'wz' + ('' if self.level is None else str(self.level))
+        self.struct_ptr = _hts_open(self.path.encode('utf-8'),
+                                    mode.encode('ascii'))
+        if not self.struct_ptr:
+            tpl = 'Could not open file {} for writing'
+            raise TabixFileException(tpl.format(self.path))
+        self.struct = self.struct_ptr[0]
+        self._bgzf = _hts_get_bgzfp(self.struct_ptr)
+        try:
+            set_threads(self.struct_ptr, self.threads)
+        except Exception:
+            self.close()
+            raise
+
+    def _index_fmt(self):
+        """Return ``(fmt, min_shift, n_lvls)`` for ``hts_idx_init()``"""
+        min_shift = self.config.min_shift
+        if min_shift:
+            return (_HTS_FMT_CSI, min_shift,
+                    (TabixWriter.MAX_SHIFT - min_shift + 2) // 3)
+        else:
+            return _HTS_FMT_TBI, 14, 5
+
+    def _tell(self):
+        """Return virtual offset of the current position
+
+        With threads, the block addresses are only known after flushing.
+        """
+        if self._threaded:
+            _bgzf_flush(self._bgzf)
+        return _bgzf_tell(self._bgzf)
+
+    def _init_index(self):
+        """Create the index, before the first indexed line is written"""
+        fmt, min_shift, n_lvls = self._index_fmt()
+        self._idx = _hts_idx_init(0, fmt, ctypes.c_uint64(self._tell()),
+                                  min_shift, n_lvls)
+        if not self._idx:
+            raise TabixIndexException('Could not create index')
+
+    def _is_meta(self, line):
+        """Return whether the next line to write is not indexed"""
+        conf = self.config
+        return (self._lineno < conf.line_skip or
+                line[:1] == chr(conf.meta_char))
+
+    def write(self, line):
+        """Write one line, given without or with trailing line break"""
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\n')
+        indexed = self.index and not self._is_meta(line)
+        if indexed and not self._idx:
+            self._init_index()
+        data = (line + '\n').encode('utf-8')
+        if _bgzf_write(self._bgzf, data, len(data)) != len(data):
+            tpl = 'Could not write to {}'
+            raise TabixFileException(tpl.format(self.path))
+        self._lineno += 1
+        if indexed:
+            self._push(line)
+
+    def write_many(self, lines):
+        """Write all lines from the iterable ``lines``
+
+        Returns the number of lines written.
+        """
+        num = 0
+        for line in lines:
+            self.write(line)
+            num += 1
+        return num
+
+    def _push(self, line):
+        """Add the line just written to the index
+
+        With threads, ``bgzf_idx_push()`` queues the line and htslib
+        resolves its offset when the block has been compressed, only the
+        offset within the block is used.
+        """
+        conf = self.config
+        fields = line.split('\t')
+        seq = fields[conf.seq_col - 1]
+        tid = self._tids.setdefault(seq, len(self._tids))
+        begin_pos, end_pos = _line_span(conf.preset, conf.begin_col,
+                                        conf.end_col, fields)
+        if (tid, begin_pos) < self._last:
+            tpl = 'Line {} of {} is not sorted: {}'
+            raise TabixIndexException(tpl.format(
+                self._lineno, self.path, line))
+        self._last = (tid, begin_pos)
+        offset = ctypes.c_uint64(_bgzf_tell(self._bgzf))
+        if self._threaded:
+            res = _bgzf_idx_push(self._bgzf, self._idx, tid,
+                                 _hts_pos_t(begin_pos), _hts_pos_t(end_pos),
+                                 offset, 1)
+        else:
+            res = _hts_idx_push(self._idx, tid, _hts_pos_t(begin_pos),
+                                _hts_pos_t(end_pos), offset, 1)
+        if res < 0:
+            tpl = 'Could not index line {} of {}'
+            raise TabixIndexException(tpl.format(self._lineno, self.path))
+
+    def _index_meta(self):
+        """Return the tabix meta data stored in the index
+
+        The configuration followed by the sequence names, as written by
+        ``tbx_set_meta()``.
+        """
+        names = b''.join(name.encode('utf-8') + b'\0' for name in self._tids)
+        conf = self.config
+        return struct.pack('<7i', conf.preset, conf.seq_col, conf.begin_col,
+                           conf.end_col, conf.meta_char, conf.line_skip,
+                           len(names)) + names
+
+    def _finish_index(self):
+        """Finish the index built while writing, before closing the file"""
+        if not self._idx:
+            self._init_index()  # no lines were indexed
+        _bgzf_flush(self._bgzf)  # also waits for the compression threads
+        offset = ctypes.c_uint64(_bgzf_tell(self._bgzf))
+        if _hts_idx_amend_last:
+            _hts_idx_amend_last(self._idx, offset)
+        _hts_idx_finish(self._idx, offset)
+        meta = self._index_meta()
+        _hts_idx_set_meta(self._idx, len(meta), meta, 1)
+
+    def _save_index(self):
+        """Save the finished index, after closing the file"""
+        fmt = self._index_fmt()[0]
+        _hts_idx_save(self._idx, self.path.encode('utf-8'), fmt)
+        default_path = self.path + ('.csi' if fmt == _HTS_FMT_CSI else '.tbi')
+        if self.index_path != default_path:
+            os.replace(default_path, self.index_path)
+
+    def close(self):
+        """Close file, flushing all data, and write the index
+
+        The index is written after the file so it is not older than the
+        file.  This function is idempotent.
+        """
+        if not self.struct_ptr:
+            return  # not open
+        try:
+            try:
+                if self.index:
+                    self._finish_index()
+            finally:
+                res = _hts_close(self.struct_ptr)
+                self.struct_ptr = None
+                self.struct = None
+                self._bgzf = None
+            if res != 0:
+                tpl = 'Problem closing file {}'
+                raise TabixFileException(tpl.format(self.path))
+            if self.index:
+                self._save_index()
+        finally:
+            if self._idx:
+                _hts_idx_destroy(self._idx)
+                self._idx = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
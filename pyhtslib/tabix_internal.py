@@ -11,6 +11,11 @@ __author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
 # export everything from this submodule manually, including the code that
 # starts with an underscore, importing modules will not import the latter
 __all__ = [
+    # constants
+    '_TBX_GENERIC',
+    '_TBX_SAM',
+    '_TBX_VCF',
+    '_TBX_UCSC',
     # htslib types
     '_tbx_conf_t',
     '_tbx_t',
@@ -30,6 +35,15 @@ __all__ = [
     '_tbx_seqnames',
 ]
 
+# ----------------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------------
+
+_TBX_GENERIC = 0
+_TBX_SAM = 1
+_TBX_VCF = 2
+_TBX_UCSC = 0x10000  # flag for zero-based begin positions
+
 # ----------------------------------------------------------------------------
 # Structures
 # ----------------------------------------------------------------------------
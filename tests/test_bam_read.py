@@ -3,7 +3,14 @@
 
 # TODO(holtgrewe): tests for CRAM
 
+import array
+import struct
+import warnings
+
+import pytest
+
 import pyhtslib.bam as bam
+import pyhtslib.hts as hts
 
 from tests.bam_fixtures import *  # NOQA
 
@@ -12,6 +19,12 @@ __author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
 QNAMES = ['I', 'II.14978392', 'III', 'IV', 'V', 'VI']
 END_POS = [102, 102, 102, 102, 102, 100101]
 FLAGS = [16, 16, 16, 16, 16, 2048]
+SEQ_I = ('CCTAGCCCTAACCCTAACCCTAACCCTAGCCTAAGCCTAAGCCTAAGCCT'
+         'AAGCCTAAGCCTAAGCCTAAGCCTAAGCCTAAGCCTAAGCCTAAGCCTAA')
+TAGS_I = [('XG', 1), ('XM', 5), ('XN', 0), ('XO', 1), ('XS', -18),
+          ('AS', -18), ('YT', 'UU')]
+QUAL_I = ('#############################@B?8B?BA@@DDBCDDCBC@C'
+          'DCDCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC')
 
 
 # ---------------------------------------------------------------------------
@@ -38,6 +51,11 @@ def check_file(f):
     assert all([records[i].flag == 16 for i in range(5)])
     assert all([records[i].is_reversed for i in range(5)])
 
+
+def count_records(shard, records):
+    """Count records of a shard in ``parallel_map()``"""
+    return sum(1 for _ in records)
+
 # ---------------------------------------------------------------------------
 # Tests
 # ---------------------------------------------------------------------------
@@ -58,6 +76,57 @@ def test_six_records_read_sequential_bam(six_records_bam):
         check_file(f)
 
 
+def test_decode_seq():
+    assert bam.decode_seq(b'\x12\x48\xf0', 5) == 'ACGTN'
+    assert bam.decode_seq(b'\x12\x48\xf0', 6) == 'ACGTN='
+    assert bam.decode_seq(b'', 0) == ''
+
+
+def test_decode_qual():
+    assert bam.decode_qual(b'\x00\x02\x28') == '!#I'
+    assert bam.decode_qual(b'\xff\xff') == '*'
+
+
+def test_six_records_seq_qual_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        record = next(iter(f))
+        assert record.seq == SEQ_I
+        assert record.qual == QUAL_I
+
+
+def test_six_records_lazy_fields_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        it = iter(f)
+        record = next(it)
+        assert record.flag == 16
+        assert list(record._cache.keys()) == ['flag']
+        detached = record.detach()
+        assert next(it).qname == 'II.14978392'
+        assert detached.qname == 'I'
+        assert detached.seq == SEQ_I
+        assert detached.ref_next is None
+        detached.free()
+
+
+def test_aux_tag_parser():
+    buf = (b'NMC\x05' + b'XSi' + struct.pack('<i', -18) + b'YTZUU\x00' +
+           b'XAAx' + b'MLBC' + struct.pack('<I', 3) + bytes([1, 2, 250]) +
+           b'XBBs' + struct.pack('<Ihh', 2, -1, 300) +
+           b'XFf' + struct.pack('<f', 1.5))
+    parser = bam.BAMAuxTagParser(buf)
+    assert parser.get_keys() == ['NM', 'XS', 'YT', 'XA', 'ML', 'XB', 'XF']
+    assert list(parser().items()) == [
+        ('NM', 5), ('XS', -18), ('YT', 'UU'), ('XA', 'x'),
+        ('ML', array.array('B', [1, 2, 250])),
+        ('XB', array.array('h', [-1, 300])), ('XF', 1.5)]
+
+
+def test_six_records_tags_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        record = next(iter(f))
+        assert list(record.tags.items()) == TAGS_I
+
+
 def test_two_hundred_read_sequential_sam(two_hundred_sam):
     with bam.BAMFile(str(two_hundred_sam)) as f:
         num = len(list(f))
@@ -76,6 +145,22 @@ def test_two_hundred_read_sequential_bam(two_hundred_bam):
         assert num == 200
 
 
+def test_two_hundred_read_sequential_bam_threads(two_hundred_bam):
+    with bam.BAMFile(str(two_hundred_bam), threads=2) as f:
+        num = len(list(f))
+        assert num == 200
+
+
+def test_two_hundred_read_threads_warning(two_hundred_bam):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with bam.BAMFile(str(two_hundred_bam), threads=2) as f:
+            assert len(list(f)) == 200
+    # reading with threads is only ignored, loudly, without hts_set_threads()
+    ignored = [w for w in caught if issubclass(w.category, RuntimeWarning)]
+    assert len(ignored) == (0 if hts._hts_set_threads else 1)
+
+
 def test_two_hundread_through_index_sam_gz(
         two_hundred_sam_gz, two_hundred_tbi):
     with bam.BAMIndex(str(two_hundred_sam_gz)) as idx:
@@ -86,3 +171,183 @@ def test_two_hundread_through_index_bam(two_hundred_bam, two_hundred_bai):
     with bam.BAMIndex(str(two_hundred_bam)) as idx:
         assert len(list(idx.query('chr17:10,000,000-11,000,000'))) == 2
         assert len(list(idx.query('chr17:10,000,000-15,000,000'))) == 12
+
+
+def test_two_hundread_through_index_bam_threads(
+        two_hundred_bam, two_hundred_bai):
+    with bam.BAMIndex(str(two_hundred_bam), threads=2) as idx:
+        assert len(list(idx.query('chr17:10,000,000-15,000,000'))) == 12
+
+
+def test_six_records_get_tag_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        record = next(iter(f))
+        assert record.get_tag('XS') == -18
+        assert record.get_tag('YT') == 'UU'
+        assert record.get_tag('NM') is None
+        assert record.get_tag('NM', 0) == 0
+        assert record.has_tag('XG')
+        assert not record.has_tag('NM')
+        assert 'tags' not in record._cache
+
+
+def test_six_records_tag_selector_bam(six_records_bam):
+    select = bam.TagSelector(['YT', 'XS', 'CB'])
+    with bam.BAMFile(str(six_records_bam)) as f:
+        values = [select(record) for record in f]
+    assert values[0] == ('UU', -18, None)
+    assert values[5] == (None, None, None)
+
+
+def test_six_records_iter_batches_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        batches = list(f.iter_batches(
+            batch_size=4, fields=['flag', 'end_pos', 'qname', 'seq']))
+    assert [len(b) for b in batches] == [4, 2]
+    assert list(batches[0]['flag']) + list(batches[1]['flag']) == FLAGS
+    assert (list(batches[0]['end_pos']) + list(batches[1]['end_pos']) ==
+            END_POS)
+    assert list(batches[0]['qname']) + list(batches[1]['qname']) == QNAMES
+    assert batches[0]['seq'][0] == SEQ_I
+
+
+def test_two_hundred_iter_batches_bam(two_hundred_bam):
+    with bam.BAMFile(str(two_hundred_bam)) as f:
+        assert sum(len(b) for b in f.iter_batches(batch_size=64)) == 200
+
+
+def test_six_records_iter_batches_cigar_tags_bam(six_records_bam):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        batches = list(f.iter_batches(
+            fields=['cigar'], tags=[('XS', 'i'), ('YT', 'Z')]))
+    assert len(batches) == 1
+    batch = batches[0]
+    assert list(batch['cigar']) == ['27M1D73M'] * 5 + ['27M100000D73M']
+    assert batch['XS'].type_ == 'i'
+    assert list(batch['XS']) == [-18] * 5 + [None]
+    assert list(batch['YT']) == ['UU'] * 5 + [None]
+
+
+def test_two_hundred_query_batches_bam(two_hundred_bam, two_hundred_bai):
+    with bam.BAMIndex(str(two_hundred_bam)) as idx:
+        batches = list(idx.query_batches(
+            'chr17:10,000,000-15,000,000', batch_size=5,
+            fields=['begin_pos', 'qname']))
+    assert [len(b) for b in batches] == [5, 5, 2]
+
+
+def test_six_records_to_arrow_bam(six_records_bam):
+    pytest.importorskip('pyarrow')
+    batches = list(bam.to_arrow(
+        str(six_records_bam), fields=['flag', 'qname', 'cigar'],
+        batch_size=4, tags={'XS': 'i'}))
+    assert [len(b) for b in batches] == [4, 2]
+    assert batches[0].schema.names == ['flag', 'qname', 'cigar', 'XS']
+    table = batches[1].to_pydict()
+    assert table['flag'] == FLAGS[4:]
+    assert table['qname'] == QNAMES[4:]
+    assert table['cigar'] == ['27M1D73M', '27M100000D73M']
+    assert table['XS'] == [-18, None]
+
+
+def test_two_hundred_write_parquet_bam(two_hundred_bam, two_hundred_bai,
+                                       tmpdir):
+    pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmpdir.join('two_hundred.parquet'))
+    num = bam.write_parquet(str(two_hundred_bam), path,
+                            region='chr17:10,000,000-15,000,000')
+    assert num == 12
+    assert pq.read_table(path).num_rows == 12
+
+
+def test_two_hundread_through_index_bam_cache(
+        two_hundred_bam, two_hundred_bai):
+    with bam.BAMIndex(str(two_hundred_bam), cache_size='1MB') as idx:
+        for _ in range(2):
+            assert len(list(idx.query('chr17:10,000,000-15,000,000'))) == 12
+        assert idx.cache.cache_size == 1024 ** 2
+
+
+def test_two_hundred_query_many_bam(two_hundred_bam, two_hundred_bai):
+    regions = ['chr17:10,500,000-15,000,000', 'chr17:10,000,000-11,000,000']
+    with bam.BAMIndex(str(two_hundred_bam)) as idx:
+        results = [(r.qname, matched)
+                   for r, matched in idx.query_many(regions)]
+    assert len(results) == 12
+    assert len(set(qname for qname, _ in results)) == len(results)
+    assert all(matched for _, matched in results)
+    assert sum(1 for _, matched in results if regions[1] in matched) == 2
+
+
+def test_two_hundred_query_many_bam_nearby(two_hundred_bam, two_hundred_bai):
+    regions = ['chr17:10,000,000-10,500,000', 'chr17:10,600,000-11,000,000',
+               'chr17:12,000,000-15,000,000']
+    with bam.BAMIndex(str(two_hundred_bam)) as idx:
+        expected = {}
+        for region in regions:
+            for record in idx.query(region):
+                expected.setdefault(record.qname, []).append(region)
+        for max_gap in (0, 10 ** 9):
+            results = dict((r.qname, matched) for r, matched
+                           in idx.query_many(regions, max_gap=max_gap))
+            assert results == expected
+
+
+def test_two_hundred_parallel_map_bam_overlapping(
+        two_hundred_bam, two_hundred_bai):
+    regions = ['chr17:10,000,000-12,000,000', 'chr17:11,000,000-15,000,000']
+    with bam.BAMIndex(str(two_hundred_bam)) as idx:
+        expected = len([r for r in idx.query('chr17:10,000,000-15,000,000')
+                        if r.begin_pos >= 9999999])
+        for processes in (1, 2):
+            assert idx.parallel_map(count_records, regions,
+                                    processes=processes,
+                                    reduce=int.__add__) == expected
+
+
+def test_two_hundred_parallel_map_bam(two_hundred_bam, two_hundred_bai):
+    with bam.BAMFile(str(two_hundred_bam)) as f:
+        expected = len([r for r in f if r.r_id >= 0 and r.begin_pos >= 0])
+    with bam.BAMIndex(str(two_hundred_bam)) as idx:
+        counts = idx.parallel_map(count_records, chunk_bp=1000000,
+                                  processes=2)
+        assert len(counts) > len(idx.bam_file.header.target_infos)
+        assert sum(counts) == expected
+        assert idx.parallel_map(count_records, chunk_bp=1000000,
+                                processes=1, reduce=int.__add__) == expected
+        region = 'chr17:10,000,000-11,000,000'
+        expected = len([r for r in idx.query(region)
+                        if r.begin_pos >= 9999999])
+        assert idx.parallel_map(count_records, [region], processes=2,
+                                reduce=int.__add__) == expected
+
+
+def test_two_hundred_build_index_bam(two_hundred_bam):
+    path = str(two_hundred_bam)
+    assert bam.BAMIndex.build(path) == path + '.bai'
+    assert bam.BAMIndex.build(path, min_shift=14) == path + '.csi'
+    with bam.BAMIndex(path) as idx:
+        assert len(list(idx.query('chr17:10,000,000-15,000,000'))) == 12
+    with bam.BAMIndex(path, bai_path=path + '.csi') as idx:
+        assert len(list(idx.query('chr17:10,000,000-15,000,000'))) == 12
+
+
+def test_two_hundred_auto_build_index_bam(two_hundred_bam, two_hundred_sam_gz):
+    for path in (str(two_hundred_bam), str(two_hundred_sam_gz)):
+        with bam.BAMIndex(path, auto_build=True, threads=2) as idx:
+            assert len(list(idx.query('chr17:10,000,000-11,000,000'))) == 2
+
+
+def test_build_many_index_bam(two_hundred_bam, six_records_bam):
+    paths = [str(two_hundred_bam), str(six_records_bam)]
+    assert (bam.BAMIndex.build_many(paths, processes=2) ==
+            [path + '.bai' for path in paths])
+    with bam.BAMIndex(paths[1]) as idx:
+        assert len(list(idx.query('CHROMOSOME_I'))) == 6
+
+
+def test_block_cache_requires_bgzf(six_records_sam):
+    with bam.BAMFile(str(six_records_sam)) as f:
+        with pytest.raises(hts.HTSException):
+            hts.BGZFBlockCache(f.struct_ptr, '1MB')
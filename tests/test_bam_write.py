@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Tests for writing SAM/BAM files"""
+
+import collections
+
+import pytest
+
+import pyhtslib.bam as bam
+
+from tests.bam_fixtures import *  # NOQA
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+QNAMES = ['I', 'II.14978392', 'III', 'IV', 'V', 'VI']
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+
+def read_records(path):
+    """Return list of ``(qname, flag, begin_pos, cigar, seq, tags)``"""
+    with bam.BAMFile(path) as f:
+        return [(r.qname, r.flag, r.begin_pos, str(r.cigar[0]), r.seq,
+                 list(r.tags.items())) for r in f]
+
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('name', ['out.bam', 'out.sam', 'out.sam.gz'])
+def test_bam_writer_copy(six_records_bam, tmpdir, name):
+    path = str(tmpdir.join(name))
+    with bam.BAMFile(str(six_records_bam)) as f:
+        with bam.BAMWriter(path, f.header) as writer:
+            for record in f:
+                writer.write(record)
+
+    expected = read_records(str(six_records_bam))
+    assert [x[0] for x in expected] == QNAMES
+    assert read_records(path) == expected
+
+
+def test_bam_writer_threads_level(six_records_bam, tmpdir):
+    path = str(tmpdir.join('out.bam'))
+    with bam.BAMFile(str(six_records_bam)) as f:
+        writer = bam.BAMWriter(path, f.header, threads=2, level=1)
+        assert writer.mode == 'wb1'
+        writer.open()
+        assert writer.write_many(f) == 6
+        writer.close()
+        writer.close()  # idempotent
+
+    assert read_records(path) == read_records(str(six_records_bam))
+
+
+def test_bam_writer_detached_records(six_records_bam, tmpdir):
+    # records and header that are not backed by htslib structs any more
+    with bam.BAMFile(str(six_records_bam)) as f:
+        header = bam.BAMHeader()
+        header.target_infos = f.header.target_infos
+        header.header_records = f.header.header_records
+        records = []
+        for record in f:
+            records.append(bam.BAMRecord(impl=bam.BAMRecordImpl(
+                *[getattr(record, name)
+                  for name in bam.BAMRecordImpl.FIELDS])))
+
+    path = str(tmpdir.join('out.bam'))
+    with bam.BAMWriter(path, header) as writer:
+        writer.write_many(records)
+
+    assert read_records(path) == read_records(str(six_records_bam))
+    with bam.BAMFile(path) as f:
+        assert ([(i.name, i.length) for i in f.header.target_infos] ==
+                [(i.name, i.length) for i in header.target_infos])
+
+
+def test_bam_writer_tag_types(six_records_bam, tmpdir):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        header = f.header
+        record = next(iter(f))
+        impl = bam.BAMRecordImpl(*[getattr(record, name)
+                                   for name in bam.BAMRecordImpl.FIELDS])
+    impl.tags = collections.OrderedDict(
+        [('XA', 'c'), ('XH', '1AE3'), ('XB', True), ('XZ', 'text')])
+    impl.tag_types = {'XA': 'A', 'XH': 'H'}
+
+    path = str(tmpdir.join('out.sam'))
+    with bam.BAMWriter(path, header) as writer:
+        writer.write(bam.BAMRecord(impl=impl))
+
+    with bam.BAMFile(path) as f:
+        record = next(iter(f))
+        assert list(record.tags.items()) == [
+            ('XA', 'c'), ('XH', '1AE3'), ('XB', 1), ('XZ', 'text')]
+        types = record.tag_types
+        assert (types['XA'], types['XH'], types['XZ']) == ('A', 'H', 'Z')
+        assert types['XB'] not in ('A', 'H', 'Z', 'f', 'd')
+        # the type codes read back are kept when copying the records
+        copy = bam.BAMRecord(impl=bam.BAMRecordImpl(
+            *[getattr(record, name) for name in bam.BAMRecordImpl.FIELDS]))
+    assert bam._sam_line(copy).split('\t')[11:] == [
+        'XA:A:c', 'XH:H:1AE3', 'XB:i:1', 'XZ:Z:text']
+
+
+def test_bam_writer_int_tag_ranges(six_records_bam, tmpdir):
+    with bam.BAMFile(str(six_records_bam)) as f:
+        header = f.header
+        record = next(iter(f))
+        impl = bam.BAMRecordImpl(*[getattr(record, name)
+                                   for name in bam.BAMRecordImpl.FIELDS])
+    impl.tag_types = None
+    impl.tags = collections.OrderedDict([
+        ('XU', 2 ** 32 - 1), ('XN', -2 ** 31), ('XA', [1, 2 ** 31 + 5])])
+
+    path = str(tmpdir.join('out.bam'))
+    with bam.BAMWriter(path, header) as writer:
+        writer.write(bam.BAMRecord(impl=impl))
+    with bam.BAMFile(path) as f:
+        record = next(iter(f))
+        assert record.tags['XU'] == 2 ** 32 - 1
+        assert record.tags['XN'] == -2 ** 31
+        assert list(record.tags['XA']) == [1, 2 ** 31 + 5]
+        assert (record.tag_types['XU'], record.tag_types['XA']) == (
+            'I', 'BI')
+
+    for value in (2 ** 32, -2 ** 31 - 1, [-1, 2 ** 31]):
+        impl.tags = collections.OrderedDict([('XX', value)])
+        with bam.BAMWriter(str(tmpdir.join('bad.bam')), header) as writer:
+            with pytest.raises(bam.BAMFileException):
+                writer.write(bam.BAMRecord(impl=impl))
+
+
+def test_bam_writer_bad_extension(tmpdir):
+    with pytest.raises(bam.BAMFileException):
+        bam.BAMWriter(str(tmpdir.join('out.txt')), bam.BAMHeader())
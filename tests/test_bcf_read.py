@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 """Tests for reading BCF/VCF files sequentially or through indices"""
 
+import ctypes
+
+import pytest
+
 import pyhtslib.bcf as bcf
 
 from tests.bcf_fixtures import *  # NOQA
@@ -48,6 +52,16 @@ def check_file(f):
 
     assert len(records) == 6
 
+
+def count_records(shard, records):
+    """Count records of a shard in ``parallel_map()``"""
+    return sum(1 for _ in records)
+
+
+def unpacked_levels(shard, records):
+    """Return set of the unpack levels of a shard in ``parallel_map()``"""
+    return {record.struct.unpacked for record in records}
+
 # ---------------------------------------------------------------------------
 # Tests
 # ---------------------------------------------------------------------------
@@ -86,6 +100,12 @@ def test_two_hundred_read_sequential_bcf(two_hundred_bcf):
         assert num == 200
 
 
+def test_two_hundred_read_sequential_bcf_threads(two_hundred_bcf):
+    with bcf.BCFFile(str(two_hundred_bcf), threads=2) as f:
+        num = len(list(f))
+        assert num == 200
+
+
 def test_two_hundread_through_index_vcf_gz(
         two_hundred_vcf_gz, two_hundred_tbi):
     with bcf.BCFIndex(str(two_hundred_vcf_gz)) as idx:
@@ -96,3 +116,330 @@ def test_two_hundread_through_index_bcf(two_hundred_bcf, two_hundred_csi):
     with bcf.BCFIndex(str(two_hundred_bcf)) as idx:
         assert len(list(idx.query('17:10,000,000-11,000,000'))) == 2
         assert len(list(idx.query('17:10,000,000-15,000,000'))) == 3
+
+
+def test_two_hundread_through_index_bcf_threads(
+        two_hundred_bcf, two_hundred_csi):
+    with bcf.BCFIndex(str(two_hundred_bcf), threads=2) as idx:
+        assert len(list(idx.query('17:10,000,000-15,000,000'))) == 3
+
+
+def test_two_hundred_query_many_bcf(two_hundred_bcf, two_hundred_csi):
+    regions = ['17:10,500,000-15,000,000', '17:10,000,000-11,000,000']
+    with bcf.BCFIndex(str(two_hundred_bcf)) as idx:
+        results = [(r.begin_pos, matched)
+                   for r, matched in idx.query_many(regions)]
+    assert len(results) == 3
+    assert all(matched for _, matched in results)
+    assert sum(1 for _, matched in results if regions[1] in matched) == 2
+
+
+def test_two_hundred_parallel_map_bcf(two_hundred_bcf, two_hundred_csi):
+    with bcf.BCFIndex(str(two_hundred_bcf)) as idx:
+        counts = idx.parallel_map(count_records, chunk_bp=1000000,
+                                  processes=2)
+        assert sum(counts) == 200
+        region = '17:10,000,000-11,000,000'
+        expected = len([r for r in idx.query(region)
+                        if r.begin_pos >= 9999999])
+        assert idx.parallel_map(count_records, [region], chunk_bp=100000,
+                                processes=1, reduce=int.__add__) == expected
+
+
+def test_two_hundred_parallel_map_bcf_kwargs(two_hundred_bcf, two_hundred_csi):
+    with bcf.BCFIndex(str(two_hundred_bcf), unpack='site',
+                      cache_size='1M') as idx:
+        assert idx._worker_kwargs() == {
+            'threads': 1, 'cache_size': 2 ** 20, 'samples': None,
+            'unpack': 'site'}
+        levels = idx.parallel_map(unpacked_levels, chunk_bp=1000000,
+                                  processes=2, reduce=set.union)
+    # the workers open the index with the same unpack level
+    assert levels == {bcf._BCF_UN_STR}
+
+
+def test_six_records_format_values_vcf(six_records_vcf):
+    with bcf.BCFFile(str(six_records_vcf)) as f:
+        record = next(iter(f))
+        assert len(record.genotypes) == 1
+        fields = record.genotypes[0].fields
+        assert list(fields.keys()) == ['GT', 'AD', 'DP', 'GQ', 'PL']
+        assert fields['GT'].allele_ids == [0, 1]
+        assert not fields['GT'].is_phased
+        assert fields['AD'] == [6, 4]
+        assert fields['DP'] == 10
+        assert fields['GQ'] == 99
+        assert fields['PL'] == [120, 0, 180]
+
+
+def test_genotype_call_missing_values():
+    call = bcf.GenotypeCall.from_values([bcf._bcf_gt_phased(0), None])
+    assert call.allele_ids == [0, None]
+    assert not call.is_phased
+    call = bcf.GenotypeCall.from_values(
+        [None, bcf._bcf_gt_phased(1), bcf._bcf_gt_unphased(0)])
+    assert call.allele_ids == [None, 1, 0]
+    assert call.is_phased
+    assert bcf.GenotypeCall.from_values([None, None]).allele_ids == [
+        None, None]
+
+
+def test_missing_gt_vcf(tmpdir):
+    path = tmpdir.join('missing_gt.vcf')
+    path.write('\n'.join([
+        '##fileformat=VCFv4.2',
+        '##contig=<ID=1,length=1000>',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                   'INFO', 'FORMAT', 'a', 'b', 'c']),
+        '\t'.join(['1', '100', '.', 'A', 'C', '.', '.', '.', 'DP:GT',
+                   '3:0|1', '4:./.', '5']),
+    ]) + '\n')
+    with bcf.BCFFile(str(path)) as f:
+        record = next(iter(f))
+        calls = [call.gt for call in record.genotypes]
+    assert [call.allele_ids for call in calls] == [
+        [0, 1], [None, None], [None]]
+    assert [call.is_phased for call in calls] == [True, False, False]
+
+
+def test_six_records_info_values_bcf(six_records_bcf):
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        record = next(iter(f))
+        info = record.info
+        assert isinstance(info, bcf.BCFInfo)
+        assert list(info)[:6] == ['AC', 'AF', 'AN', 'BaseQRankSum', 'DB', 'DP']
+        assert not info._values  # nothing decoded yet
+        assert info['AC'] == [1]
+        assert abs(info['AF'][0] - 0.5) < 0.01
+        assert info['DB'] is True
+        assert info['DP'] == 10
+        assert info['set'] == 'variant2'
+        assert 'DS' not in info
+        assert set(info._values) == set(['AC', 'AF', 'DB', 'DP', 'set'])
+        metas = f.header._field_metas
+        assert metas[(bcf._BCF_HL_INFO, f.header.ids.index('DP'))] is \
+            info._metas['DP']
+        detached = record.detach()
+        assert detached.info['DP'] == 10
+
+
+def test_six_records_buffer_arena_bcf(six_records_bcf):
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        it = iter(f)
+        addresses = set()
+        for record in it:
+            assert record._buffers is it.buffers
+            assert record.info['AC'] == [1]
+            assert record.genotypes[0].fields['AD']
+            addresses.add(ctypes.addressof(it.buffers.int32.ptr.contents))
+        # same sizes in all records, htslib only reallocates when growing
+        assert len(addresses) == 1
+        assert not it.buffers.int32.ptr
+        assert not it.buffers.char.ptr
+
+
+def test_six_records_accessors_bcf(six_records_bcf):
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        get_dp = f.header.info_accessor('DP')
+        get_af = f.header.info_accessor('AF')
+        get_db = f.header.info_accessor('DB')
+        get_ds = f.header.info_accessor('DS')
+        get_set = f.header.info_accessor('set')
+        get_ad = f.header.format_accessor('AD')
+        get_gq = f.header.format_accessor('GQ')
+        for i, record in enumerate(f):
+            assert get_dp(record) == record.info['DP']
+            assert get_af(record) == pytest.approx(record.info['AF'])
+            assert get_db(record) == ('DB' in record.info)
+            assert get_ds(record) is False
+            assert get_set(record) == record.info['set']
+            assert get_ad(record) == [gt.fields['AD']
+                                      for gt in record.genotypes]
+            assert get_gq(record) == [gt.gq for gt in record.genotypes]
+            if i == 0:
+                assert get_dp(record) == 10
+                assert get_ad(record) == [[6, 4]]
+                detached = record.detach()
+                assert get_dp(detached) == 10
+                assert get_ad(detached) == [[6, 4]]
+
+
+def test_six_records_accessors_undefined_bcf(six_records_bcf):
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        with pytest.raises(bcf.BCFFileException):
+            f.header.info_accessor('GQ')  # FORMAT only
+        with pytest.raises(bcf.BCFFileException):
+            f.header.format_accessor('XX')
+
+
+def test_six_records_gt_array_vcf(six_records_vcf):
+    pytest.importorskip('numpy')
+    with bcf.BCFFile(str(six_records_vcf)) as f:
+        for record in f:
+            alleles, phased = record.gt_array()
+            assert alleles.dtype.name == 'int8'
+            assert alleles.shape == (1, 2)
+            assert alleles.tolist() == [[0, 1]]
+            assert phased.tolist() == [False]
+
+
+def test_two_hundred_iter_gt_blocks_bcf(two_hundred_bcf):
+    pytest.importorskip('numpy')
+    with bcf.BCFFile(str(two_hundred_bcf)) as f:
+        blocks = list(f.iter_gt_blocks(64))
+    assert [alleles.shape[0] for alleles, _ in blocks] == [64, 64, 64, 8]
+    assert all(alleles.shape[1:] == (1, 2) for alleles, _ in blocks)
+    assert all(phased.shape == (len(alleles), 1) for alleles, phased in blocks)
+
+
+def test_iter_gt_blocks_without_gt(tmpdir):
+    np = pytest.importorskip('numpy')
+    path = tmpdir.join('mixed_gt.vcf')
+    path.write('\n'.join([
+        '##fileformat=VCFv4.2',
+        '##contig=<ID=1,length=1000>',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                   'INFO', 'FORMAT', 'a', 'b']),
+        '\t'.join(['1', '100', '.', 'A', 'C', '.', '.', '.', 'GT',
+                   '0|1', '1/1']),
+        '\t'.join(['1', '200', '.', 'A', 'C', '.', '.', '.', 'DP',
+                   '3', '4']),
+        '\t'.join(['1', '300', '.', 'A', 'C', '.', '.', '.']),
+    ]) + '\n')
+    with bcf.BCFFile(str(path)) as f:
+        for record in f:
+            if record.begin_pos == 199:
+                with pytest.raises(bcf.BCFFileException):
+                    record.gt_array()
+    with bcf.BCFFile(str(path)) as f:
+        (alleles, phased), = list(f.iter_gt_blocks())
+    assert alleles.shape == (3, 2, 2)
+    assert alleles[0].tolist() == [[0, 1], [1, 1]]
+    missing = [[bcf.GT_MISSING, bcf.GT_VECTOR_END]] * 2
+    assert alleles[1].tolist() == missing
+    assert alleles[2].tolist() == missing
+    assert phased.tolist() == [[True, False], [False, False], [False, False]]
+    assert phased.dtype == np.bool_
+
+
+def test_six_records_samples_vcf(six_records_vcf):
+    with bcf.BCFFile(str(six_records_vcf), samples=['manuel']) as f:
+        assert f.header.sample_names == ['manuel']
+        assert all(len(record.genotypes) == 1 for record in f)
+    with bcf.BCFFile(str(six_records_vcf), samples=[]) as f:
+        assert f.header.sample_names == []
+        assert all(len(record.genotypes) == 0 for record in f)
+
+
+def test_six_records_samples_unknown_bcf(six_records_bcf):
+    with pytest.raises(bcf.BCFFileException):
+        with bcf.BCFFile(str(six_records_bcf), samples=['nobody']):
+            pass
+
+
+def test_two_hundread_through_index_bcf_samples(
+        two_hundred_bcf, two_hundred_csi):
+    with bcf.BCFIndex(str(two_hundred_bcf), samples=[]) as idx:
+        assert idx.bcf_file.header.sample_names == []
+        num_genotypes = [len(record.genotypes)
+                         for record in idx.query('17:10,000,000-15,000,000')]
+        assert num_genotypes == [0, 0, 0]
+
+
+def test_six_records_read_sequential_bcf_unpack(six_records_bcf):
+    for unpack in ['site', 'shared', 'all']:
+        with bcf.BCFFile(str(six_records_bcf), unpack=unpack) as f:
+            check_file(f)
+
+
+def test_six_records_unpack_site_bcf(six_records_bcf):
+    with bcf.BCFFile(str(six_records_bcf), unpack='site') as f:
+        for record, ref in zip(f, REFS):
+            assert record.ref == ref
+            assert record.struct.unpacked == bcf._BCF_UN_STR
+            assert len(record.genotypes) == 1
+            assert record.struct.unpacked == bcf._BCF_UN_ALL
+
+
+def test_six_records_unpack_invalid(six_records_bcf):
+    with pytest.raises(bcf.BCFFileException):
+        bcf.BCFFile(str(six_records_bcf), unpack='none')
+
+
+def test_two_hundread_through_index_bcf_unpack(
+        two_hundred_bcf, two_hundred_csi):
+    with bcf.BCFIndex(str(two_hundred_bcf), unpack='site') as idx:
+        alts = []
+        for record in idx.query('17:10,000,000-15,000,000'):
+            assert record.struct.unpacked == bcf._BCF_UN_STR
+            alts.append(record.alts)
+        assert len(alts) == 3
+
+
+def test_six_records_to_arrow_vcf(six_records_vcf):
+    pytest.importorskip('pyarrow')
+    fields = ['CHROM', 'POS', 'REF', 'ALT', 'INFO/AF', 'INFO/DP', 'INFO/DB',
+              'FORMAT/GT', 'FORMAT/DP']
+    batches = list(bcf.to_arrow(str(six_records_vcf), fields, batch_size=4))
+    assert [len(b) for b in batches] == [4, 2]
+    assert batches[0].schema.names == fields
+    table = batches[0].to_pydict()
+    assert table['CHROM'] == CHROMS[:4]
+    assert table['POS'] == [pos + 1 for pos in BEGIN_POS[:4]]
+    assert table['ALT'] == ALTS[:4]
+    assert table['INFO/DP'][0] == 10
+    assert table['INFO/DB'][0] is True
+    assert table['FORMAT/GT'][0] == ['0/1']
+    assert table['FORMAT/DP'][0] == [10]
+
+
+def test_two_hundred_to_arrow_regions_bcf(two_hundred_bcf, two_hundred_csi):
+    pytest.importorskip('pyarrow')
+    regions = ['17:10,500,000-15,000,000', '17:10,000,000-11,000,000']
+    batches = list(bcf.to_arrow(str(two_hundred_bcf), regions=regions))
+    assert sum(len(b) for b in batches) == 3
+
+
+def test_two_hundred_write_parquet_bcf(two_hundred_bcf, tmpdir):
+    pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmpdir.join('two_hundred.parquet'))
+    assert bcf.write_parquet(str(two_hundred_bcf), path, batch_size=64) == 200
+    table = pq.read_table(path)
+    assert table.num_rows == 200
+    assert table.schema.names == list(bcf.BCF_ARROW_SITE_FIELDS)
+
+
+def test_six_records_to_arrow_invalid_field(six_records_vcf):
+    pytest.importorskip('pyarrow')
+    with pytest.raises(bcf.BCFFileException):
+        bcf.to_arrow(str(six_records_vcf), ['CHROM', 'INFO/XX'])
+
+
+def test_two_hundred_build_index_bcf(two_hundred_bcf, two_hundred_vcf_gz):
+    path = str(two_hundred_bcf)
+    assert bcf.BCFIndex.build(path) == path + '.csi'
+    with pytest.raises(bcf.BCFIndexException):
+        bcf.BCFIndex.build(path, min_shift=0)
+    with bcf.BCFIndex(path) as idx:
+        assert len(list(idx.query('17:10,000,000-15,000,000'))) == 3
+    path = str(two_hundred_vcf_gz)
+    assert bcf.BCFIndex.build(path) == path + '.tbi'
+    assert bcf.BCFIndex.build(path, min_shift=14) == path + '.csi'
+    with bcf.BCFIndex(path, csi_path=path + '.csi') as idx:
+        assert len(list(idx.query('17:10,000,000-15,000,000'))) == 3
+
+
+def test_two_hundred_auto_build_index_bcf(two_hundred_bcf):
+    with bcf.BCFIndex(str(two_hundred_bcf), auto_build=True) as idx:
+        assert len(list(idx.query('17:10,000,000-11,000,000'))) == 2
+
+
+def test_build_many_index_bcf(two_hundred_bcf, six_records_bcf):
+    paths = [str(two_hundred_bcf), str(six_records_bcf)]
+    assert (bcf.BCFIndex.build_many(paths, threads=2, processes=2) ==
+            [path + '.csi' for path in paths])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Tests for writing VCF/BCF files"""
+
+import pytest
+
+import pyhtslib.bcf as bcf
+
+from tests.bcf_fixtures import *  # NOQA
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+
+def read_sites(path):
+    """Return list of ``(chrom, begin_pos, ref, alts, filters, info)``"""
+    with bcf.BCFFile(path) as f:
+        return [(r.chrom, r.begin_pos, r.ref, r.alts, r.filters,
+                 dict(r.info)) for r in f]
+
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('name', ['out.bcf', 'out.vcf', 'out.vcf.gz'])
+def test_bcf_writer_copy(six_records_bcf, tmpdir, name):
+    path = str(tmpdir.join(name))
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        with bcf.BCFWriter(path, f.header) as writer:
+            for record in f:
+                writer.write(record)
+
+    expected = read_sites(str(six_records_bcf))
+    assert len(expected) == 6
+    assert read_sites(path) == expected
+    with bcf.BCFFile(path) as f:
+        assert f.header.sample_names == ['manuel']
+
+
+def test_bcf_writer_threads_level(six_records_bcf, tmpdir):
+    path = str(tmpdir.join('out.bcf'))
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        writer = bcf.BCFWriter(path, f.header, mode='wb', threads=2, level=1)
+        assert writer.mode == 'wb1'
+        writer.open()
+        assert writer.write_many(f) == 6
+        writer.close()
+        writer.close()  # idempotent
+
+    assert read_sites(path) == read_sites(str(six_records_bcf))
+
+
+def test_bcf_writer_translate(six_records_bcf, six_records_vcf, tmpdir):
+    path = str(tmpdir.join('out.bcf'))
+    with bcf.BCFFile(str(six_records_bcf)) as f_out, \
+            bcf.BCFFile(str(six_records_vcf)) as f_in:
+        chroms = []
+        with bcf.BCFWriter(path, f_out.header) as writer:
+            for record in f_in:
+                assert not writer._same_header(record.header)
+                writer.write(record)
+                chroms.append(record.chrom)  # still valid for its header
+
+    assert chroms == ['2', '2', '2', '19', '20', '22']
+    assert read_sites(path) == read_sites(str(six_records_vcf))
+
+
+def test_bcf_writer_detached_records(six_records_bcf, tmpdir):
+    with bcf.BCFFile(str(six_records_bcf)) as f:
+        header = bcf.BCFHeader()
+        header.sample_names = f.header.sample_names
+        for record in f.header.header_records:
+            header.add_header_record(record)
+        records = [record.detach() for record in f]
+
+    path = str(tmpdir.join('out.vcf'))
+    with bcf.BCFWriter(path, header) as writer:
+        writer.write_many(records)
+
+    expected = read_sites(str(six_records_bcf))
+    actual = read_sites(path)
+    assert [x[:5] for x in actual] == [x[:5] for x in expected]
+    assert [sorted(x[5]) for x in actual] == [sorted(x[5]) for x in expected]
+
+
+def test_bcf_writer_float_precision(tmpdir):
+    src = tmpdir.join('floats.vcf')
+    src.write('\n'.join([
+        '##fileformat=VCFv4.2',
+        '##contig=<ID=1,length=1000>',
+        '##INFO=<ID=X,Number=2,Type=Float,Description="Values">',
+        '##FORMAT=<ID=Y,Number=1,Type=Float,Description="Value">',
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+                   'INFO', 'FORMAT', 'a']),
+        '\t'.join(['1', '100', '.', 'A', 'C', '12.345678', '.',
+                   'X=0.1234567,98765.43', 'Y', '1.0000001']),
+    ]) + '\n')
+    with bcf.BCFFile(str(src)) as f:
+        header = f.header
+        record = next(iter(f)).detach()
+        path = str(tmpdir.join('out.vcf'))
+        with bcf.BCFWriter(path, header) as writer:
+            writer.write(record)
+
+    def values(record):
+        return (record.qual, list(record.info['X']),
+                record.genotypes[0].fields['Y'])
+
+    with bcf.BCFFile(path) as f:
+        assert values(next(iter(f))) == values(record)
+    with open(path) as f:
+        line = [l for l in f if not l.startswith('#')][0]
+    assert '\t12.345678\t' in line
+    assert 'X=0.1234567,98765.43' in line
+    assert line.rstrip('\n').endswith('\t1.0000001')
+
+
+def test_bcf_writer_bad_extension(tmpdir):
+    with pytest.raises(bcf.BCFFileException):
+        bcf.BCFWriter(str(tmpdir.join('out.txt')), bcf.BCFHeader())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Tests for the module pyhtslib.hts"""
+
+import pytest
+
+import pyhtslib
+import pyhtslib.hts as hts
+
+__author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
+
+# ---------------------------------------------------------------------------
+# Tests
+# ---------------------------------------------------------------------------
+
+
+def test_shard_genome_whole_genome():
+    shards = hts.shard_genome([('1', 25), ('2', 0)], chunk_bp=10)
+    assert shards == [
+        pyhtslib.GenomeInterval('1', 0, 10),
+        pyhtslib.GenomeInterval('1', 10, 20),
+        pyhtslib.GenomeInterval('1', 20, 25),
+        pyhtslib.GenomeInterval('2', 0, hts.UNKNOWN_LENGTH_END),
+    ]
+
+
+def test_shard_genome_regions():
+    shards = hts.shard_genome([('1', 25), ('2', 0)],
+                              ['1:3-14', pyhtslib.GenomeInterval('2', 0, 15)],
+                              chunk_bp=10)
+    assert shards == [
+        pyhtslib.GenomeInterval('1', 2, 12),
+        pyhtslib.GenomeInterval('1', 12, 14),
+        pyhtslib.GenomeInterval('2', 0, 10),
+        pyhtslib.GenomeInterval('2', 10, 15),
+    ]
+
+
+def test_shard_genome_overlapping_regions():
+    shards = hts.shard_genome([('1', 5000), ('2', 0)],
+                              ['1:1000-3000', '2', '1:1-2000'],
+                              chunk_bp=1000)
+    assert shards == [
+        pyhtslib.GenomeInterval('1', 0, 1000),
+        pyhtslib.GenomeInterval('1', 1000, 2000),
+        pyhtslib.GenomeInterval('1', 2000, 3000),
+        pyhtslib.GenomeInterval('2', 0, hts.UNKNOWN_LENGTH_END),
+    ]
+
+
+def test_shard_genome_unknown_seq():
+    with pytest.raises(hts.HTSException):
+        hts.shard_genome([('1', 25)], ['3:1-10'])
+
+
+def test_parse_size():
+    assert hts.parse_size(1024) == 1024
+    assert hts.parse_size('256MB') == 256 * 1024 ** 2
+    assert hts.parse_size('1.5k') == 1536
+    assert hts.parse_size('100') == 100
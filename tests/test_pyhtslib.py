@@ -13,3 +13,12 @@ __author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
 def test_genome_interval():
     gitv = pyhtslib.GenomeInterval('chr1', 1000, 2000)
     assert str(gitv) == 'chr1:1,001-2,000'
+
+
+def test_genome_interval_from_str():
+    gitv = pyhtslib.GenomeInterval.from_str('chr1:1,001-2,000')
+    assert gitv == pyhtslib.GenomeInterval('chr1', 1000, 2000)
+    gitv = pyhtslib.GenomeInterval.from_str('chr1:1001')
+    assert gitv == pyhtslib.GenomeInterval('chr1', 1000, None)
+    gitv = pyhtslib.GenomeInterval.from_str('chr1')
+    assert gitv == pyhtslib.GenomeInterval('chr1', 0, None)
@@ -5,6 +5,7 @@ import os
 import py
 import pytest
 
+import pyhtslib.hts_internal as hts_internal
 import pyhtslib.tabix as tabix
 
 __author__ = 'Manuel Holtgrewe <manuel.holtgrewe@bihealth.de>'
@@ -42,6 +43,15 @@ def reduced_pg_tbi(tmpdir):
     yield dst
     dst.remove()
 
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+
+def count_records(shard, records):
+    """Count records of a shard in ``parallel_map()``"""
+    return sum(1 for _ in records)
+
 # ---------------------------------------------------------------------------
 # Tests
 # ---------------------------------------------------------------------------
@@ -110,8 +120,186 @@ def test_vcf_tabix_load_chr3_region(reduced_pg_vcf, reduced_pg_tbi):
     assert count == 3
 
 
+def test_vcf_tabix_load_chr3_threads(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True,
+                          threads=2) as t:
+        assert len(list(t.query('chr3'))) == 7
+
+
+def test_vcf_tabix_load_chr3_cache(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True,
+                          cache_size=1024 ** 2) as t:
+        assert len(list(t.query('chr3'))) == 7
+        assert len(list(t.query('chr3'))) == 7
+        assert t.cache.cache_size == 1024 ** 2
+
+
+def test_vcf_tabix_query_many(reduced_pg_vcf, reduced_pg_tbi):
+    regions = ['chr3:45,000,000-150,000,000', 'chr3']
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        results = list(t.query_many(regions))
+    assert len(results) == 7
+    assert sum(1 for _, matched in results if len(matched) == 2) == 3
+
+
+def test_vcf_tabix_query_many_gaps(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        lines = list(t.query('chr3'))
+        begins = [int(line.split('\t')[1]) for line in lines]
+        # one region per line, none overlapping
+        regions = ['chr3:{}-{}'.format(pos, pos) for pos in begins]
+        for max_gap in (0, 10 ** 9):
+            results = [(line, matched) for line, matched in
+                       t.query_many(regions, max_gap=max_gap)]
+            assert results == [(line, [region])
+                               for line, region in zip(lines, regions)]
+
+
+def test_vcf_tabix_parallel_map(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        assert sum(t.parallel_map(count_records, processes=2)) == 112
+        assert t.parallel_map(count_records, ['chr3:45,000,000-150,000,000'],
+                              chunk_bp=1000000, processes=2,
+                              reduce=int.__add__) == 3
+
+
 def test_vcf_tabix_get_header(reduced_pg_vcf, reduced_pg_tbi):
     with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
         header = t.get_header()
         assert header.startswith('##fileformat=VCFv4.1')
         assert len(header) == 3598
+
+
+def test_tabix_writer_vcf(reduced_pg_vcf, reduced_pg_tbi, tmpdir):
+    path = str(tmpdir.join('out.vcf.gz'))
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        header = t.get_header()
+        with tabix.TabixWriter(path) as writer:
+            writer.write_many(header.splitlines())
+            assert writer.write_many(t.from_start()) == 112
+    assert os.path.exists(path + '.tbi')
+    with tabix.TabixIndex(path, require_index=True) as t:
+        assert t.get_header() == header
+        assert len(list(t.from_start())) == 112
+        assert len(list(t.query('chr3'))) == 7
+        assert len(list(t.query('chr3:45,000,000-150,000,000'))) == 3
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_tabix_writer_bed(tmpdir, threads):
+    if threads > 1 and not hts_internal._bgzf_idx_push:
+        pytest.skip('indexing with threads requires htslib >= 1.10')
+    path = str(tmpdir.join('out.bed.gz'))
+    lines = ['chr{}\t{}\t{}\tx'.format(c, i * 100, i * 100 + 50)
+             for c in (1, 2) for i in range(1000)]
+    config = tabix.TabixConfig.from_extension(path, min_shift=14)
+    with tabix.TabixWriter(path, config, threads=threads, level=1) as writer:
+        assert writer._threaded == (threads > 1)
+        writer.write('#comment\n')
+        writer.write_many(lines)
+    assert os.path.exists(path + '.csi')
+    with tabix.TabixIndex(path, tbi_path=path + '.csi') as t:
+        assert list(t.query('chr2:1-200')) == lines[1000:1002]
+        assert len(list(t.query('chr1'))) == 1000
+
+
+def test_tabix_writer_threads_without_index(tmpdir):
+    path = str(tmpdir.join('out.bed.gz'))
+    if not hts_internal._bgzf_idx_push:
+        with pytest.raises(tabix.TabixIndexException):
+            tabix.TabixWriter(path, threads=2)
+    with tabix.TabixWriter(path, threads=2, index=False) as writer:
+        writer.write('chr1\t100\t200')
+    assert not os.path.exists(path + '.tbi')
+    with pytest.raises(tabix.TabixIndexException):
+        tabix.TabixIndex.build(str(tmpdir.join('missing.bed.gz')))
+
+
+def test_tabix_writer_unsorted(tmpdir):
+    path = str(tmpdir.join('out.bed.gz'))
+    writer = tabix.TabixWriter(path)
+    writer.open()
+    writer.write('chr1\t100\t200')
+    with pytest.raises(tabix.TabixIndexException):
+        writer.write('chr1\t50\t60')
+    writer.close()
+
+
+def test_vcf_tabix_query_columns(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        lines = [l.split('\t') for l in t.query('chr3')]
+        batches = list(t.query_columns(
+            'chr3', {0: str, 1: int, 4: str, 2: bytes}, batch_size=5))
+    assert [len(b[0]) for b in batches] == [5, 2]
+    assert list(batches[0]) == [0, 1, 2, 4]
+    assert sum((b[0] for b in batches), []) == ['chr3'] * 7
+    assert (sum((b[1].tolist() for b in batches), []) ==
+            [int(l[1]) for l in lines])
+    assert batches[0][2] == [l[2].encode('utf-8') for l in lines[:5]]
+
+
+def test_vcf_tabix_query_columns_numpy(reduced_pg_vcf, reduced_pg_tbi):
+    np = pytest.importorskip('numpy')
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        lines = [l.split('\t') for l in t.query('chr3')]
+        batch, = t.query_columns('chr3', {1: int, 0: str}, as_numpy=True)
+        floats, = t.query_columns('chr3', {1: float}, as_numpy=True)
+    assert batch[1].dtype == np.int64
+    assert batch[1].tolist() == [int(l[1]) for l in lines]
+    assert batch[0].tolist() == ['chr3'] * 7
+    assert floats[1].dtype == np.float64
+    assert floats[1].tolist() == [float(l[1]) for l in lines]
+
+
+def test_vcf_tabix_query_columns_invalid(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        with pytest.raises(tabix.TabixIndexException):
+            t.query_columns('chr3', {0: list})
+        with pytest.raises(tabix.TabixIndexException):
+            list(t.query_columns('chr3', {2: int}))
+
+
+def test_vcf_tabix_raw(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True) as t:
+        lines = list(t.query('chr3'))
+        raw_lines = list(t.query('chr3', raw=True))
+        assert all(isinstance(l, bytes) for l in raw_lines)
+        assert [l.decode('utf-8') for l in raw_lines] == lines
+        raw_all = list(t.from_start(raw=True))
+        assert len(raw_all) == 112
+        assert raw_all == [l.encode('utf-8') for l in t.from_start()]
+
+
+def test_vcf_tabix_from_start_sequential(reduced_pg_vcf, reduced_pg_tbi):
+    with tabix.TabixIndex(str(reduced_pg_vcf), require_index=True,
+                          threads=2) as t:
+        it = t.from_start()
+        assert it.chrom is None
+        chroms = []
+        for line in it:
+            assert not line.startswith('#')
+            assert it.chrom == line.split('\t')[0]
+            chroms.append(it.chrom)
+        assert len(chroms) == 112
+        assert chroms.count('chr3') == 7
+        # the index's own file is not moved by the sequential reader
+        assert len(list(t.query('chr3'))) == 7
+
+
+def test_tabix_writer_index_matches_build(tmpdir):
+    path = str(tmpdir.join('out.bed.gz'))
+    lines = ['chr{}\t{}\t{}\tname{}'.format(c, i * 37, i * 37 + i % 500, i)
+             for c in (1, 2, 3) for i in range(20000)]
+    with tabix.TabixWriter(path) as writer:
+        writer.write_many(lines)
+    built_path = str(tmpdir.join('built.bed.gz'))
+    py.path.local(path).copy(py.path.local(built_path))
+    tabix.TabixIndex.build(built_path)
+    regions = ['chr1', 'chr2:1-100', 'chr2:300,000-400,000',
+               'chr3:739,000-740,000', 'chr3:1-1']
+    with tabix.TabixIndex(path, auto_build=False) as written, \
+            tabix.TabixIndex(built_path, auto_build=False) as built:
+        for region in regions:
+            expected = list(built.query(region))
+            assert list(written.query(region)) == expected
+            assert expected or region == 'chr3:1-1'